@@ -0,0 +1,207 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import json
+import os
+import sys
+from time import time
+
+import psutil
+
+from mo_dots import wrap
+from mo_files import File
+from mo_http import http
+from mo_json import value2json
+from mo_logs import Log, constants, startup
+from mo_threads import Lock, Thread, Till
+from tests.hg_fixture import HgFixture
+from tuid.service import TUIDService
+from tuid.util import delete
+
+# Replays recorded hg.mozilla.org responses so the service can be measured
+# without network access (Elasticsearch is still expected on localhost).
+#
+# Record the fixtures once, with network:
+#     python tests/benchmark.py --config=tests/config/benchmark.json --record
+# Then measure, offline:
+#     python tests/benchmark.py --config=tests/config/benchmark.json
+
+MEMORY_SAMPLE_INTERVAL = 0.1  # seconds
+
+
+class MemorySampler(object):
+    """
+    Track the peak resident memory while a workload runs
+    """
+
+    def __init__(self):
+        self.process = psutil.Process(os.getpid())
+        self.locker = Lock()
+        self.peak = 0
+        self.thread = None
+
+    def __enter__(self):
+        self.start = self.peak = self.process.memory_info().rss
+        self.thread = Thread.run("memory sampler", self._sample)
+        return self
+
+    def _sample(self, please_stop):
+        while not please_stop:
+            rss = self.process.memory_info().rss
+            with self.locker:
+                self.peak = max(self.peak, rss)
+            (please_stop | Till(seconds=MEMORY_SAMPLE_INTERVAL)).wait()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.thread.stop()
+        self.thread.join()
+        self.end = self.process.memory_info().rss
+
+
+def find_old_revision(hg_url, branch, new_revision, num_changesets):
+    """
+    :return: the revision num_changesets before new_revision
+    """
+    found = []
+    final_rev = new_revision
+    while len(found) < num_changesets:
+        clog = http.get_json(str(hg_url) + "/" + branch + "/json-log/" + final_rev)
+        for cset in clog.changesets[:-1]:
+            found.append(cset.node[:12])
+        final_rev = clog.changesets[-1].node[:12]
+    return found[num_changesets - 1]
+
+
+def run_workload(name, fixture, function):
+    before = fixture.stats()
+    with MemorySampler() as memory:
+        start = time()
+        files_returned = function()
+        duration = time() - start
+    after = fixture.stats()
+
+    result = wrap(
+        {
+            "name": name,
+            "seconds": round(duration, 3),
+            "files": files_returned,
+            "files_per_second": round(files_returned / duration, 2) if duration else None,
+            "memory": {
+                "start_mb": round(memory.start / 1000000, 1),
+                "peak_mb": round(memory.peak / 1000000, 1),
+                "end_mb": round(memory.end / 1000000, 1),
+            },
+            "hg_requests": {k: after[k] - before[k] for k in after},
+        }
+    )
+    Log.note("{{name}}: {{result|json}}", name=name, result=result)
+    return result
+
+
+def main():
+    config = startup.read_settings(
+        defs=[
+            {
+                "name": ["--record"],
+                "help": "fetch missing responses from hg.mozilla.org and record them",
+                "action": "store_true",
+                "dest": "record",
+            }
+        ],
+        default_filename="tests/config/benchmark.json",
+    )
+    constants.set(config.constants)
+    Log.start(config.debug)
+
+    bench = config.benchmark
+    if config.args.record:
+        bench.fixture.record = True
+    fixture = None
+    failed = False
+
+    try:
+        if not bench.fixture.record and not File(bench.fixture.database.filename).exists:
+            Log.error(
+                "No hg responses are recorded in {{filename}}, run once with --record",
+                filename=bench.fixture.database.filename,
+            )
+        fixture = HgFixture(bench.fixture)
+
+        # START FROM AN EMPTY SERVICE DATABASE
+        File(config.tuid.database.name).delete()
+        service = TUIDService(kwargs=config.tuid, start_workers=False)
+        service.clogger.disable_all()
+
+        with open(bench.files, "r") as f:
+            files = json.load(f)[: bench.num_files]
+        branch = config.tuid.hg.branch
+
+        old_revision = find_old_revision(
+            service.hg_url, branch, bench.new_revision, bench.num_changesets
+        )
+        service.clogger.initialize_to_range(old_revision, bench.new_revision)
+        service.annotation_writer.flush()
+        delete(service.annotations, {"terms": {"file": files}})
+
+        results = [
+            run_workload(
+                "cold " + str(len(files)) + " files",
+                fixture,
+                lambda: len(
+                    service.get_tuids_from_files(files, old_revision, use_thread=False)[0]
+                ),
+            ),
+            run_workload(
+                "warm " + str(len(files)) + " files",
+                fixture,
+                lambda: len(
+                    service.get_tuids_from_files(files, old_revision, use_thread=False)[0]
+                ),
+            ),
+            run_workload(
+                "frontier advance " + str(bench.num_changesets) + " changesets",
+                fixture,
+                lambda: len(
+                    service.get_tuids_from_files(
+                        files, bench.new_revision, going_forward=True, use_thread=False
+                    )[0]
+                ),
+            ),
+            run_workload(
+                "try branch",
+                fixture,
+                lambda: len(
+                    service.get_tuids_from_files(
+                        files[: bench.num_try_files],
+                        bench.try_revision,
+                        repo="try",
+                        use_thread=False,
+                    )[0]
+                ),
+            ),
+        ]
+
+        if bench.output:
+            File(bench.output).write(value2json(results, pretty=True))
+        Log.note("Benchmark complete:\n{{results|json}}", results=results)
+    except Exception as e:
+        Log.warning("Benchmark failed", cause=e)
+        failed = True
+    finally:
+        if fixture:
+            fixture.stop()
+        Log.stop()
+    if failed:
+        # SO SCRIPTS AND CI SEE THE FAILURE
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import json
+
+import flask
+from flask import Flask, Response
+from werkzeug.serving import make_server
+
+from jx_sqlite.sqlite import Sqlite, quote_list, quote_value
+from mo_dots import coalesce
+from mo_files.url import URL
+from mo_http import http
+from mo_kwargs import override
+from mo_logs import Log
+from mo_threads import Lock, Thread
+from mo_times import Date
+
+DEBUG = False
+
+
+class HgFixture(object):
+    """
+    A LOCAL STAND-IN FOR hg.mozilla.org
+
+    Serves responses recorded in a Sqlite database with the same `cache`
+    table used by `mo_hg.relay.cache`, so a relay database can be replayed
+    directly. With `record=True`, misses are fetched from `source` and
+    stored; otherwise they return 404.
+    """
+
+    @override
+    def __init__(
+        self, database, port=8123, host="localhost", record=False, source=None, kwargs=None
+    ):
+        self.db = Sqlite(kwargs=database)
+        self.record = record
+        self.source = URL(coalesce(source, "https://hg.mozilla.org"))
+        self.url = URL("http://" + host, port=port)
+        self.stats_locker = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+
+        if not self.db.query("SELECT name FROM sqlite_master WHERE type='table'").data:
+            with self.db.transaction() as t:
+                t.execute(
+                    "CREATE TABLE cache ("
+                    "   path TEXT PRIMARY KEY, "
+                    "   headers TEXT, "
+                    "   response TEXT, "
+                    "   timestamp REAL "
+                    ")"
+                )
+
+        app = Flask(__name__)
+        app.add_url_rule(str("/<path:path>"), None, self._serve, methods=[str("GET")])
+        self.server = make_server(host, port, app, threaded=True)
+        self.thread = Thread.run("hg fixture", self._run)
+
+    def _run(self, please_stop):
+        please_stop.then(self.server.shutdown)
+        self.server.serve_forever()
+
+    def stop(self):
+        self.thread.stop()
+        self.thread.join()
+
+    def stats(self):
+        with self.stats_locker:
+            return {"hits": self.hits, "misses": self.misses, "recorded": self.recorded}
+
+    def _serve(self, path):
+        path = _normalize(path, flask.request.query_string.decode("utf8"))
+        found = self.db.query(
+            "SELECT headers, response FROM cache WHERE path=" + quote_value(path)
+        ).data
+        if found:
+            with self.stats_locker:
+                self.hits += 1
+            headers, response = found[0]
+            return Response(response.encode("latin1"), status=200, headers=json.loads(headers))
+
+        with self.stats_locker:
+            self.misses += 1
+        if not self.record:
+            Log.note("No recording for {{path}}", path=path)
+            return Response(b"not recorded", status=404)
+
+        DEBUG and Log.note("Recording {{path}}", path=path)
+        response = http.get(str(self.source) + "/" + path, stream=True)
+        # KEEP THE RAW (POSSIBLY COMPRESSED) BYTES WITH THE HEADERS THAT DESCRIBE THEM
+        response.headers.pop("transfer-encoding", None)
+        headers = json.dumps(dict(response.headers))
+        content = response.raw.read()
+        if response.status_code == 200:
+            with self.db.transaction() as t:
+                t.execute(
+                    "INSERT OR REPLACE INTO cache (path, headers, response, timestamp) VALUES"
+                    + quote_list((path, headers, content.decode("latin1"), Date.now().unix))
+                )
+            with self.stats_locker:
+                self.recorded += 1
+        return Response(content, status=response.status_code, headers=json.loads(headers))
+
+
+def _normalize(path, query_string):
+    # THE SERVICE BUILDS URLS WITH DOUBLE SLASHES; THE RELAY STORES PATHS WITHOUT LEADING ONES
+    path = "/".join(p for p in path.split("/") if p)
+    if query_string:
+        path += "?" + query_string
+    return path
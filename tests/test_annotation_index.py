@@ -0,0 +1,117 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from jx_elasticsearch.elasticsearch import proto_name
+from mo_dots import Data, wrap
+from mo_times.dates import Date
+
+from tuid.annotation_index import AnnotationIndex
+
+ALIAS = "tuid-annotations"
+
+
+class FakeIndex(object):
+    def __init__(self, cluster, kwargs):
+        self.cluster = cluster
+        self.settings = kwargs
+
+    def is_proto(self, index):
+        return not self.cluster.indices[index]["alias"]
+
+    def add_alias(self, alias):
+        self.cluster.indices[self.settings.index]["alias"] = alias
+
+    def extend(self, records, refresh=None):
+        docs = self.cluster.indices[self.settings.index]["docs"]
+        for r in records:
+            docs[r["value"]["_id"]] = r["value"]
+
+
+class FakeCluster(object):
+    def __init__(self):
+        self.indices = {}
+        self.mget_requests = 0
+
+    def post(self, path, data=None, timeout=None):
+        assert path == "/_mget"
+        self.mget_requests += 1
+        docs = []
+        for d in data["docs"]:
+            index = self.indices.get(d["_index"])
+            if index is None:
+                docs.append({"_id": d["_id"], "error": {"type": "index_not_found_exception"}})
+            elif d["_id"] in index["docs"]:
+                docs.append({"_id": d["_id"], "found": True, "_source": index["docs"][d["_id"]]})
+            else:
+                docs.append({"_id": d["_id"], "found": False})
+        return wrap({"docs": docs})
+
+    def add(self, name, docs):
+        self.indices[name] = {"alias": ALIAS, "docs": {d["_id"]: d for d in docs}}
+
+    def get_aliases(self, after=None):
+        for name, i in self.indices.items():
+            yield Data(index=name, alias=i["alias"])
+
+    def get_index(self, read_only=True, kwargs=None):
+        return FakeIndex(self, kwargs)
+
+    def create_index(self, create_timestamp=None, kwargs=None):
+        name = proto_name(kwargs.index, create_timestamp)
+        self.indices[name] = {"alias": None, "docs": {}}
+        kwargs.index = name
+        return FakeIndex(self, kwargs)
+
+    def delete_index(self, name):
+        del self.indices[name]
+
+
+def test_writes_to_todays_partition():
+    cluster = FakeCluster()
+    index = AnnotationIndex(cluster, kwargs=wrap({"index": ALIAS}))
+    index.extend([{"value": {"_id": "a", "annotation": "[1]"}}])
+
+    today = proto_name(ALIAS, Date.today())
+    assert list(cluster.indices) == [today]
+    assert cluster.indices[today]["alias"] == ALIAS
+    assert index.get_records(["a", "b"])["a"].annotation == "[1]"
+
+
+def test_old_partition_is_read_then_dropped():
+    cluster = FakeCluster()
+    old = ALIAS + "20190101_000000"
+    cluster.add(old, [{"_id": "a", "annotation": "[1]"}, {"_id": "b", "annotation": "[2]"}])
+    index = AnnotationIndex(cluster, kwargs=wrap({"index": ALIAS}))
+    index.extend([{"value": {"_id": "a", "annotation": "[3]"}}])
+
+    # The newest partition wins, and all are read in one request
+    found = index.get_records(["a", "b"])
+    assert found["a"].annotation == "[3]"
+    assert found["b"].annotation == "[2]"
+    assert cluster.mget_requests == 1
+
+    assert index.old_partitions(Date("2019-01-02")) == []
+    dropping = index.old_partitions(Date.now())
+    assert [p.settings.index for p in dropping] == [old]
+    index.drop(dropping[0])
+    assert old not in cluster.indices
+    assert list(index.get_records(["a", "b"])) == ["a"]
+
+
+def test_partition_dropped_by_another_process():
+    cluster = FakeCluster()
+    old = ALIAS + "20190101_000000"
+    cluster.add(old, [{"_id": "b", "annotation": "[2]"}])
+    index = AnnotationIndex(cluster, kwargs=wrap({"index": ALIAS}))
+    index.extend([{"value": {"_id": "a", "annotation": "[3]"}}])
+
+    cluster.delete_index(old)
+    assert list(index.get_records(["a", "b"])) == ["a"]
+    assert index.old_partitions(Date.now()) == []
@@ -0,0 +1,77 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_threads import Signal, Thread, Till
+
+from tuid.annotation_writer import AnnotationWriter
+
+
+class FakeIndex(object):
+    def __init__(self):
+        self.bulks = []
+        self.allowed = Signal()
+        self.allowed.go()
+
+    def extend(self, records, refresh=None):
+        self.allowed.wait()
+        assert not refresh
+        self.bulks.append([r["value"]["_id"] for r in records])
+
+
+def _records(ids):
+    return [{"value": {"_id": i, "annotation": "[" + i + "]"}} for i in ids]
+
+
+def test_reads_before_write():
+    index = FakeIndex()
+    index.allowed = Signal()
+    writer = AnnotationWriter(index, batch_size=10, wait=0.1)
+    writer.add(_records(["a", "b"]))
+    assert writer.get("a").annotation == "[a]"
+    assert writer.get("c") is None
+
+    index.allowed.go()
+    writer.flush()
+    assert writer.get("a") is None
+    assert index.bulks == [["a", "b"]]
+
+
+def test_many_requests_one_bulk():
+    index = FakeIndex()
+    writer = AnnotationWriter(index, batch_size=4, wait=10)
+    writer.add(_records(["a"]))
+    writer.add(_records(["b", "c"]))
+    writer.add(_records(["d", "e"]))
+    writer.flush()
+    assert [i for bulk in index.bulks for i in bulk] == ["a", "b", "c", "d", "e"]
+    assert index.bulks[0] == ["a", "b", "c", "d"]
+
+
+def test_full_queue_blocks():
+    index = FakeIndex()
+    index.allowed = Signal()
+    writer = AnnotationWriter(index, batch_size=2, wait=0.1, max_pending=2)
+    writer.add(_records(["a", "b"]))
+
+    added = Signal()
+
+    def add_more(please_stop):
+        writer.add(_records(["c"]))
+        added.go()
+
+    Thread.run("add more", add_more)
+    (added | Till(seconds=0.5)).wait()
+    assert not added
+
+    index.allowed.go()
+    (added | Till(seconds=10)).wait()
+    assert added
+    writer.flush()
+    assert index.bulks == [["a", "b"], ["c"]]
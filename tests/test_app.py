@@ -53,6 +53,18 @@ def test_empty_query(config, app):
     assert response.content == EXPECTING_QUERY
 
 
+@pytest.mark.first_run
+@pytest.mark.skipif(PY2, reason="interprocess communication problem")
+def test_metrics(config, app):
+    url = "http://localhost:" + text(config.flask.port) + "/metrics"
+    response = http.get(url)
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    content = response.content.decode("utf8")
+    assert "tuid_requests_total " in content
+    assert 'tuid_request_latency_seconds_bucket{le="+Inf"} ' in content
+
+
 @pytest.mark.first_run
 @pytest.mark.skipif(True, reason="can not get this test to work")
 def test_query_too_big(config, app):
@@ -153,6 +165,65 @@ def test_single_file_list(config, app):
     assert len(set(tuids)) == 41  # tuids much be unique
 
 
+@pytest.mark.first_run
+@pytest.mark.skipif(PY2, reason="interprocess communication problem")
+def test_some_lines(config, app):
+    url = "http://localhost:" + text(config.flask.port) + "/tuid"
+    where = [
+        {"eq": {"revision": "29dcc9cb77c372c97681a47496488ec6c623915d"}},
+        {"in": {"path": ["gfx/thebes/gfxFontVariations.h"]}},
+        {"eq": {"branch": "mozilla-central"}},
+    ]
+    whole = http.post_json(url, json={"from": "files", "where": {"and": where}})
+    all_tuids = whole.data[0][1]
+
+    some_lines = {"path": "gfx/thebes/gfxFontVariations.h", "lines": [3, [10, 12], [40, 99]]}
+    response = http.post_json(
+        url,
+        json={
+            "meta": {"format": "list"},
+            "from": "files",
+            "where": {"and": where + [{"eq": {"lines": [some_lines]}}]},
+        },
+    )
+
+    result = response.data[0]
+    assert result.lines == [3, 10, 11, 12, 40, 41]  # 41 lines in the file
+    assert result.tuids == [all_tuids[line - 1] for line in result.lines]
+
+
+@pytest.mark.first_run
+@pytest.mark.skipif(PY2, reason="interprocess communication problem")
+def test_many_revisions(config, app):
+    url = "http://localhost:" + text(config.flask.port) + "/tuid"
+    revisions = ["29dcc9cb77c372c97681a47496488ec6c623915d", "0f4946791ddb"]
+    response = http.post_json(
+        url,
+        json={
+            "from": "files",
+            "where": {
+                "or": [
+                    {
+                        "and": [
+                            {"eq": {"revision": revision}},
+                            {"in": {"path": ["gfx/thebes/gfxFontVariations.h"]}},
+                            {"eq": {"branch": branch}},
+                        ]
+                    }
+                    for revision, branch in zip(revisions, ["mozilla-central", "try"])
+                ]
+            },
+        },
+    )
+
+    assert sorted(g.group for g in response.data) == [0, 1]
+    for g in response.data:
+        assert g.revision == revisions[g.group]
+        assert g.files[0].path == "gfx/thebes/gfxFontVariations.h"
+    first = [g for g in response.data if g.group == 0][0]
+    assert len(first.files[0].tuids) == 41
+
+
 @pytest.mark.first_run
 @pytest.mark.skipif(PY2, reason="interprocess communication problem")
 def test_client(config, app):
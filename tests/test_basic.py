@@ -144,6 +144,17 @@ def test_tryrepo_tuids(service):
     assert found_file
 
 
+def test_branch_check_is_kept(service):
+    test_revision = "0f4946791ddb"
+    with service.conn.transaction() as t:
+        t.execute("DELETE FROM branchRevision")
+
+    assert service._check_branch(test_revision, "try")
+    found = service.conn.get("SELECT revision FROM branchRevision WHERE branch=?", ("try",))
+    assert [r for r, in found] == [test_revision]
+    assert not service._check_branch("000000000000", "try")
+
+
 def test_multithread_tuid_uniqueness(service):
     timeout_seconds = 60
     old_revision = "d63ed14ed622"
@@ -305,6 +316,26 @@ def test_removed_lines(service):
     assert len(new_lines[0][1]) == len(old_lines[0][1]) - 4
 
 
+def test_lines_from_tuids(service):
+    old_rev = "a6fdd6eae583"
+    new_rev = "c8dece9996b7"
+    file = "taskcluster/ci/test/tests.yml"
+    service.clogger.initialize_to_range(old_rev, new_rev)
+    old_lines = service.get_tuids_from_files([file], old_rev)[0][0][1]
+    new_lines = service.get_tuids_from_files([file], new_rev)[0][0][1]
+
+    tuids = [t.tuid for t in old_lines]
+    found, completed = service.get_lines_from_tuids(tuids, new_rev)
+    assert completed
+    assert [tuid for tuid, _, _ in found] == tuids
+    assert all(path == file for _, path, _ in found)
+
+    # THE FOUR REMOVED LINES ARE GONE, THE REST ARE WHERE THE ANNOTATION PUTS THEM
+    expected = {t.tuid: t.line for t in new_lines}
+    assert [line for tuid, _, line in found] == [expected.get(tuid) for tuid in tuids]
+    assert sum(1 for _, _, line in found if line is None) == 4
+
+
 def test_remove_file(service):
     entries = service.get_tuids("/third_party/speedometer/InteractiveRunner.html", "e3f24e165618")
     assert 0 == len(entries[0][1])
@@ -345,6 +376,7 @@ def test_forward_then_backward_diff(service):
 
     for n in range(2):
         filter = {"terms": {"file": file}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
         rev_next = revs_next[n]
@@ -359,6 +391,7 @@ def test_forward_then_backward_diff(service):
                 assert curr[i] == next[i]
 
         filter = {"term": {"revision": rev_curr}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
         curr = service.get_tuids_from_files(file, rev_curr)[0][0][1]
@@ -376,6 +409,7 @@ def test_file_with_line_replacement(service):
     old_rev = "568e1959ca47"
     new_rev = "e3f24e165618"
     filter = {"term": {"file": file[0]}}
+    service.annotation_writer.flush()
     delete(service.annotations, filter)
     service.clogger.initialize_to_range(old_rev, new_rev)
     old = service.get_tuids_from_files(file, old_rev)[0]
@@ -490,6 +524,7 @@ def test_many_files_one_revision(service):
     with service.conn.transaction() as t:
         t.execute("DELETE FROM latestFileMod WHERE file IN " + quote_list(test_file))
         filter = {"terms": {"file": test_file}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
     Log.note("Total files: {{total}}", total=str(len(test_file)))
@@ -526,6 +561,7 @@ def test_one_addition_many_files(service):
     with service.conn.transaction() as t:
         t.execute("DELETE FROM latestFileMod WHERE file IN " + quote_list(test_file))
         filter = {"terms": {"file": test_file}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
     # Get current annotation
@@ -712,6 +748,7 @@ def test_one_http_call_required(service):
         temp = [i.lstrip("/") for i in proc_files]
         t.execute("DELETE FROM latestFileMod WHERE file IN " + quote_list(temp))
         filter = {"terms": {"file": temp}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
     Log.note("Number of files to process: {{flen}}", flen=len(files))
@@ -786,6 +823,7 @@ def test_out_of_order_get_tuids_from_files(service):
     with service.conn.transaction() as t:
         t.execute("DELETE FROM latestFileMod WHERE file=" + quote_value(test_file[0]))
         filter = {"term": {"file": test_file[0]}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
     check_lines = [41]
@@ -825,6 +863,7 @@ def test_out_of_order_going_forward_get_tuids_from_files(service):
     with service.conn.transaction() as t:
         t.execute("DELETE FROM latestFileMod WHERE file=" + quote_value(test_file[0]))
         filter = {"term": {"file": test_file[0]}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
     check_lines = [41]
@@ -923,6 +962,7 @@ def test_merged_changes(service):
     with service.conn.transaction() as t:
         t.execute("DELETE FROM latestFileMod WHERE file=" + quote_value(test_files[0]))
         filter = {"term": {"file": test_files[0]}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
     old_tuids, _ = service.get_tuids_from_files(test_files, old_rev, use_thread=False)
@@ -966,6 +1006,7 @@ def test_very_distant_files(service):
 
     with service.conn.transaction() as t:
         filter = {"term": {"revision": new_rev}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
         for file in test_files:
             t.execute(
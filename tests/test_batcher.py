@@ -0,0 +1,75 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_threads import Thread
+
+from tuid.batcher import Batcher
+from tuid.util import TuidMap
+
+
+class FakeService(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_tuids_from_files(self, files, revision, going_forward=False, repo=None):
+        self.calls.append((sorted(files), revision, repo))
+        return [(f, [TuidMap(revision + ":" + f, 1)]) for f in files], True
+
+
+def _request(batcher, files, revision, results):
+    def request(please_stop):
+        results.append(batcher.get_tuids_from_files(files, revision, repo="mozilla-central"))
+
+    return Thread.run("request", request)
+
+
+def test_same_revision_is_one_call():
+    service = FakeService()
+    batcher = Batcher(service, window=0.5)
+    first, second = [], []
+    threads = [
+        _request(batcher, ["/a.js", "b.js"], "r1", first),
+        _request(batcher, ["c.js", "a.js"], "r1", second),
+    ]
+    for t in threads:
+        t.join()
+
+    assert service.calls == [(["a.js", "b.js", "c.js"], "r1", "mozilla-central")]
+    assert batcher.merged == 1
+    # EACH REQUEST GETS ONLY ITS OWN FILES, IN ITS OWN ORDER
+    assert [f for f, _ in first[0][0]] == ["a.js", "b.js"]
+    assert [f for f, _ in second[0][0]] == ["c.js", "a.js"]
+    assert second[0][0][1][1][0].tuid == "r1:a.js"
+
+
+def test_other_revision_is_another_call():
+    service = FakeService()
+    batcher = Batcher(service, window=0.5)
+    results = []
+    threads = [
+        _request(batcher, ["a.js"], "r1", results),
+        _request(batcher, ["a.js"], "r2", results),
+    ]
+    for t in threads:
+        t.join()
+
+    assert sorted(service.calls) == [
+        (["a.js"], "r1", "mozilla-central"),
+        (["a.js"], "r2", "mozilla-central"),
+    ]
+    assert batcher.merged == 0
+
+
+def test_no_window():
+    service = FakeService()
+    batcher = Batcher(service, window=0)
+    result, completed = batcher.get_tuids_from_files(["/a.js"], "r1")
+    assert completed
+    assert service.calls == [(["/a.js"], "r1", None)]
@@ -47,6 +47,7 @@ def test_caching_daemon(service):
     with service.conn.transaction() as t:
         t.execute("DELETE FROM latestFileMod")
     filter = {"terms": {"file": test_file}}
+    service.annotation_writer.flush()
     delete(service.annotations, filter)
 
     service.clogger.initialize_to_range(initial_revision, final_revision)
@@ -87,6 +88,7 @@ def test_caching(service):
     with service.conn.transaction() as t:
         t.execute("DELETE FROM latestFileMod")
         filter = {"terms": {"file": test_file}}
+        service.annotation_writer.flush()
         delete(service.annotations, filter)
 
     initial_tuids = service.get_tuids_from_files(test_file, initial_revision)[0][0][1]
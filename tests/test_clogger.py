@@ -57,17 +57,17 @@ def test_tipfilling(clogger):
         "sort": [{"revnum": {"order": "desc"}}],
         "size": 1,
     }
-    result = clogger.csetlog.search(query)
+    result = clogger.csetlog.index.search(query)
     current_tip = result.hits.hits[0]._source.revision
 
     filter = {"match_all": {}}
-    delete(clogger.csetlog, filter)
+    delete(clogger.csetlog.index, filter)
 
     clogger.disable_tipfilling = False
 
     new_tip = None
     while num_trys > 0:
-        result = clogger.csetlog.search(query)
+        result = clogger.csetlog.index.search(query)
         new_tip = (result.hits.hits[0]._source.revnum, result.hits.hits[0]._source.revision)
         if new_tip:
             if current_tip == new_tip[1]:
@@ -94,7 +94,7 @@ def test_backfilling_to_revision(clogger):
         "sort": [{"revnum": {"order": "asc"}}],
         "size": 1,
     }
-    result = clogger.csetlog.search(query)
+    result = clogger.csetlog.index.search(query)
     oldest_revnum = result.hits.hits[0]._source.revnum
     oldest_rev = result.hits.hits[0]._source.revision
 
@@ -115,7 +115,7 @@ def test_backfilling_to_revision(clogger):
             "sort": [{"revnum": {"order": "asc"}}],
             "size": 1,
         }
-        result = clogger.csetlog.search(query)
+        result = clogger.csetlog.index.search(query)
         new_ending = result.hits.hits[0]._source.revision
         DEBUG and Log.note("{{data}}", data=(oldest_rev, new_old_rev, new_ending))
         if new_ending == new_old_rev:
@@ -133,7 +133,7 @@ def test_backfilling_to_revision(clogger):
         "query": {"bool": {"must": [{"term": {"revision": oldest_rev}}]}},
         "size": 1,
     }
-    result = clogger.csetlog.search(query)
+    result = clogger.csetlog.index.search(query)
     old_oldest_revnum = result.hits.hits[0]._source.revnum
     assert expected_old_revnum == old_oldest_revnum
 
@@ -144,7 +144,7 @@ def test_backfilling_to_revision(clogger):
         "query": {"bool": {"must": [{"term": {"revision": new_ending}}]}},
         "size": 1,
     }
-    result = clogger.csetlog.search(query)
+    result = clogger.csetlog.index.search(query)
     new_oldest_revnum = result.hits.hits[0]._source.revnum
 
     assert expected_new_revnum == new_oldest_revnum
@@ -164,7 +164,7 @@ def test_backfilling_by_count(clogger):
         "sort": [{"revnum": {"order": "asc"}}],
         "size": 1,
     }
-    result = clogger.csetlog.search(query)
+    result = clogger.csetlog.index.search(query)
     oldest_revnum = result.hits.hits[0]._source.revnum
     oldest_rev = result.hits.hits[0]._source.revision
 
@@ -187,7 +187,7 @@ def test_backfilling_by_count(clogger):
             "sort": [{"revnum": {"order": "asc"}}],
             "size": 1,
         }
-        result = clogger.csetlog.search(query)
+        result = clogger.csetlog.index.search(query)
         new_ending = result.hits.hits[0]._source.revision
         DEBUG and Log.note("{{data}}", data=(oldest_rev, new_old_rev, new_ending))
         if new_ending == new_old_rev:
@@ -196,7 +196,7 @@ def test_backfilling_by_count(clogger):
                 "query": {"bool": {"must": [{"term": {"revision": new_ending}}]}},
                 "size": 1,
             }
-            result = clogger.csetlog.search(query)
+            result = clogger.csetlog.index.search(query)
             new_oldest_revnum = result.hits.hits[0]._source.revnum
 
             query = {
@@ -204,7 +204,7 @@ def test_backfilling_by_count(clogger):
                 "query": {"bool": {"must": [{"term": {"revision": oldest_rev}}]}},
                 "size": 1,
             }
-            result = clogger.csetlog.search(query)
+            result = clogger.csetlog.index.search(query)
             old_oldest_revnum = result.hits.hits[0]._source.revnum
             break
 
@@ -231,18 +231,18 @@ def test_partial_tipfilling(clogger):
     num_trys = 50
     wait_time = 2
     query = {"aggs": {"output": {"value_count": {"field": "revnum"}}}, "size": 0}
-    prev_total_revs = int(clogger.csetlog.search(query).aggregations.output.value)
+    prev_total_revs = int(clogger.csetlog.index.search(query).aggregations.output.value)
 
     max_tip_num, _ = clogger.get_tip()
     filter = {"bool": {"must": [{"range": {"revnum": {"gte": max_tip_num - 5}}}]}}
-    delete(clogger.csetlog, filter)
+    delete(clogger.csetlog.index, filter)
 
     clogger.disable_tipfilling = False
     tmp_num_trys = 0
     while tmp_num_trys < num_trys:
         Till(seconds=wait_time).wait()
         query = {"aggs": {"output": {"value_count": {"field": "revnum"}}}, "size": 0}
-        revnums_in_db = int(clogger.csetlog.search(query).aggregations.output.value)
+        revnums_in_db = int(clogger.csetlog.index.search(query).aggregations.output.value)
         if revnums_in_db == prev_total_revs:
             break
         tmp_num_trys += 1
@@ -291,7 +291,7 @@ def test_get_revnum_range_tipfill(clogger):
     tip_num, tip_rev = clogger.get_tip()
     tail_num, _ = clogger.get_tail()
     filter = {"bool": {"must": [{"range": {"revnum": {"gte": tip_num - 5}}}]}}
-    delete(clogger.csetlog, filter)
+    delete(clogger.csetlog.index, filter)
 
     _, new_tip_rev = clogger.get_tip()
 
@@ -317,7 +317,7 @@ def test_get_revnum_range_tipnback(clogger):
     for ordering in range(2):
         # Used for testing output
         query = {"aggs": {"output": {"value_count": {"field": "revnum"}}}, "size": 0}
-        prev_total_revs = int(clogger.csetlog.search(query).aggregations.output.value)
+        prev_total_revs = int(clogger.csetlog.index.search(query).aggregations.output.value)
         expected_total_revs = prev_total_revs + 10
 
         # Get the current tail, go 10 changesets back and request
@@ -328,7 +328,7 @@ def test_get_revnum_range_tipnback(clogger):
         # to a non-existent (backfill required) revision in the past.
         tip_num, tip_rev = clogger.get_tip()
         filter = {"bool": {"must": [{"range": {"revnum": {"gte": tip_num - 5}}}]}}
-        delete(clogger.csetlog, filter)
+        delete(clogger.csetlog.index, filter)
 
         _, new_tip_rev = clogger.get_tip()
 
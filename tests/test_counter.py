@@ -0,0 +1,53 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from time import time
+
+from mo_threads import Thread, Till
+
+from tuid.counter import Counter
+
+
+def test_waiter_wakes_on_change():
+    counter = Counter()
+    counter.add(3)
+
+    def finish(please_stop):
+        Till(seconds=0.2).wait()
+        counter.add(-3)
+
+    start = time()
+    Thread.run("finish", finish)
+    assert counter.wait_for(lambda v: v == 0, till=Till(seconds=10))
+    # WOKEN BY THE CHANGE, NOT BY A POLLING INTERVAL
+    assert time() - start < 1
+
+
+def test_acquire_limit():
+    counter = Counter()
+    assert counter.acquire(1)
+    assert not counter.acquire(1, till=Till(seconds=0.1))
+    assert counter.value == 1
+
+    def release(please_stop):
+        Till(seconds=0.2).wait()
+        counter.add(-1)
+
+    Thread.run("release", release)
+    assert counter.acquire(1, till=Till(seconds=10))
+    assert counter.value == 1
+
+
+def test_with_clause_wakes():
+    counter = Counter()
+    with counter(2):
+        assert counter.value == 2
+        assert not counter.wait_for(lambda v: v == 0, till=Till(seconds=0.1))
+    assert counter.wait_for(lambda v: v == 0)
@@ -0,0 +1,59 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from tuid import sql
+from tuid.clogger import MAXIMUM_NONPERMANENT_CSETS, TIME_TO_KEEP_ANNOTATIONS, _num_to_delete
+from tuid.csetlog import SqliteCsetLog
+
+
+def test_sqlite_csetlog():
+    csetlog = SqliteCsetLog(sql.Sql(None))
+    assert csetlog.count() == 0
+    assert csetlog.get_revnum_stats("max") == 0
+    assert csetlog.get_tip() == (None, None)
+
+    csetlog.add([(1, "aaaaaaaaaaaa", 100), (2, "bbbbbbbbbbbb", 200), (3, "cccccccccccc", -1)])
+    csetlog.add([(4, "dddddddddddd", -1)])
+    assert csetlog.count() == 4
+    assert csetlog.get_revnum_stats("min") == 1
+    assert csetlog.get_tip() == (4, "dddddddddddd")
+    assert csetlog.get_tail() == (1, "aaaaaaaaaaaa")
+    assert csetlog.get_revnums(["bbbbbbbbbbbb", "eeeeeeeeeeee"]) == {"bbbbbbbbbbbb": 2}
+    assert csetlog.has_revnum(3) and not csetlog.has_revnum(5)
+    assert sorted(csetlog.get_range(2, 3)) == [(2, "bbbbbbbbbbbb"), (3, "cccccccccccc")]
+    assert csetlog.min_permanent_revnum() == 3
+    assert csetlog.get_timestamps(below=3) == [(1, 100), (2, 200)]
+
+    csetlog.delete_to(2)
+    assert csetlog.get_tail() == (3, "cccccccccccc")
+    csetlog.delete_all()
+    assert csetlog.count() == 0
+    assert csetlog.min_permanent_revnum() is None
+
+
+def test_recent_backfill_under_older_rows():
+    now = 1000000000
+    old = now - TIME_TO_KEEP_ANNOTATIONS.seconds - 1
+    csetlog = SqliteCsetLog(sql.Sql(None))
+    # Backfilled long ago, below the permanent rows
+    csetlog.add([(revnum, "%012d" % revnum, old) for revnum in range(100, 110)])
+    csetlog.add([(110, "%012d" % 110, -1)])
+    # ...then a request backfilled further down
+    csetlog.add([(revnum, "%012d" % revnum, now) for revnum in range(90, 100)])
+
+    tail = [timestamp for _, timestamp in csetlog.get_timestamps(below=110)]
+    # The recent rows are kept, and the old ones above them too, so there is no gap
+    assert _num_to_delete(tail, now) == 0
+    # Once the recent rows are old, all go
+    assert _num_to_delete(tail, now + TIME_TO_KEEP_ANNOTATIONS.seconds + 1) == 20
+    # Beyond the maximum, only the rows that are not recent are cut
+    many = [now - 7200] * MAXIMUM_NONPERMANENT_CSETS + [now] * 10
+    assert _num_to_delete([now] * 10 + many, now) == 0
+    assert _num_to_delete(many, now) == 10
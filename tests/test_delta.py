@@ -0,0 +1,28 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from tuid.util import COPY, NEW, decode_delta, encode_delta
+
+
+def test_delta_of_an_edit():
+    base = list(range(1, 10001))
+    # LINES 51-60 REPLACED BY TWO NEW LINES, AND ONE LINE ADDED AT THE END
+    tuids = base[:50] + [20001, 20002] + base[60:] + [20003]
+    delta = encode_delta(base, tuids)
+    assert delta == [COPY, 0, 50, NEW, 20001, 2, COPY, 60, 9940, NEW, 20003, 1]
+    assert decode_delta(base, delta) == tuids
+
+
+def test_delta_with_missing_lines():
+    base = [-1, 5, 6, -1, 7]
+    tuids = [-1, -1, 6, 7, 8, 9, -1]
+    assert decode_delta(base, encode_delta(base, tuids)) == tuids
+    assert decode_delta(base, encode_delta(base, [])) == []
+    assert decode_delta([], encode_delta([], tuids)) == tuids
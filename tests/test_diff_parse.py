@@ -0,0 +1,94 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import wrap
+from mo_hg.parse import (
+    Moves,
+    as_moves,
+    diff_to_moves,
+    stream_lines,
+    stream_moves,
+    stream_to_moves,
+)
+from mo_json import json2value, value2json
+
+RAW_DIFF = (
+    "# HG changeset patch\n"
+    "# User test\n"
+    "change two files\n"
+    "\n"
+    "diff --git a/dom/base/one.cpp b/dom/base/one.cpp\n"
+    "--- a/dom/base/one.cpp\n"
+    "+++ b/dom/base/one.cpp\n"
+    "@@ -1,4 +1,4 @@\n"
+    " first\n"
+    "--- a removed line that looks like a header\n"
+    "+added\n"
+    " third\n"
+    " fourth\n"
+    "@@ -10,2 +10,3 @@\n"
+    " tenth\n"
+    "+eleventh\n"
+    " twelfth\n"
+    "\\ No newline at end of file\n"
+    "diff --git a/old/two.js b/new/two.js\n"
+    "rename from old/two.js\n"
+    "rename to new/two.js\n"
+    "--- a/old/two.js\n"
+    "+++ b/new/two.js\n"
+    "@@ -1,1 +0,0 @@\n"
+    "-gone\n"
+)
+
+
+def _simple(moves):
+    return [(f.old.name, f.new.name, [(c.line, c.action) for c in f.changes]) for f in moves]
+
+
+def test_diff_to_moves():
+    assert _simple(diff_to_moves(RAW_DIFF)) == [
+        ("/dom/base/one.cpp", "/dom/base/one.cpp", [(1, "-"), (1, "+"), (10, "+")]),
+        ("/old/two.js", "/new/two.js", [(0, "-")]),
+    ]
+
+
+def test_stream_in_small_chunks():
+    raw = RAW_DIFF.encode("utf8")
+    chunks = (raw[i : i + 5] for i in range(0, len(raw), 5))
+    assert _simple(stream_to_moves(stream_lines(chunks))) == _simple(diff_to_moves(RAW_DIFF))
+
+
+def test_skip_unwanted_files():
+    wanted = {"new/two.js"}
+    found = list(stream_moves(RAW_DIFF.encode("utf8").split(b"\n"), wanted))
+    assert [(old, new, list(lines)) for old, new, lines, _ in found] == [
+        ("/old/two.js", "/new/two.js", [0])
+    ]
+    # THE RENAME ADDS THE OLD NAME, SO EARLIER CHANGES TO IT ARE WANTED TOO
+    assert wanted == {"old/two.js", "new/two.js"}
+
+
+def test_compact_moves():
+    changes = diff_to_moves(RAW_DIFF)[0].changes
+    assert isinstance(changes, Moves)
+    assert list(changes.pairs()) == [(1, "-"), (1, "+"), (10, "+")]
+    assert list(changes.inverted().pairs()) == [(10, "-"), (1, "-"), (1, "+")]
+    assert changes[-1].line == 10 and changes[-1]["action"] == "+"
+    assert value2json(changes) == value2json(
+        [
+            {"line": 1, "action": "-"},
+            {"line": 1, "action": "+"},
+            {"line": 10, "action": "+"},
+        ]
+    )
+
+    # MOVES READ BACK FROM THE ES CACHE ARE PLAIN JSON
+    from_cache = wrap(json2value(value2json(changes)))
+    assert list(as_moves(from_cache).pairs()) == list(changes.pairs())
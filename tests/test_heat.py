@@ -0,0 +1,41 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from tuid.heat import FileHeat
+
+
+def test_heat_decays():
+    heat = FileHeat(half_life=10)
+    heat.add(["/dom/a.cpp", "dom/a.cpp"], now=100)
+    assert heat.get("dom/a.cpp", now=100) == 2
+    assert heat.get("/dom/a.cpp", now=110) == 1
+    assert heat.get("never/asked.cpp", now=110) == 0
+
+
+def test_hottest_first():
+    heat = FileHeat(half_life=10)
+    heat.add(["old.cpp", "old.cpp", "old.cpp"], now=0)
+    heat.add(["new.cpp", "new.cpp"], now=100)
+    heat.add(["once.cpp"], now=100)
+
+    files = ["cold.cpp", "once.cpp", "old.cpp", "new.cpp"]
+    assert heat.hottest(files, now=100) == ["new.cpp", "once.cpp"]
+    assert heat.hottest(files, min_heat=1.5, now=100) == ["new.cpp"]
+    assert heat.hottest(files, limit=1, now=100) == ["new.cpp"]
+    # old.cpp WENT COLD, SO IT WAS FORGOTTEN
+    assert len(heat) == 2
+
+
+def test_heat_survives_restart():
+    heat = FileHeat(half_life=10)
+    heat.add(["dom/a.cpp", "dom/a.cpp"], now=100)
+    restarted = FileHeat(half_life=10)
+    restarted.restore(heat.snapshot())
+    assert restarted.get("dom/a.cpp", now=110) == 1
@@ -0,0 +1,59 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import subprocess
+from distutils.spawn import find_executable
+
+import pytest
+
+from tuid.hg_local import LocalHg
+
+HG = find_executable("hg")
+
+
+@pytest.fixture
+def local_hg(tmpdir):
+    repo = str(tmpdir)
+
+    def commit(content, message):
+        with open(tmpdir.join("file.txt").strpath, "w") as f:
+            f.write(content)
+        subprocess.check_call([HG, "commit", "-q", "-A", "-u", "test", "-m", message], cwd=repo)
+
+    subprocess.check_call([HG, "init", repo])
+    commit("a\nb\nc\n", "first")
+    commit("a\nB\nc\nd\n", "second")
+
+    hg = LocalHg(local_hg_source=repo, hg_for_building=HG)
+    yield hg
+    hg.stop()
+
+
+@pytest.mark.skipif(not HG, reason="needs Mercurial")
+def test_local_clog(local_hg):
+    clog = local_hg.get_clog("tip")
+    assert [c.desc for c in clog.changesets] == ["second", "first"]
+    assert clog.changesets[0].parents == [clog.changesets[1].node]
+    assert local_hg.has_revision(clog.changesets[1].node[:12])
+    assert not local_hg.has_revision("deadbeef0000")
+
+
+@pytest.mark.skipif(not HG, reason="needs Mercurial")
+def test_local_diff_and_files(local_hg):
+    moves, description = local_hg.get_diff("tip")
+    assert description == "second"
+    assert len(moves) == 1
+    assert moves[0].new.name == "/file.txt"
+    assert [(c.line, c.action) for c in moves[0].changes] == [(1, "-"), (1, "+"), (3, "+")]
+
+    assert local_hg.get_files("tip") == ["file.txt"]
+    assert local_hg.get_line_count("tip", "file.txt") == 4
+    assert local_hg.get_line_count("0", "file.txt") == 3
+    assert local_hg.get_line_count("tip", "missing.txt") is None
@@ -0,0 +1,137 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import tempfile
+from functools import partial
+
+from mo_dots import Null, wrap
+from mo_json import value2json
+from mo_threads import Lock, Signal, Thread, Till
+
+import tuid.clogger
+import tuid.pushes
+from tuid.clogger import Clogger
+from tuid.pushes import PushListener
+
+
+class FakeClogger(object):
+    def __init__(self):
+        self.config = wrap({"hg": {"branch": "mozilla-central"}})
+        self.tuid_service = wrap({"hg_cache": Null, "local_hg": Null})
+        self.tip_signal = Signal()
+        self.known = {"aaaaaaaaaaaa": 1}
+
+    def get_tip(self):
+        return 1, "aaaaaaaaaaaa"
+
+    def get_revnums(self, revisions):
+        return {r: self.known[r] for r in revisions if r in self.known}
+
+    def _backfill_signal(self, revision):
+        signal = Signal()
+        signal.go()
+        return signal
+
+    def _backfill_forget(self, revision, signal):
+        pass
+
+
+def _push(repo, *heads):
+    return {
+        "payload": {
+            "type": "changegroup.1",
+            "data": {"repo_url": "https://hg.mozilla.org/" + repo, "heads": list(heads)},
+        }
+    }
+
+
+def test_push_wakes_tip_update():
+    clogger = FakeClogger()
+    listener = PushListener(clogger)
+    listener.add(_push("integration/autoland", "b" * 40))
+    listener.add(_push("mozilla-central", "a" * 40))
+    (clogger.tip_signal | Till(seconds=1)).wait()
+    # Nothing new on the main branch
+    assert not clogger.tip_signal
+
+    listener.add(_push("mozilla-central", "c" * 40))
+    (clogger.tip_signal | Till(seconds=5)).wait()
+    assert clogger.tip_signal
+    assert listener.received == 2
+    listener.thread.stop()
+
+
+def test_pushes_from_file():
+    clogger = FakeClogger()
+    filename = os.path.join(tempfile.mkdtemp(), "pushes.json")
+    with open(filename, "w") as f:
+        # Already there at the start, so skipped
+        f.write(value2json(_push("mozilla-central", "d" * 40)) + "\n")
+    listener = PushListener(clogger, file=filename)
+    (clogger.tip_signal | Till(seconds=1.5)).wait()
+    assert not clogger.tip_signal
+
+    with open(filename, "a") as f:
+        f.write(value2json(_push("mozilla-central", "c" * 40)) + "\n")
+    (clogger.tip_signal | Till(seconds=5)).wait()
+    assert clogger.tip_signal
+    assert listener.received == 1
+    listener.file_thread.stop()
+    listener.thread.stop()
+
+
+def test_unreached_head_is_forgotten():
+    clogger = FakeClogger()
+    # A real csetLog waiter map, whose tip update never brings the head
+    clogger.backfill_locker = Lock()
+    clogger.backfill_waiters = {}
+    clogger._backfill_signal = partial(Clogger._backfill_signal, clogger)
+    clogger._backfill_forget = partial(Clogger._backfill_forget, clogger)
+
+    old_timeout, tuid.pushes.PUSH_TIP_TIMEOUT = tuid.pushes.PUSH_TIP_TIMEOUT, 0.5
+    try:
+        listener = PushListener(clogger)
+        listener.add(_push("mozilla-central", "e" * 40))
+        (clogger.tip_signal | Till(seconds=5)).wait()
+        Till(seconds=2).wait()
+        assert clogger.backfill_waiters == {}
+        listener.thread.stop()
+    finally:
+        tuid.pushes.PUSH_TIP_TIMEOUT = old_timeout
+
+
+def test_push_during_tip_update():
+    clogger = FakeClogger()
+    clogger.disable_tipfilling = False
+    updates = []
+
+    def update_tip():
+        updates.append(len(updates))
+        if len(updates) == 1:
+            # A push lands while the first update runs
+            clogger.tip_signal.go()
+        return False
+
+    clogger.update_tip = update_tip
+
+    def fill_forward(please_stop):
+        Clogger.fill_forward_continuous(clogger, please_stop=please_stop)
+
+    old_wait, tuid.clogger.CSET_TIP_WAIT_TIME = tuid.clogger.CSET_TIP_WAIT_TIME, 60
+    thread = Thread.run("fill forward", fill_forward)
+    try:
+        Till(seconds=2).wait()
+        # The push started another pass, without waiting for the poll
+        assert len(updates) == 2
+    finally:
+        thread.stop()
+        thread.join()
+        tuid.clogger.CSET_TIP_WAIT_TIME = old_wait
@@ -0,0 +1,125 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import wrap
+
+from tuid import sql
+from tuid.heat import FileHeat
+from tuid.router import Router
+from tuid.util import TuidMap
+from tuid.workers import Workers, owner
+
+
+class FakeService(object):
+    def __init__(self, workers):
+        self.workers = workers
+        self.heat = FileHeat()
+
+    def get_tuids_from_files(self, files, revision, repo=None):
+        return [(f, [TuidMap(7, 1), TuidMap(8, 2)]) for f in files], True
+
+
+class FakePeerRouter(Router):
+    # Answers for the other worker, as its /tuid endpoint would
+    def _post(self, process_num, table, where):
+        paths = where["and"][2]["in"]["path"]
+        return wrap([{"path": p, "tuids": [1, None, 3]} for p in paths]), False
+
+
+def test_owner_is_stable():
+    assert owner("/dom/base/nsDocument.cpp", 4) == owner("dom/base/nsDocument.cpp", 4)
+    owners = set(owner("file" + str(i) + ".js", 4) for i in range(100))
+    assert owners == {0, 1, 2, 3}
+
+
+def test_tuid_blocks(tmp_path):
+    workers = Workers(
+        count=2, coordinator=str(tmp_path / "coordinator.db"), process_num=0, block_size=100
+    )
+    workers.start_tuids(500)
+    assert workers.next_block(1) == (500, 600)
+    assert workers.next_block(900) == (900, 1000)
+    assert workers.next_block(1) == (1000, 1100)
+    assert workers.tuid_owner(42) == 0
+    assert workers.local_name("resources/tuid_app.db") == "resources/tuid_app.db"
+
+    assert not workers.has_carried("tuid-annotations20201019_000000")
+    assert not workers.carried("tuid-annotations20201019_000000")
+    assert workers.has_carried("tuid-annotations20201019_000000")
+
+
+def test_files_are_routed(tmp_path):
+    workers = Workers(count=2, coordinator=str(tmp_path / "coordinator.db"), process_num=1)
+    assert workers.local_name("resources/tuid_app.db") == "resources/tuid_app-1.db"
+    assert workers.peer_url(0) == "http://localhost:5000/tuid"
+
+    service = FakeService(workers)
+    router = FakePeerRouter(service, service)
+    files = ["file" + str(i) + ".js" for i in range(10)]
+    result, completed = router.get_tuids_from_files(files, "r1")
+
+    assert not completed
+    assert [f for f, _ in result] == files
+    for f, tuids in result:
+        if workers.owns(f):
+            assert tuids == [TuidMap(7, 1), TuidMap(8, 2)]
+        else:
+            assert tuids == [TuidMap(1, 1), TuidMap(3, 3)]
+    assert router.forwarded == 1
+
+
+def _frontiers(name, files=()):
+    conn = sql.Sql(name)
+    with conn.transaction() as t:
+        t.execute(
+            "CREATE TABLE IF NOT EXISTS latestFileMod (file TEXT, revision CHAR(12) NOT NULL, PRIMARY KEY(file));"
+        )
+        for file in files:
+            t.execute(
+                "INSERT INTO latestFileMod (file, revision) VALUES (?, ?)", (file, "r" + file)
+            )
+    return conn
+
+
+def test_frontiers_move_to_owner(tmp_path):
+    # A single-process deployment, with the frontiers and tuids of all files
+    name = str(tmp_path / "tuid_app.db")
+    files = ["file" + str(i) + ".js" for i in range(20)]
+    conn0 = _frontiers(name, files)
+
+    # ...is restarted as two workers
+    coordinator = str(tmp_path / "coordinator.db")
+    worker0 = Workers(count=2, coordinator=coordinator, process_num=0, block_size=100)
+    worker1 = Workers(count=2, coordinator=coordinator, process_num=1, block_size=100)
+    conn1 = _frontiers(worker1.local_name(name))
+    worker0.take_frontiers(conn0, name)
+    worker1.take_frontiers(conn1, name)
+
+    # Each file keeps its frontier, so its annotation, so its tuids
+    mine = [f for f in files if worker1.owns(f)]
+    assert mine and len(mine) < len(files)
+    assert sorted(
+        tuple(r) for r in conn1.get("SELECT file, revision FROM latestFileMod")
+    ) == sorted((f, "r" + f) for f in mine)
+    assert sorted(
+        tuple(r) for r in conn0.get("SELECT file, revision FROM latestFileMod")
+    ) == sorted((f, "r" + f) for f in files if f not in mine)
+
+    # New tuids come after the ones made before there were workers
+    worker0.start_tuids(500)
+    assert worker1.next_block(1) == (500, 600)
+    assert worker1.tuid_owner(42) == 0
+    assert worker1.tuid_owner(550) == 1
+
+    # Going back to one process, worker 0 takes them back
+    single = Workers(count=1, coordinator=coordinator, process_num=0)
+    single.take_frontiers(conn0, name)
+    assert len(conn0.get("SELECT file FROM latestFileMod")) == len(files)
+    assert not conn1.get("SELECT file FROM latestFileMod")
@@ -0,0 +1,81 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import gc
+import os
+import random
+from time import time
+
+import psutil
+
+from mo_logs import Log
+from mo_threads import Till, stop_main_thread
+
+# How the Till daemon behaves with many pending timers:
+#     python tests/till_benchmark.py
+# Creates PENDING timers that will not fire during the run, then measures
+# the cost of adding them, the daemon CPU while idle, how late short timers
+# fire, and what happens when most of the pending timers are dropped.
+
+PENDING = 100000
+SHORT_TIMERS = 50
+SHORT_WAIT = 0.05  # seconds
+IDLE_TIME = 3  # seconds
+
+
+def cpu_seconds():
+    times = psutil.Process(os.getpid()).cpu_times()
+    return times.user + times.system
+
+
+def measure_lateness():
+    lateness = []
+    for _ in range(SHORT_TIMERS):
+        start = time()
+        Till(seconds=SHORT_WAIT).wait()
+        lateness.append(time() - start - SHORT_WAIT)
+    lateness.sort()
+    return {
+        "median_ms": round(1000 * lateness[len(lateness) // 2], 1),
+        "max_ms": round(1000 * lateness[-1], 1),
+    }
+
+
+def main():
+    Log.start()
+    result = {"pending": PENDING}
+
+    start = time()
+    pending = [Till(seconds=random.uniform(60, 600)) for _ in range(PENDING)]
+    result["create_seconds"] = round(time() - start, 3)
+
+    # LET THE DAEMON TAKE THE NEW TIMERS, THEN MEASURE IT IDLE
+    Till(seconds=1).wait()
+    start_cpu = cpu_seconds()
+    Till(seconds=IDLE_TIME).wait()
+    result["idle_cpu_percent"] = round(100 * (cpu_seconds() - start_cpu) / IDLE_TIME, 1)
+
+    result["lateness"] = measure_lateness()
+
+    # DROP MOST TIMERS; THEIR ENTRIES ARE NOW DEAD WEAK REFERENCES
+    del pending[: PENDING * 9 // 10]
+    gc.collect()
+    Till(seconds=1).wait()
+    start_cpu = cpu_seconds()
+    Till(seconds=IDLE_TIME).wait()
+    result["idle_cpu_percent_after_drop"] = round(100 * (cpu_seconds() - start_cpu) / IDLE_TIME, 1)
+    result["lateness_after_drop"] = measure_lateness()
+
+    Log.note("Till benchmark:\n{{result|json}}", result=result)
+    stop_main_thread()
+
+
+if __name__ == "__main__":
+    main()
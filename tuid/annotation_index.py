@@ -0,0 +1,180 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import re
+
+from jx_elasticsearch.elasticsearch import INDEX_DATE_FORMAT, SUFFIX_PATTERN
+from mo_dots import coalesce, wrap
+from mo_logs import Log
+from mo_threads import Lock
+from mo_times.dates import Date, unicode2Date
+from mo_times.durations import DAY
+
+ROLLOVER_INTERVAL = DAY  # annotations written in the same interval share a partition
+
+
+class AnnotationIndex(object):
+    """
+    The annotations, split into partitions by the time they were written.
+    Each partition is an index named <index>YYYYMMDD_HHMMSS, after the start
+    of its interval, and all of them carry the <index> alias. New annotations
+    go to the newest partition, so lookups of recent revisions hit a small
+    index, and old annotations are dropped a whole partition at a time.
+
+    Offers the parts of jx_elasticsearch.elasticsearch.Index the service uses.
+    """
+
+    def __init__(self, cluster, interval=ROLLOVER_INTERVAL, kwargs=None):
+        self.cluster = cluster
+        self.interval = interval
+        self.settings = kwargs.copy()
+        self.alias = self.settings.index
+        self.pattern = re.escape(self.alias) + "(" + SUFFIX_PATTERN + ")$"
+        self.locker = Lock()
+        self.partitions = []  # (start, index), oldest first
+        self._load()
+
+    def _load(self):
+        names = set(
+            a.index
+            for a in self.cluster.get_aliases(after=Date.now())
+            if re.match(self.pattern, a.index)
+        )
+        partitions = []
+        for name in sorted(names):
+            settings = self.settings.copy()
+            settings.index = name
+            settings.alias = self.alias
+            index = self.cluster.get_index(read_only=False, kwargs=settings)
+            if index.is_proto(name):
+                # Created, but the alias was never added
+                index.add_alias(self.alias)
+            start = unicode2Date(re.match(self.pattern, name).group(1), format=INDEX_DATE_FORMAT)
+            partitions.append((start, index))
+        self.partitions = partitions
+
+    def reload(self):
+        """
+        Forget the partitions dropped by another process
+        """
+        with self.locker:
+            self._load()
+
+    def _current(self):
+        """
+        :return: the partition new annotations are written to, made if the
+                 newest one is from an earlier interval
+        """
+        start = Date.now().floor(self.interval)
+        with self.locker:
+            if self.partitions and self.partitions[-1][0] >= start:
+                return self.partitions[-1][1]
+
+            settings = self.settings.copy()
+            settings.index = self.alias
+            settings.alias = None
+            try:
+                index = self.cluster.create_index(create_timestamp=start, kwargs=settings)
+                index.add_alias(self.alias)
+            except Exception as e:
+                # Another process may have made it first
+                Log.warning("Could not make partition of {{alias}}", alias=self.alias, cause=e)
+            self._load()
+            if not self.partitions or self.partitions[-1][0] < start:
+                Log.error(
+                    "Expecting a partition of {{alias}} for {{start}}",
+                    alias=self.alias,
+                    start=start,
+                )
+            return self.partitions[-1][1]
+
+    def old_partitions(self, before):
+        """
+        :param before: a Date
+        :return: the partitions with only annotations written before this time,
+                 oldest first; the newest partition is never among them
+        """
+        with self.locker:
+            return [
+                index
+                for (_, index), (next_start, _) in zip(self.partitions, self.partitions[1:])
+                if next_start <= before
+            ]
+
+    def drop(self, partition):
+        with self.locker:
+            self.partitions = [(s, p) for s, p in self.partitions if p is not partition]
+        self.cluster.delete_index(partition.settings.index)
+
+    def extend(self, records, refresh=None):
+        self._current().extend(records, refresh=refresh)
+
+    def get_records(self, ids, includes=None, timeout=None):
+        """
+        Realtime lookup by _id, with one _mget over all partitions; an _id
+        found in many partitions is taken from the newest
+        :return: map from _id to _source, for the ids found
+        """
+        ids = list(ids)
+        with self.locker:
+            partitions = [index for _, index in reversed(self.partitions)]
+        if not ids or not partitions:
+            return {}
+
+        docs = []
+        for index in partitions:
+            for i in ids:
+                doc = {"_index": index.settings.index, "_id": i}
+                if index.settings.type:
+                    doc["_type"] = index.settings.type
+                if includes is not None:
+                    doc["_source"] = includes
+                docs.append(doc)
+        try:
+            response = self.cluster.post(
+                "/_mget", data={"docs": docs}, timeout=coalesce(timeout, self.settings.timeout)
+            )
+        except Exception as e:
+            Log.error("Problem with _mget of {{alias}}", alias=self.alias, cause=e)
+
+        # The docs come back in the order asked for, so newest partition first
+        result = {}
+        dropped = False
+        for d in response.docs:
+            if d.found:
+                if d._id not in result:
+                    result[d._id] = d._source
+            elif d.error.type == "index_not_found_exception":
+                dropped = True
+            elif d.error:
+                Log.error("Problem with _mget of {{alias}}", alias=self.alias, cause=d.error)
+        if dropped:
+            # Another process dropped a partition
+            self.reload()
+        return result
+
+    def search(self, query, timeout=None):
+        path = "/" + self.alias + "/_search"
+        try:
+            return self.cluster.post(
+                path, data=wrap(query), timeout=coalesce(timeout, self.settings.timeout)
+            )
+        except Exception as e:
+            Log.error("Problem with search (path={{path}})", path=path, cause=e)
+
+    def delete_record(self, filter, refresh=None):
+        with self.locker:
+            partitions = [index for _, index in self.partitions]
+        for index in partitions:
+            index.delete_record(filter, refresh=refresh)
+
+    def refresh(self):
+        self._current()
+        self.cluster.post("/" + self.alias + "/_refresh")
@@ -0,0 +1,124 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from itertools import islice
+
+from mo_dots import wrap
+from mo_logs import Log
+from mo_threads import Lock, Signal, Thread, Till
+
+WRITE_BATCH_SIZE = 500  # annotations sent to Elasticsearch in one bulk request
+WRITE_WAIT = 1  # seconds an annotation may wait for a batch to fill
+MAX_PENDING = 10000  # annotations waiting to be written before add() blocks
+
+
+class AnnotationWriter(object):
+    """
+    Writes the annotations of all requests to Elasticsearch from one thread,
+    in bulk requests of up to WRITE_BATCH_SIZE. Until Elasticsearch has an
+    annotation it stays in memory, where get() finds it, so a request can
+    read the annotations it (or another request) just added. Annotations are
+    read by _id, which is realtime, so the bulk requests do not refresh.
+    """
+
+    def __init__(
+        self, index, batch_size=WRITE_BATCH_SIZE, wait=WRITE_WAIT, max_pending=MAX_PENDING
+    ):
+        self.index = index
+        self.batch_size = batch_size
+        self.wait = wait
+        self.max_pending = max_pending
+        self.locker = Lock()
+        self.pending = {}  # _id -> annotation record, oldest first
+        self.full = Signal()  # a batch is ready
+        self.written = Signal()  # a batch was written, so there may be room
+        self.num_written = 0
+        self.thread = Thread.run("annotation writer", self._writer)
+
+    def add(self, records):
+        """
+        Blocks while MAX_PENDING annotations are waiting to be written
+        :param records: [{"value": record}, ...], as given to tuid.util.insert
+        """
+        records = [r["value"] for r in records]
+        if not records:
+            return
+        while True:
+            with self.locker:
+                if not self.pending or len(self.pending) + len(records) <= self.max_pending:
+                    for r in records:
+                        # A newer record for the _id replaces the older one
+                        self.pending.pop(r["_id"], None)
+                        self.pending[r["_id"]] = r
+                    if len(self.pending) >= self.batch_size:
+                        self.full.go()
+                    return
+                written = self.written
+            written.wait()
+
+    def get(self, _id):
+        """
+        :return: the annotation record waiting to be written, or None
+        """
+        with self.locker:
+            record = self.pending.get(_id)
+        return wrap(record) if record is not None else None
+
+    def flush(self):
+        """
+        Returns once everything added so far is in Elasticsearch
+        """
+        while True:
+            with self.locker:
+                if not self.pending:
+                    return
+                self.full.go()
+                written = self.written
+            written.wait()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _writer(self, please_stop):
+        while not please_stop:
+            (please_stop | self.full | Till(seconds=self.wait)).wait()
+            while self._write_batch() and len(self.pending) >= self.batch_size:
+                pass
+        # Write what is left before shutdown
+        while self.pending and self._write_batch():
+            pass
+
+    def _write_batch(self):
+        """
+        :return: True if a batch was written
+        """
+        with self.locker:
+            if self.full:
+                self.full = Signal()
+            batch = list(islice(self.pending.values(), self.batch_size))
+        if not batch:
+            return False
+
+        try:
+            self.index.extend([{"value": r} for r in batch])
+        except Exception as e:
+            # Kept pending, so the next round tries again
+            Log.warning("Can not write {{num}} annotations", num=len(batch), cause=e)
+            return False
+
+        with self.locker:
+            for r in batch:
+                # Unless it was replaced while being written
+                if self.pending.get(r["_id"]) is r:
+                    del self.pending[r["_id"]]
+            self.num_written += len(batch)
+            written, self.written = self.written, Signal()
+        written.go()
+        return True
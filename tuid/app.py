@@ -11,19 +11,24 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import os
+from functools import partial
+from time import time
 
 import flask
 import objgraph
 from flask import Flask, Response
 
-from mo_dots import listwrap, coalesce, unwraplist
+from mo_dots import listwrap, coalesce, set_default, unwraplist
 from mo_json import value2json, json2value
 from mo_logs import Log, constants, startup, Except
 from mo_threads.threads import RegisterThread
 from mo_times import Timer
 from pyLibrary.env.flask_wrappers import cors_wrapper
+from tuid.batcher import Batcher
+from tuid.router import FORWARDED_HEADER, Router
 from tuid.service import TUIDService
-from tuid.util import map_to_array
+from tuid.statslogger import METRICS_CONTENT_TYPE
+from tuid.util import map_to_array, select_lines
 
 OVERVIEW = None
 QUERY_SIZE_LIMIT = 10 * 1000 * 1000
@@ -46,11 +51,15 @@ class TUIDApp(Flask):
 flask_app = None
 config = None
 service = None
+batcher = None
+router = None  # Only when there are many worker processes
 
 
 @cors_wrapper
 def tuid_endpoint(path):
     with RegisterThread():
+        start = time()
+        streamed = False  # the latency of a streamed response is recorded when it ends
         try:
             service.statsdaemon.update_requests(requests_total=1)
 
@@ -67,32 +76,44 @@ def tuid_endpoint(path):
             query = json2value(request_body.decode("utf8"))
 
             # ENSURE THE QUERY HAS THE CORRECT FORM
-            if query["from"] != "files":
-                Log.error("Can only handle queries on the `files` table")
-
-            ands = listwrap(query.where["and"])
-            if len(ands) != 3:
-                Log.error(
-                    "expecting a simple where clause with following structure\n{{example|json}}",
-                    example={
-                        "and": [
-                            {"eq": {"branch": "<BRANCH>"}},
-                            {"eq": {"revision": "<REVISION>"}},
-                            {"in": {"path": ["<path1>", "<path2>", "...", "<pathN>"]}},
-                        ]
-                    },
+            # `files` gives the tuids of each path, `tuids` gives the path and line of each tuid
+            if query["from"] not in ("files", "tuids"):
+                Log.error("Can only handle queries on the `files` or `tuids` table")
+            by_tuid = query["from"] == "tuids"
+            # Requests from another worker are for files this one owns
+            local = not router or flask.request.headers.get(FORWARDED_HEADER)
+
+            if query.where["or"]:
+                # MANY REVISIONS, ONE {"and": [...]} CLAUSE FOR EACH
+                if by_tuid:
+                    Log.error("Can only handle many revisions on the `files` table")
+                groups = [_parse_and(o["and"]) for o in listwrap(query.where["or"])]
+
+                if (
+                    service.conn.pending_transactions > TOO_BUSY
+                    or service.get_thread_count() > TOO_MANY_THREADS
+                ):
+                    Log.note("Too busy for {{num}} revisions", num=len(groups))
+                    service.statsdaemon.update_requests(requests_incomplete=1, requests_passed=1)
+                    return Response(
+                        b'{"format":"list", "data":[]}',
+                        status=202,
+                        headers={"Content-Type": "application/json"},
+                    )
+
+                if local:
+                    service.heat.add(path for _, _, paths, _, _ in groups for path in paths)
+                service.statsdaemon.update_requests(requests_passed=1)
+                streamed = True
+                return Response(
+                    _stream_groups(groups, service if local else router, start),
+                    status=200,
+                    headers={"Content-Type": "application/json"},
                 )
 
-            rev = None
-            paths = None
-            branch_name = None
-            for a in ands:
-                rev = coalesce(rev, a.eq.revision)
-                paths = unwraplist(coalesce(paths, a["in"].path, a.eq.path))
-                branch_name = coalesce(branch_name, a.eq.branch)
-            paths = listwrap(paths)
+            branch_name, rev, paths, tuids, lines = _parse_and(query.where["and"])
 
-            if len(paths) == 0:
+            if len(tuids if by_tuid else paths) == 0:
                 response, completed = [], True
             elif service.conn.pending_transactions > TOO_BUSY:  # CHECK IF service IS VERY BUSY
                 # TODO:  BE SURE TO UPDATE STATS TOO
@@ -101,11 +122,31 @@ def tuid_endpoint(path):
             elif service.get_thread_count() > TOO_MANY_THREADS:
                 Log.note("Too many threads open")
                 response, completed = [], False
+            elif by_tuid:
+                # RETURN LINES
+                with Timer("tuid internal response time for {{num}} tuids", {"num": len(tuids)}):
+                    if router:
+                        response, completed = router.get_lines_from_tuids(
+                            tuids, rev, repo=branch_name, forwarded=bool(local)
+                        )
+                    else:
+                        response, completed = service.get_lines_from_tuids(
+                            tuids, rev, repo=branch_name
+                        )
+
+                if not completed:
+                    Log.note(
+                        "Request for {{num}} tuids is incomplete for revision {{rev}}.",
+                        num=len(tuids),
+                        rev=rev,
+                    )
             else:
                 # RETURN TUIDS
+                if local:
+                    service.heat.add(paths)
                 with Timer("tuid internal response time for {{num}} files", {"num": len(paths)}):
-                    response, completed = service.get_tuids_from_files(
-                        revision=rev, files=paths, going_forward=True, repo=branch_name
+                    response, completed = (batcher if local else router).get_tuids_from_files(
+                        paths, rev, repo=branch_name
                     )
 
                 if not completed:
@@ -116,9 +157,9 @@ def tuid_endpoint(path):
                     )
 
             if query.meta.format == "list":
-                formatter = _stream_list
+                formatter = _stream_lines_list if by_tuid else partial(_stream_list, lines=lines)
             else:
-                formatter = _stream_table
+                formatter = _stream_lines_table if by_tuid else partial(_stream_table, lines=lines)
 
             service.statsdaemon.update_requests(
                 requests_complete=1 if completed else 0,
@@ -140,16 +181,117 @@ def tuid_endpoint(path):
                 status=400,
                 headers={"Content-Type": "text/html"},
             )
+        finally:
+            if not streamed:
+                service.statsdaemon.record_latency(time() - start)
+
+
+def _parse_and(ands):
+    """
+    :param ands: THE {"and": [...]} CLAUSE OF ONE REQUEST
+    :return: (branch, revision, paths, tuids, lines) WHERE lines MAPS PATH TO WANTED LINES
+    """
+    ands = listwrap(ands)
+    if len(ands) not in (3, 4):
+        Log.error(
+            "expecting a simple where clause with following structure\n{{example|json}}",
+            example={
+                "and": [
+                    {"eq": {"branch": "<BRANCH>"}},
+                    {"eq": {"revision": "<REVISION>"}},
+                    {"in": {"path": ["<path1>", "<path2>", "...", "<pathN>"]}},
+                    # optional, to get only some lines of some paths
+                    {"eq": {"lines": [{"path": "<path1>", "lines": [1, [10, 20]]}]}},
+                ]
+            },
+        )
+
+    rev = None
+    paths = None
+    tuids = None
+    lines = {}
+    branch_name = None
+    for a in ands:
+        for l in listwrap(a.eq.lines):
+            lines[l.path.lstrip("/")] = l.lines
+        rev = coalesce(rev, a.eq.revision)
+        paths = unwraplist(coalesce(paths, a["in"].path, a.eq.path))
+        tuids = unwraplist(coalesce(tuids, a["in"].tuid, a.eq.tuid))
+        branch_name = coalesce(branch_name, a.eq.branch)
+    return branch_name, rev, listwrap(paths), listwrap(tuids), lines
+
+
+def _stream_groups(groups, lookup, start):
+    """
+    ONE RESULT PER GROUP, AS SOON AS IT IS DONE, WHICH IS NOT THE ORDER GIVEN
+    :param lookup: THE service, OR THE router
+    :param start: WHEN THE REQUEST ARRIVED, FOR THE LATENCY
+    """
+    completed = True
+    try:
+        yield b'{"format":"list", "data":['
+        sep = b""
+        results = lookup.get_tuids_from_revisions([g[:3] for g in groups])
+        for i, files, group_completed in results:
+            completed = completed and group_completed
+            branch, revision, _, _, lines = groups[i]
+            yield sep
+            yield value2json(
+                {
+                    "group": i,
+                    "branch": branch,
+                    "revision": revision,
+                    "complete": group_completed,
+                    "files": [_file_record(f, pairs, lines) for f, pairs in files],
+                }
+            ).encode("utf8")
+            sep = b","
+    except Exception as e:
+        # THE RESPONSE HAS STARTED, SO THE MISSING GROUPS ARE THE ONLY SIGN
+        completed = False
+        Log.warning("could not finish {{num}} revisions", num=len(groups), cause=e)
+    finally:
+        service.statsdaemon.update_requests(
+            requests_complete=1 if completed else 0, requests_incomplete=1 if not completed else 0
+        )
+        service.statsdaemon.record_latency(time() - start)
+    yield b"]}"
+
 
+def _file_record(f, pairs, lines):
+    if lines and f in lines:
+        some_lines, tuids = select_lines(pairs, lines[f])
+        return {"path": f, "lines": some_lines, "tuids": tuids}
+    return {"path": f, "tuids": map_to_array(pairs)}
+
+
+def _stream_table(files, lines=None):
+    """
+    :param lines: map from path to the lines wanted, paths not in it get all their lines
+    """
+    if not lines:
+        yield b'{"format":"table", "header":["path", "tuids"], "data":['
+        sep = b""
+        for f, pairs in files:
+            yield sep
+            yield value2json([f, map_to_array(pairs)]).encode("utf8")
+            sep = b","
+        yield b"]}"
+        return
 
-def _stream_table(files):
-    yield b'{"format":"table", "header":["path", "tuids"], "data":['
+    yield b'{"format":"table", "header":["path", "lines", "tuids"], "data":['
+    sep = b""
     for f, pairs in files:
-        yield value2json([f, map_to_array(pairs)]).encode("utf8")
+        yield sep
+        if f in lines:
+            yield value2json([f] + list(select_lines(pairs, lines[f]))).encode("utf8")
+        else:
+            yield value2json([f, None, map_to_array(pairs)]).encode("utf8")
+        sep = b","
     yield b"]}"
 
 
-def _stream_list(files):
+def _stream_list(files, lines=None):
     if not files:
         yield b'{"format":"list", "data":[]}'
         return
@@ -157,11 +299,49 @@ def _stream_list(files):
     sep = b'{"format":"list", "data":['
     for f, pairs in files:
         yield sep
-        yield value2json({"path": f, "tuids": map_to_array(pairs)}).encode("utf8")
+        yield value2json(_file_record(f, pairs, lines)).encode("utf8")
+        sep = b","
+    yield b"]}"
+
+
+def _stream_lines_table(lines):
+    yield b'{"format":"table", "header":["tuid", "path", "line"], "data":['
+    sep = b""
+    for tuid, path, line in lines:
+        yield sep
+        yield value2json([tuid, path, line]).encode("utf8")
+        sep = b","
+    yield b"]}"
+
+
+def _stream_lines_list(lines):
+    yield b'{"format":"list", "data":['
+    sep = b""
+    for tuid, path, line in lines:
+        yield sep
+        yield value2json({"tuid": tuid, "path": path, "line": line}).encode("utf8")
         sep = b","
     yield b"]}"
 
 
+@cors_wrapper
+def _metrics():
+    try:
+        return Response(
+            service.statsdaemon.to_prometheus().encode("utf8"),
+            status=200,
+            headers={"Content-Type": METRICS_CONTENT_TYPE},
+        )
+    except Exception as e:
+        e = Except.wrap(e)
+        Log.warning("could not build metrics", cause=e)
+        return Response(
+            value2json(e, pretty=True).encode("utf8"),
+            status=500,
+            headers={"Content-Type": "text/html"},
+        )
+
+
 @cors_wrapper
 def _head(path):
     return Response(b"", status=200)
@@ -175,6 +355,7 @@ def _default(path):
 if __name__ in ("__main__",):
     Log.note("Starting TUID Service App...")
     flask_app = TUIDApp(__name__)
+    flask_app.add_url_rule(str("/metrics"), None, _metrics, methods=[str("GET")])
     flask_app.add_url_rule(
         str("/"), None, tuid_endpoint, defaults={"path": ""}, methods=[str("GET"), str("POST")]
     )
@@ -183,11 +364,41 @@ if __name__ in ("__main__",):
     )
 
     try:
-        config = startup.read_settings(filename=os.environ.get("TUID_CONFIG"))
+        config = startup.read_settings(
+            defs=[
+                {
+                    "name": ["--process_num"],
+                    "help": "number of this worker process, when there are many",
+                    "type": int,
+                    "dest": "process_num",
+                    "default": 0,
+                    "required": False,
+                }
+            ],
+            filename=os.environ.get("TUID_CONFIG"),
+        )
         constants.set(config.constants)
         Log.start(config.debug)
 
+        if config.tuid.workers:
+            set_default(
+                config.tuid.workers,
+                {"process_num": config.args.process_num, "port": config.flask.port},
+            )
         service = TUIDService(config.tuid)
+        batcher = Batcher(service)
+        service.statsdaemon.add_gauge(
+            "requests_batched",
+            "Requests answered together with another at the same revision",
+            lambda: batcher.merged,
+        )
+        if service.workers:
+            router = Router(service, batcher)
+            service.statsdaemon.add_gauge(
+                "requests_forwarded",
+                "Requests sent to the worker that owns the files",
+                lambda: router.forwarded,
+            )
 
         # Log memory info while running
         initial_growth = {}
@@ -0,0 +1,83 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_logs import Log
+from mo_threads import Lock, Signal, Thread, Till
+
+BATCH_WINDOW = 0.2  # seconds a request waits for others at the same revision, 0 to not wait
+
+
+class _Batch(object):
+    def __init__(self):
+        self.files = set()
+        self.requests = 0
+        self.done = Signal()
+        self.result = {}
+        self.completed = False
+        self.error = None
+
+
+class Batcher(object):
+    """
+    Merges the requests for the same (branch, revision) that arrive within
+    BATCH_WINDOW seconds of each other into one get_tuids_from_files call,
+    so they share the branch check, the csetLog range, the diffs, and the
+    annotation lookups. Each request gets back just the files it asked for.
+    """
+
+    def __init__(self, service, window=None):
+        self.service = service
+        self.window = BATCH_WINDOW if window is None else window
+        self.locker = Lock()
+        self.pending = {}  # (branch, revision) -> _Batch still taking requests
+        self.merged = 0  # requests answered by a call made for another request
+
+    def get_tuids_from_files(self, files, revision, repo=None):
+        """
+        Same as TUIDService.get_tuids_from_files(files, revision, going_forward=True, repo=repo)
+        """
+        if not self.window:
+            return self.service.get_tuids_from_files(
+                files, revision, going_forward=True, repo=repo
+            )
+
+        key = (repo, revision)
+        with self.locker:
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = self.pending[key] = _Batch()
+                Thread.run("batch " + revision, self._run, key, batch)
+            else:
+                self.merged += 1
+            batch.files.update(f.lstrip("/") for f in files)
+            batch.requests += 1
+
+        batch.done.wait()
+        if batch.error:
+            Log.error("Batch of {{num}} requests failed", num=batch.requests, cause=batch.error)
+        files = [f.lstrip("/") for f in files]
+        return [(f, batch.result[f]) for f in files if f in batch.result], batch.completed
+
+    def _run(self, key, batch, please_stop=None):
+        (please_stop | Till(seconds=self.window)).wait()
+        with self.locker:
+            del self.pending[key]
+            files = list(batch.files)
+
+        repo, revision = key
+        try:
+            result, batch.completed = self.service.get_tuids_from_files(
+                files, revision, going_forward=True, repo=repo
+            )
+            batch.result = dict(result)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.go()
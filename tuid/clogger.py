@@ -9,26 +9,28 @@ from __future__ import division
 from __future__ import unicode_literals
 
 import time
+from itertools import chain
 
 # Use import as follows to prevent
 # circular dependency conflict for
 # TUIDService, which makes use of the
 # Clogger
 import tuid.service
-from jx_elasticsearch import elasticsearch
 from jx_python import jx
-from mo_dots import Null, coalesce, set_default, wrap
+from mo_dots import Null, coalesce
+from mo_files.url import URL
 from mo_hg.hg_mozilla_org import HgMozillaOrg
 from mo_logs import Log
-from mo_logs.exceptions import suppress_exception
 from mo_threads import Till, Thread, Lock, Queue, Signal
+from mo_times.dates import Date
 from mo_times.durations import DAY
 from mo_http import http
 from tuid import sql
-from tuid.util import HG_URL, insert, delete
+from tuid.csetlog import ElasticsearchCsetLog, SqliteCsetLog
+from tuid.pushes import PushListener
+from tuid.util import HG_URL
 
 RETRY = {"times": 3, "sleep": 5}
-SQL_CSET_BATCH_SIZE = 500
 CSET_TIP_WAIT_TIME = 5 * 60  # seconds
 CSET_BACKFILL_WAIT_TIME = 1 * 60  # seconds
 CSET_MAINTENANCE_WAIT_TIME = 30 * 60  # seconds
@@ -38,13 +40,20 @@ TIME_TO_KEEP_ANNOTATIONS = 5 * DAY
 MAX_TIPFILL_CLOGS = 400  # changeset logs
 MAX_BACKFILL_CLOGS = 1000  # changeset logs
 CHANGESETS_PER_CLOG = 20  # changesets
+PUSHES_PER_REQUEST = 100  # pushes in one json-pushes request
+PARALLEL_PUSH_REQUESTS = 4  # json-pushes requests made at once when walking the changelog
+LOCAL_CLOG_SIZE = 1000  # changesets read at once from a local clone
 BACKFILL_REVNUM_TIMEOUT = int(MAX_BACKFILL_CLOGS * 2.5)  # Assume 2.5 seconds per clog
 MINIMUM_PERMANENT_CSETS = 200  # changesets
 MAXIMUM_NONPERMANENT_CSETS = 1500  # changesets
 SIGNAL_MAINTENANCE_CSETS = int(MAXIMUM_NONPERMANENT_CSETS + (0.2 * MAXIMUM_NONPERMANENT_CSETS))
+RECENT_CSETS_TIME = 60 * 60  # seconds a backfill is kept, even beyond MAXIMUM_NONPERMANENT_CSETS
 UPDATE_VERY_OLD_FRONTIERS = False
+DELETION_BATCH_SIZE = 1000  # csetLog rows or annotations deleted at once
 CACHE_WAIT_TIME = 15  # seconds
 CACHING_BATCH_SIZE = 50
+CACHE_MAX_FILES = 1000  # files advanced by the caching daemon per round, hottest first
+CACHE_MIN_HEAT = 0.5  # colder files are not advanced, see tuid.heat
 
 SINGLE_CLOGGER = None
 
@@ -75,7 +84,6 @@ class Clogger:
                 self.esconfig = self.config.tuid.esclogger.csetLog
             else:
                 self.esconfig = self.config.esclogger.csetLog
-            self.es = elasticsearch.Cluster(kwargs=self.esconfig)
 
             self.tuid_service = (
                 tuid_service
@@ -87,49 +95,45 @@ class Clogger:
             self.rev_locker = Lock()
             self.working_locker = Lock()
             self.csetLog_locker = Lock()
+            self.backfill_locker = Lock()
+            # revision -> (Signal, number waiting), fired when the revision is
+            # added to the csetLog or the backfill gives up on it
+            self.backfill_waiters = {}
 
-            if new_table:
-                try:
-                    index = self.es.get_canonical_index(self.esconfig.index)
-                    response = self.es.delete_index(index)
-                except Exception as e:
-                    Log.warning(
-                        "could not delete csetlog index because (mostly index has not yet created): {{cause}}",
-                        cause=str(e),
-                    )
-
-            self.init_db()
+            self.init_db(new_table)
             self.next_revnum = self.get_revnum_stats("max") + 1
 
             self.csets_todo_backwards = Queue(name="Clogger.csets_todo_backwards")
             self.caching_signal = Signal(name="Clogger.caching_signal")
+            self.maintenance_signal = Signal(name="Clogger.maintenance_signal")
+            self.tip_signal = Signal(name="Clogger.tip_signal")  # a push landed
+            self.csets_deleted = 0
+            self.annotations_deleted = 0
 
             if "tuid" in self.config:
                 self.config = self.config.tuid
+            self.hg_url = URL(coalesce(self.config.hg.url, HG_URL))
 
             self.disable_backfilling = False
             self.disable_tipfilling = False
             self.disable_caching = False
+            self.disable_maintenance = False
 
             self.backfill_thread = None
             self.tipfill_thread = None
             self.caching_thread = None
+            self.maintenance_thread = None
+            self.push_listener = None
 
             # Make sure we are filled before allowing queries
-            query = {"aggs": {"output": {"value_count": {"field": "revnum"}}}, "size": 0}
-            numrevs = int(self.csetlog.search(query).aggregations.output.value)
+            numrevs = self.csetlog.count()
             if numrevs < MINIMUM_PERMANENT_CSETS:
                 Log.note(
                     "Filling in csets to hold {{minim}} csets.", minim=MINIMUM_PERMANENT_CSETS
                 )
                 oldest_rev = "tip"
 
-                query = {
-                    "_source": {"includes": ["revision"]},
-                    "sort": [{"revnum": {"order": "asc"}}],
-                    "size": 1,
-                }
-                tmp = self.csetlog.search(query).hits.hits[0]._source.revision
+                _, tmp = self.get_tail()
                 if tmp:
                     oldest_rev = tmp
                 self._fill_in_range(MINIMUM_PERMANENT_CSETS - numrevs, oldest_rev, timestamp=False)
@@ -145,20 +149,7 @@ class Clogger:
             Log.warning("Cannot setup clogger: {{cause}}", cause=str(e))
 
     def get_revnum_stats(self, query_required):
-        query = None
-        if query_required == "min":
-            query = {"size": 0, "aggs": {"value": {"min": {"field": "revnum"}}}}
-        elif query_required == "max":
-            query = {"size": 0, "aggs": {"value": {"max": {"field": "revnum"}}}}
-        return coalesce(eval(str(self.csetlog.search(query).aggregations.value.value)), 0)
-
-    def _query_result_size(self, terms):
-        query = {"size": 0, "query": {"terms": terms}}
-        return query
-
-    def _make_record_csetlog(self, revnum, revision, timestamp):
-        record = {"_id": revnum, "revnum": revnum, "revision": revision, "timestamp": timestamp}
-        return {"value": record}
+        return self.csetlog.get_revnum_stats(query_required)
 
     def start_backfilling(self):
         if not self.backfill_thread:
@@ -172,28 +163,31 @@ class Clogger:
         if not self.caching_thread:
             self.caching_thread = Thread.run("caching-daemon", self.caching_daemon)
 
+    def start_maintenance(self):
+        if not self.maintenance_thread:
+            self.maintenance_thread = Thread.run("clogger-maintenance", self.maintenance_worker)
+
     def start_workers(self):
         self.start_tipfillling()
         self.start_backfilling()
         self.start_caching()
+        self.start_maintenance()
+        if self.config.pushes and not self.push_listener:
+            self.push_listener = PushListener(self, kwargs=self.config.pushes)
         Log.note("Started clogger workers.")
 
-    def init_db(self):
-        csetLog = self.esconfig
-        set_default(csetLog, {"schema": CSETLOG_SCHEMA})
-        self.csetlog = self.es.get_or_create_index(kwargs=csetLog)
-        self.csetlog.refresh()
-
-        total = self.csetlog.search({"size": 0})
-        while not total.hits:
-            total = self.csetlog.search({"size": 0})
-        with suppress_exception:
-            self.csetlog.add_alias()
+    def init_db(self, new_table=False):
+        # csetLog.backend == "sqlite" keeps the csetLog in the service's database
+        if self.esconfig.backend == "sqlite":
+            self.csetlog = SqliteCsetLog(self.conn, new_table=new_table)
+        else:
+            self.csetlog = ElasticsearchCsetLog(new_table=new_table, kwargs=self.esconfig)
 
     def disable_all(self):
         self.disable_tipfilling = True
         self.disable_backfilling = True
         self.disable_caching = True
+        self.disable_maintenance = True
 
     def revnum(self):
         """
@@ -202,24 +196,103 @@ class Clogger:
         return self.get_revnum_stats("max")
 
     def get_tip(self):
-        query = {
-            "_source": {"includes": ["revision"]},
-            "sort": [{"revnum": {"order": "desc"}}],
-            "size": 1,
-        }
-        result = self.csetlog.search(query)
-        tmp = (result.hits.hits[0].sort[0], result.hits.hits[0]._source.revision)
-        return tmp
+        return self.csetlog.get_tip()
 
     def get_tail(self):
-        query = {
-            "_source": {"includes": ["revision"]},
-            "sort": [{"revnum": {"order": "asc"}}],
-            "size": 1,
-        }
-        result = self.csetlog.search(query)
-        tmp = (result.hits.hits[0].sort[0], result.hits.hits[0]._source.revision)
-        return tmp
+        return self.csetlog.get_tail()
+
+    def _walk_branch_clog(self, revision):
+        """
+        Walk the main branch changelog, the way following json-log pages would,
+        but with fewer round trips: pushes are read PUSHES_PER_REQUEST at a
+        time, with PARALLEL_PUSH_REQUESTS requests in flight.
+        :param revision: where to start ("tip" is allowed)
+        :return: generator of 12 character revisions, newest first, starting
+                 with revision
+        """
+        if self.tuid_service.local_hg:
+            for rev in self._walk_local_clog(revision):
+                yield rev
+            return
+
+        pushes_url = str(self.hg_url) + "/" + self.config.hg.branch + "/json-pushes?version=2"
+        if revision == "tip":
+            rev_url = str(self.hg_url) + "/" + self.config.hg.branch + "/json-rev/tip"
+            revision = http.get_json(rev_url, retry=RETRY).node
+        pushes = self._get_pushes(pushes_url + "&changeset=" + revision).pushes
+        if not pushes:
+            Log.error("No push found for {{rev}}", rev=revision)
+
+        # The first push may have newer changesets than revision
+        push_id, push = list(pushes.items())[0]
+        push_id = int(push_id)
+        started = False
+        for node in reversed(list(push.changesets)):
+            started = started or node.startswith(revision[:12])
+            if started:
+                yield node[:12]
+
+        parallel = 1  # Often the walk ends in the next few pushes
+        while push_id > 1:
+            # Windows of older pushes, fetched together
+            ranges = []
+            end = push_id - 1
+            while end > 0 and len(ranges) < parallel:
+                start = max(end - PUSHES_PER_REQUEST, 0)
+                ranges.append((start, end))
+                end = start
+            results = [None] * len(ranges)
+            threads = [
+                Thread.run(
+                    "get pushes " + str(start),
+                    self._get_push_range,
+                    pushes_url,
+                    start,
+                    end,
+                    results,
+                    i,
+                )
+                for i, (start, end) in enumerate(ranges)
+            ]
+            for t in threads:
+                t.join()
+
+            for pushes in results:
+                if pushes is None:
+                    Log.error("Could not get pushes from {{url}}", url=pushes_url)
+                for _, push in sorted(pushes.items(), key=lambda p: -int(p[0])):
+                    for node in reversed(list(push.changesets)):
+                        yield node[:12]
+            push_id = ranges[-1][0] + 1
+            parallel = PARALLEL_PUSH_REQUESTS
+
+    def _walk_local_clog(self, revision):
+        # Same as _walk_branch_clog, for the local clone
+        while True:
+            nodes = [
+                c.node[:12]
+                for c in self.tuid_service.local_hg.get_clog(revision, LOCAL_CLOG_SIZE).changesets
+            ]
+            if len(nodes) < LOCAL_CLOG_SIZE:
+                for node in nodes:
+                    yield node
+                return
+            # The last one starts the next page
+            for node in nodes[:-1]:
+                yield node
+            revision = nodes[-1]
+
+    def _get_push_range(self, pushes_url, start, end, results, i, please_stop=None):
+        # Pushes with start < push id <= end
+        try:
+            url = pushes_url + "&startID=" + str(start) + "&endID=" + str(end)
+            results[i] = self._get_pushes(url).pushes
+        except Exception as e:
+            Log.warning("Could not get pushes {{start}} to {{end}}", start=start, end=end, cause=e)
+
+    def _get_pushes(self, pushes_url):
+        Log.note("Searching through pushes {{url}}", url=pushes_url)
+        return http.get_json(pushes_url, retry=RETRY)
 
     def _get_clog(self, clog_url):
         try:
@@ -233,55 +306,24 @@ class Clogger:
                 error=e,
             )
 
-    def _get_one_revision(self, cset_entry):
-        # Returns a single revision if it exists
-        _, rev, _ = cset_entry
-        query = {
-            "_source": {"includes": ["revision"]},
-            "query": {"bool": {"must": [{"term": {"revision": rev}}]}},
-            "size": 1,
-        }
-        temp = self.csetlog.search(query).hits.hits[0]._source.revision
-        return temp
-
     def _get_one_revnum(self, rev):
         # Returns a single revnum if it exists
-        query = {
-            "_source": {"includes": ["revnum"]},
-            "query": {"bool": {"must": [{"term": {"revision": rev}}]}},
-            "size": 1,
-        }
-        temp = self.csetlog.search(query).hits.hits[0]._source.revnum
-        return temp
+        return self.csetlog.get_revnums([rev[:12]]).get(rev[:12])
+
+    def get_revnums(self, revisions):
+        """
+        :param revisions: list of revisions
+        :return: map from revision[:12] to revnum, for the revisions in the csetLog
+        """
+        return self.csetlog.get_revnums(list(set(r[:12] for r in revisions)))
 
     def _get_revnum_exists(self, rev):
-        # Returns a single revnum if it exists
-        query = {
-            "_source": {"includes": ["revnum"]},
-            "query": {"bool": {"must": [{"term": {"revnum": rev}}]}},
-            "size": 0,
-        }
-        temp = self.csetlog.search(query).hits.total
-        return temp
+        # True if the revnum is in the csetLog
+        return self.csetlog.has_revnum(rev)
 
     def _get_revnum_range(self, revnum1, revnum2):
         # Returns a range of revision numbers (that is inclusive)
-        high_num = max(revnum1, revnum2)
-        low_num = min(revnum1, revnum2)
-
-        total = self.csetlog.search({"size": 0})
-        query = {
-            "size": total.hits.total,
-            "_source": {"includes": ["revnum", "revision"]},
-            "query": {
-                "bool": {"must": [{"range": {"revnum": {"gte": low_num, "lte": high_num}}}]}
-            },
-        }
-        result = self.csetlog.search(query).hits.hits
-        temp = []
-        for r in result:
-            temp.append((r._source.revnum, r._source.revision))
-        return temp
+        return self.csetlog.get_range(min(revnum1, revnum2), max(revnum1, revnum2))
 
     def add_cset_entries(self, ordered_rev_list, timestamp=False, number_forward=True):
         """
@@ -315,20 +357,44 @@ class Clogger:
         ]
 
         # In case of overlapping requests
-        fmt_insert_list = []
-        for cset_entry in insert_list:
-            tmp = self._get_one_revision(cset_entry)
-            if not tmp:
-                fmt_insert_list.append(cset_entry)
-
-        # for _, tmp_insert_list in jx.chunk(fmt_insert_list, size=SQL_CSET_BATCH_SIZE):
-        records = wrap(
-            [
-                self._make_record_csetlog(revnum, revision, timestamp)
-                for revnum, revision, timestamp in fmt_insert_list
-            ]
-        )
-        insert(self.csetlog, records)
+        existing = self.csetlog.get_revnums([rev for _, rev, _ in insert_list])
+        fmt_insert_list = [e for e in insert_list if e[1] not in existing]
+
+        self.csetlog.add(fmt_insert_list)
+        self._backfill_done([revision for _, revision, _ in fmt_insert_list])
+
+        if current_max - current_min + len(fmt_insert_list) >= SIGNAL_MAINTENANCE_CSETS:
+            self.maintenance_signal.go()
+
+    def _backfill_signal(self, revision):
+        # Signal fired once the revision is in the csetLog, or will not be;
+        # a waiter that gives up calls _backfill_forget()
+        revision = revision[:12]
+        with self.backfill_locker:
+            signal, waiting = self.backfill_waiters.get(revision, (None, 0))
+            if signal is None:
+                signal = Signal("backfill " + revision)
+            self.backfill_waiters[revision] = (signal, waiting + 1)
+            return signal
+
+    def _backfill_forget(self, revision, signal):
+        # The signal is dropped once nobody waits on it
+        revision = revision[:12]
+        with self.backfill_locker:
+            found, waiting = self.backfill_waiters.get(revision, (None, 0))
+            if found is not signal:
+                return
+            if waiting > 1:
+                self.backfill_waiters[revision] = (signal, waiting - 1)
+            else:
+                del self.backfill_waiters[revision]
+
+    def _backfill_done(self, revisions):
+        with self.backfill_locker:
+            signals = [self.backfill_waiters.pop(r[:12], (None, 0))[0] for r in revisions]
+        for signal in signals:
+            if signal is not None:
+                signal.go()
 
     def _fill_in_range(self, parent_cset, child_cset, timestamp=False, number_forward=True):
         """
@@ -358,43 +424,33 @@ class Clogger:
             return None
 
         csets_found = 0
-        clogs_seen = 0
-        final_rev = child_cset
-        while not found_parent and clogs_seen < MAX_BACKFILL_CLOGS:
-            clog_url = str(HG_URL) + "/" + self.config.hg.branch + "/json-log/" + final_rev
-            clog_obj = self._get_clog(clog_url)
-            clog_csets_list = list(clog_obj["changesets"])
-            for clog_cset in clog_csets_list[:-1]:
-                if not number_forward and csets_found <= 0:
-                    # Skip this entry it already exists
-                    csets_found += 1
-                    continue
-
-                nodes_cset = clog_cset["node"][:12]
-                if find_parent:
-                    if nodes_cset == parent_cset:
-                        found_parent = True
-                        if not number_forward:
-                            # When going forward this entry is
-                            # the given parent
-                            csets_to_add.append(nodes_cset)
-                        break
-                else:
-                    if csets_found + 1 > parent_cset:
-                        found_parent = True
-                        if not number_forward:
-                            # When going forward this entry is
-                            # the given parent (which is supposed
-                            # to already exist)
-                            csets_to_add.append(nodes_cset)
-                        break
-                    csets_found += 1
-                csets_to_add.append(nodes_cset)
-            if found_parent == True:
+        for count, nodes_cset in enumerate(self._walk_branch_clog(child_cset)):
+            if count >= MAX_BACKFILL_CLOGS * CHANGESETS_PER_CLOG:
                 break
-
-            clogs_seen += 1
-            final_rev = clog_csets_list[-1]["node"][:12]
+            if not number_forward and csets_found <= 0:
+                # Skip this entry it already exists
+                csets_found += 1
+                continue
+
+            if find_parent:
+                if nodes_cset == parent_cset:
+                    found_parent = True
+                    if not number_forward:
+                        # When going forward this entry is
+                        # the given parent
+                        csets_to_add.append(nodes_cset)
+                    break
+            else:
+                if csets_found + 1 > parent_cset:
+                    found_parent = True
+                    if not number_forward:
+                        # When going forward this entry is
+                        # the given parent (which is supposed
+                        # to already exist)
+                        csets_to_add.append(nodes_cset)
+                    break
+                csets_found += 1
+            csets_to_add.append(nodes_cset)
 
         if found_parent:
             self.add_cset_entries(csets_to_add, timestamp=timestamp, number_forward=number_forward)
@@ -430,14 +486,10 @@ class Clogger:
 
         with self.working_locker:
             if delete_old:
-                filter = {"match_all": {}}
-                delete(self.csetlog, filter)
+                self.csetlog.delete_all()
 
             max_revnum = self.get_revnum_stats("max") + 1
-            self.csetlog.add(self._make_record_csetlog(max_revnum, new_rev, -1))
-            self.csetlog.refresh()
-            while not self._get_revnum_exists(max_revnum):
-                Till(seconds=0.001).wait()
+            self.csetlog.add([(max_revnum, new_rev, -1)])
 
             self._fill_in_range(old_rev, new_rev, timestamp=True, number_forward=False)
 
@@ -449,6 +501,9 @@ class Clogger:
         parent_cset can be an int X to go back by X changesets, or
         a string to search for going backwards in time. If timestamp
         is false, no timestamps will be added to the entries.
+
+        All requests waiting in the queue are handled together, so the
+        changelog is walked once for the whole batch.
         :param please_stop:
         :return:
         """
@@ -464,24 +519,71 @@ class Clogger:
                     Till(till=CSET_BACKFILL_WAIT_TIME).wait()
                     continue
 
-                if request:
-                    parent_cset, timestamp = request
-                else:
-                    continue
-
-                with self.working_locker:
-                    parent_revnum = self._get_one_revnum(parent_cset)
-                    if parent_revnum != None:
-                        continue
+                requests = [r for r in [request] + self.csets_todo_backwards.pop_all() if r]
+                for timestamp in (True, False):
+                    batch = [parent for parent, t in requests if bool(t) == timestamp]
+                    if batch:
+                        self._fill_backward_batch(batch, timestamp)
+            except Exception as e:
+                Log.warning("Unknown error occurred during backfill: ", cause=e)
 
+    def _fill_backward_batch(self, parents, timestamp):
+        """
+        :param parents: revisions to reach, or ints to go back by that many changesets
+        :param timestamp: passed on to add_cset_entries
+        """
+        revisions = [p[:12] for p in parents if type(p) != int]
+        try:
+            with self.working_locker:
+                counts = [p for p in parents if type(p) == int]
+                if counts:
                     _, oldest_revision = self.get_tail()
-
                     self._fill_in_range(
-                        parent_cset, oldest_revision, timestamp=timestamp, number_forward=False
+                        max(counts), oldest_revision, timestamp=timestamp, number_forward=False
                     )
-                Log.note("Finished {{cset}}", cset=parent_cset)
-            except Exception as e:
-                Log.warning("Unknown error occurred during backfill: ", cause=e)
+
+                missing = set(r for r in revisions if self._get_one_revnum(r) == None)
+                if missing:
+                    _, oldest_revision = self.get_tail()
+                    self._fill_in_range_to_any(missing, oldest_revision, timestamp=timestamp)
+            Log.note("Finished {{csets}}", csets=parents)
+        finally:
+            # Wake the waiters, even if a revision was not found
+            self._backfill_done(revisions)
+
+    def _fill_in_range_to_any(self, revisions, child_cset, timestamp=False):
+        """
+        Go back from child_cset (already in the csetLog) until all the given
+        revisions are seen, then add everything up to the oldest one. Revisions
+        not found within MAX_BACKFILL_CLOGS pages are left out.
+        :param revisions: set of revisions to reach
+        :return: list of revisions added, newest first
+        """
+        remaining = set(revisions)
+        csets_to_add = []
+        last_wanted = 0  # csets_to_add[:last_wanted] ENDS AT THE OLDEST REVISION FOUND
+        walk = self._walk_branch_clog(child_cset)
+        next(walk, None)  # child_cset already exists
+        for nodes_cset in walk:
+            if not remaining or len(csets_to_add) >= MAX_BACKFILL_CLOGS * CHANGESETS_PER_CLOG:
+                break
+            csets_to_add.append(nodes_cset)
+            if nodes_cset in remaining:
+                remaining.discard(nodes_cset)
+                last_wanted = len(csets_to_add)
+
+        if remaining:
+            Log.warning(
+                "Couldn't find {{revisions}} going back from {{child}}. "
+                "Max number that can be requested is {{maxnum}}.",
+                revisions=remaining,
+                child=child_cset,
+                maxnum=MAX_BACKFILL_CLOGS * CHANGESETS_PER_CLOG,
+            )
+        csets_to_add = csets_to_add[:last_wanted]
+        if csets_to_add:
+            self.add_cset_entries(csets_to_add, timestamp=timestamp, number_forward=False)
+        return csets_to_add
 
     def update_tip(self):
         """
@@ -489,13 +591,15 @@ class Clogger:
         if an update has taken place.
         :return:
         """
-        clog_obj = self._get_clog(str(HG_URL) + "/" + self.config.hg.branch + "/json-log/tip")
+        if self.tuid_service.local_hg:
+            self.tuid_service.local_hg.pull()
+        walk = self._walk_branch_clog("tip")
+        first_clog_entry = next(walk)
 
         _, newest_known_rev = self.get_tip()
 
         # If we are still at the newest, wait for CSET_TIP_WAIT_TIME seconds
         # before checking again.
-        first_clog_entry = clog_obj["changesets"][0]["node"][:12]
         if newest_known_rev == first_clog_entry:
             return False
 
@@ -510,30 +614,22 @@ class Clogger:
         found_newest_known = False
         csets_to_add = []
         csets_found = 0
-        clogs_seen = 0
         Log.note("Found new revisions. Updating csetLog tip to {{rev}}...", rev=first_clog_entry)
-        while not found_newest_known and clogs_seen < MAX_TIPFILL_CLOGS:
-            clog_csets_list = list(clog_obj["changesets"])
-            for clog_cset in clog_csets_list[:-1]:
-                nodes_cset = clog_cset["node"][:12]
-                if not csets_to_gather:
-                    if nodes_cset == newest_known_rev:
-                        found_newest_known = True
-                        break
-                else:
-                    if csets_found >= csets_to_gather:
-                        found_newest_known = True
-                        break
-                csets_found += 1
-                csets_to_add.append(nodes_cset)
-            if not found_newest_known:
-                # Get the next page
-                clogs_seen += 1
-                final_rev = clog_csets_list[-1]["node"][:12]
-                clog_url = str(HG_URL) + "/" + self.config.hg.branch + "/json-log/" + final_rev
-                clog_obj = self._get_clog(clog_url)
-
-        if clogs_seen >= MAX_TIPFILL_CLOGS:
+        for nodes_cset in chain([first_clog_entry], walk):
+            if csets_found >= MAX_TIPFILL_CLOGS * CHANGESETS_PER_CLOG:
+                break
+            if not csets_to_gather:
+                if nodes_cset == newest_known_rev:
+                    found_newest_known = True
+                    break
+            else:
+                if csets_found >= csets_to_gather:
+                    found_newest_known = True
+                    break
+            csets_found += 1
+            csets_to_add.append(nodes_cset)
+
+        if not found_newest_known:
             Log.error(
                 "Too many changesets, can't find last tip or the number is too high: {{rev}}. "
                 "Maximum possible to request is {{maxnum}}",
@@ -550,27 +646,30 @@ class Clogger:
     def fill_forward_continuous(self, please_stop=None):
         while not please_stop:
             try:
+                # Replaced before the update, so a push that lands during it
+                # fires the signal waited on below, and starts another pass
+                tip_signal = self.tip_signal = Signal(name="Clogger.tip_signal")
                 while not please_stop and not self.disable_tipfilling and self.update_tip():
                     pass
-                (please_stop | Till(seconds=CSET_TIP_WAIT_TIME)).wait()
+                (please_stop | tip_signal | Till(seconds=CSET_TIP_WAIT_TIME)).wait()
             except Exception as e:
                 Log.warning("Unknown error occurred during tip filling:", cause=e)
 
     def get_old_cset_revnum(self, revision):
+        # Register before the request, so the backfill can not finish unseen
+        done = self._backfill_signal(revision)
         self.csets_todo_backwards.add((revision, True))
 
-        revnum = None
         timeout = Till(seconds=BACKFILL_REVNUM_TIMEOUT)
-        while not timeout:
+        revnum = self._get_one_revnum(revision)
+        while revnum == None and not timeout:
+            if done:
+                Log.error("Backfill could not find revision {{rev}}", rev=revision)
+            Log.note("Waiting for backfill of {{rev}} to complete...", rev=revision)
+            (done | timeout).wait()
             revnum = self._get_one_revnum(revision)
 
-            if revnum != None:
-                break
-            else:
-                Log.note("Waiting for backfill to complete...")
-            Till(seconds=CSET_BACKFILL_WAIT_TIME).wait()
-
-        if timeout:
+        if revnum == None:
             Log.error(
                 "Cannot find revision {{rev}} after waiting {{timeout}} seconds",
                 rev=revision,
@@ -604,7 +703,8 @@ class Clogger:
     def caching_daemon(self, please_stop=None):
         """
         This daemon caches the annotations for the files available
-        in the LatestFileMod to tip of csetLog table
+        in the LatestFileMod to tip of csetLog table. The most requested
+        files go first; files nobody asked for lately are left alone.
         """
         while not please_stop:
             try:
@@ -618,34 +718,215 @@ class Clogger:
                 if self.caching_signal._go == False or self.disable_caching:
                     continue
 
+                self.tuid_service.save_heat()
+
                 # Get current tip
                 tip_revision = self.get_tip()[1]
                 with self.conn.transaction() as t:
                     files_to_update = t.get(
-                        "SELECT file FROM latestFileMod WHERE revision != ? limit 1000",
-                        (tip_revision),
+                        "SELECT file FROM latestFileMod WHERE revision != ?", (tip_revision,)
                     )
+                files_to_update = self.tuid_service.heat.hottest(
+                    [f[0] for f in files_to_update], min_heat=CACHE_MIN_HEAT, limit=CACHE_MAX_FILES
+                )
 
-                for _, fs in jx.chunk(files_to_update, size=CACHING_BATCH_SIZE):
+                for _, files in jx.chunk(files_to_update, size=CACHING_BATCH_SIZE):
                     if self.caching_signal._go == False:
                         break
-                    files = [f[0] for f in fs]
+                    files = list(files)
                     # Update file to the tip revision
                     self.tuid_service.get_tuids_from_files(files, tip_revision, etl=False)
             except Exception as e:
                 Log.warning("Unknown error occurred during caching: ", cause=e)
 
+    def maintenance_worker(self, please_stop=None):
+        """
+        Ages out the non-permanent changesets at the tail of the csetLog, and
+        the annotations nobody needs any more. Runs every
+        CSET_MAINTENANCE_WAIT_TIME seconds, or sooner when the csetLog grows
+        past SIGNAL_MAINTENANCE_CSETS.
+        """
+        while not please_stop:
+            try:
+                (
+                    please_stop
+                    | self.maintenance_signal
+                    | Till(seconds=CSET_MAINTENANCE_WAIT_TIME)
+                ).wait()
+                if please_stop:
+                    break
+                self.maintenance_signal = Signal(name="Clogger.maintenance_signal")
+                if self.disable_maintenance:
+                    continue
+
+                self._delete_old_csets(please_stop)
+                self._drop_old_annotations(please_stop)
+            except Exception as e:
+                Log.warning("Unknown error occurred during maintenance: ", cause=e)
+
+    def _delete_old_csets(self, please_stop):
+        """
+        Delete the non-permanent changesets at the tail that are older than
+        TIME_TO_KEEP_ANNOTATIONS, or, beyond MAXIMUM_NONPERMANENT_CSETS, older
+        than RECENT_CSETS_TIME. Only the tail is cut, so the revnums left stay
+        contiguous.
+        """
+        tail = self.csetlog.get_timestamps(below=self._min_permanent_revnum())
+        num_to_delete = _num_to_delete([timestamp for _, timestamp in tail], time.time())
+        if not num_to_delete:
+            return
+
+        Log.note("Deleting {{num}} old changesets from the csetLog", num=num_to_delete)
+        for start in range(0, num_to_delete, DELETION_BATCH_SIZE):
+            if please_stop:
+                return
+            # Lowest first, so an interrupted run still leaves a contiguous csetLog
+            last, _ = tail[min(start + DELETION_BATCH_SIZE, num_to_delete) - 1]
+            with self.working_locker:
+                self.csetlog.delete_to(last)
+            self.csets_deleted += min(DELETION_BATCH_SIZE, num_to_delete - start)
+            (please_stop | Till(seconds=CSET_DELETION_WAIT_TIME)).wait()
+
+    def _min_permanent_revnum(self):
+        return coalesce(self.csetlog.min_permanent_revnum(), self.get_revnum_stats("max") + 1)
+
+    def _drop_old_annotations(self, please_stop):
+        """
+        Drop the partitions of the annotations index that were written more
+        than TIME_TO_KEEP_ANNOTATIONS ago. The annotations in them that are
+        still needed, the ones at a latestFileMod frontier and the snapshots
+        that newer annotations are stored as deltas against, are first copied
+        in full to the newest partition. With many workers (see tuid.workers),
+        each copies what the files it owns need, and the last to finish drops
+        the partition.
+        """
+        annotations = self.tuid_service.annotations
+        workers = self.tuid_service.workers
+        if workers:
+            annotations.reload()
+        old = annotations.old_partitions(Date.now() - TIME_TO_KEEP_ANNOTATIONS)
+        if not old:
+            return
+        with self.conn.transaction() as t:
+            frontiers = set(
+                (file, revision)
+                for file, revision in t.get("SELECT file, revision FROM latestFileMod")
+            )
+        before = self._index_size(annotations)
+
+        for partition in old:
+            name = partition.settings.index
+            if workers and workers.has_carried(name):
+                # The last worker to carry it forward drops it
+                continue
+            kept = 0
+            after = None
+            while not please_stop:
+                query = {
+                    "_source": {"includes": ["revision", "file"]},
+                    "sort": [{"revision": {"order": "asc"}}, {"file": {"order": "asc"}}],
+                    "size": DELETION_BATCH_SIZE,
+                }
+                if after:
+                    query["search_after"] = after
+                hits = partition.search(query).hits.hits
+                if not hits:
+                    break
+                after = hits.last().sort
+                keys = [(h._source.revision, h._source.file) for h in hits]
+                if workers:
+                    # Each worker keeps what the files it owns need
+                    keys = [(rev, file) for rev, file in keys if workers.owns(file)]
+                    if not keys:
+                        continue
+
+                # Snapshots used by deltas in the other partitions
+                revisions = list(set(rev for rev, _ in keys))
+                files = list(set(file for _, file in keys))
+                query = {
+                    "size": 0,
+                    "query": {
+                        "bool": {
+                            "must": [
+                                {"terms": {"base": revisions}},
+                                {"terms": {"file": files}},
+                            ],
+                            "must_not": {"term": {"_index": name}},
+                        }
+                    },
+                    "aggs": {
+                        "base": {
+                            "terms": {"field": "base", "size": len(revisions)},
+                            "aggs": {"file": {"terms": {"field": "file", "size": len(files)}}},
+                        }
+                    },
+                }
+                in_use = set(
+                    (base.key, file.key)
+                    for base in annotations.search(query).aggregations.base.buckets
+                    for file in base.file.buckets
+                )
+                needed = [
+                    (rev, file)
+                    for rev, file in keys
+                    if (file, rev) in frontiers or (rev, file) in in_use
+                ]
+                if not needed:
+                    continue
+                copies = self.tuid_service._get_annotations(needed)
+                self.tuid_service.insert_annotations(
+                    [(rev, file, annotation) for (rev, file), annotation in copies.items()]
+                )
+                kept += len(copies)
+            if please_stop:
+                return
+
+            # The copies must be written before the partition goes
+            self.tuid_service.annotation_writer.flush()
+            if workers and not workers.carried(name):
+                Log.note("Carried {{index}} forward, kept {{kept}}", index=name, kept=kept)
+                continue
+            total = partition.search({"size": 0}).hits.total
+            annotations.drop(partition)
+            self.annotations_deleted += total - kept
+            Log.note(
+                "Dropped {{index}}, with {{num}} old annotations, kept {{kept}} still in use",
+                index=name,
+                num=total,
+                kept=kept,
+            )
+            (please_stop | Till(seconds=CSET_DELETION_WAIT_TIME)).wait()
+
+        Log.note(
+            "Annotations index went from {{before}} to {{after}} bytes",
+            before=before,
+            after=self._index_size(annotations),
+        )
+
+    def _index_size(self, index):
+        # Deleted documents only free their space once Elasticsearch merges segments
+        try:
+            stats = index.cluster.get("/" + index.settings.index + "/_stats/store")
+            return stats._all.primaries.store.size_in_bytes
+        except Exception as e:
+            Log.warning("Can not get size of {{index}}", index=index.settings.index, cause=e)
+            return None
+
 
-CSETLOG_SCHEMA = {
-    "settings": {"index.number_of_replicas": 1, "index.number_of_shards": 1},
-    "mappings": {
-        "csetlogtype": {
-            "_all": {"enabled": False},
-            "properties": {
-                "revnum": {"type": "integer", "store": True},
-                "revision": {"type": "keyword", "store": True},
-                "timestamp": {"type": "integer", "store": True},
-            },
-        }
-    },
-}
+def _num_to_delete(timestamps, now):
+    """
+    A backfill adds rows below the tail, so the lowest revnums are often the
+    newest rows. The tail is cut only up to the first row that is not old
+    enough, so a recent backfill is kept, along with the older rows above it.
+
+    :param timestamps: when each non-permanent row was added, by revnum
+    :param now: seconds since epoch
+    :return: the number of rows to delete from the start of the tail
+    """
+    too_old = now - TIME_TO_KEEP_ANNOTATIONS.seconds
+    recent = now - RECENT_CSETS_TIME
+    too_many = len(timestamps) - MAXIMUM_NONPERMANENT_CSETS
+    for num, timestamp in enumerate(timestamps):
+        if timestamp >= too_old and (num >= too_many or timestamp >= recent):
+            return num
+    return len(timestamps)
@@ -9,7 +9,7 @@ from __future__ import division
 from __future__ import unicode_literals
 
 from mo_logs import Log
-from mo_threads import Lock
+from mo_threads import Lock, Signal
 
 
 class Counter(object):
@@ -20,11 +20,52 @@ class Counter(object):
 
     with my_counter:
         # my_counter is incremented in this context
+
+    Every change wakes the threads in `wait_for()` and `acquire()`, so they
+    do not have to poll the value.
     """
 
     def __init__(self):
         self.locker = Lock()
         self.value = 0
+        self.changed = Signal()
+
+    def add(self, amount):
+        with self.locker:
+            self.value += amount
+            changed, self.changed = self.changed, Signal()
+        changed.go()
+
+    def wait_for(self, condition, till=None):
+        """
+        :param condition: function of the value
+        :param till: signal to stop waiting
+        :return: True when condition(value) holds, False if till came first
+        """
+        while True:
+            with self.locker:
+                if condition(self.value):
+                    return True
+                changed = self.changed
+            if till:
+                return False
+            (changed | till).wait()
+
+    def acquire(self, limit, till=None):
+        """
+        Increment, once the value is below limit; `add(-1)` to release
+        :param till: signal to stop waiting
+        :return: True if incremented, False if till came first
+        """
+        while True:
+            with self.locker:
+                if self.value < limit:
+                    self.value += 1
+                    return True
+                changed = self.changed
+            if till:
+                return False
+            (changed | till).wait()
 
     def __call__(self, num):
         """
@@ -41,13 +82,11 @@ class Counter(object):
         return ManyCounter(self, num)
 
     def __enter__(self):
-        with self.locker:
-            self.value += 1
+        self.add(1)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        with self.locker:
-            self.value -= 1
+        self.add(-1)
 
 
 class ManyCounter(object):
@@ -60,13 +99,11 @@ class ManyCounter(object):
         self.increment = increment
 
     def __enter__(self):
-        with self.parent.locker:
-            self.parent.value += self.increment
+        self.parent.add(self.increment)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        with self.parent.locker:
-            self.parent.value -= self.increment
+        self.parent.add(-self.increment)
 
 
 class Semaphore(object):
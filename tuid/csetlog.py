@@ -0,0 +1,279 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+The changesets the Clogger knows, as (revnum, revision, timestamp) rows.
+revnum counts up towards tip, revision is 12 characters, and timestamp is
+when a non-permanent row was added, or -1 for a permanent one.
+
+ElasticsearchCsetLog and SqliteCsetLog keep them, and both offer:
+
+    count()                      number of rows
+    get_revnum_stats(query)      the "min" or "max" revnum, 0 if there are none
+    get_tip(), get_tail()        (revnum, revision) with the largest, or smallest, revnum
+    get_revnums(revisions)       map from revision to revnum, for the revisions found
+    has_revnum(revnum)           True if there is a row with the revnum
+    get_range(low, high)         list of (revnum, revision) with low <= revnum <= high
+    get_timestamps(below)        list of (revnum, timestamp) with revnum < below, by revnum
+    min_permanent_revnum()       smallest revnum of a permanent row, None if there are none
+    add(rows)                    add (revnum, revision, timestamp) rows, replacing any
+                                 with the same revnum
+    delete_to(revnum)            delete the rows with revnum <= the given one
+    delete_all()                 delete all rows
+    refresh()                    make the rows added so far visible to queries
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from jx_elasticsearch import elasticsearch
+from jx_sqlite.sqlite import quote_list
+from mo_dots import coalesce, set_default, wrap
+from mo_logs import Log
+from mo_logs.exceptions import suppress_exception
+from mo_sql import sql_list
+from tuid.util import delete, insert
+
+SQL_CSET_BATCH_SIZE = 500  # rows in one INSERT
+ES_PAGE_SIZE = 1000  # documents in one search, well below index.max_result_window
+
+
+class ElasticsearchCsetLog(object):
+    """
+    The csetLog in an Elasticsearch index, one document per changeset
+    """
+
+    def __init__(self, new_table=False, kwargs=None):
+        self.es = elasticsearch.Cluster(kwargs=kwargs)
+        if new_table:
+            try:
+                index = self.es.get_canonical_index(kwargs.index)
+                self.es.delete_index(index)
+            except Exception as e:
+                Log.warning(
+                    "could not delete csetlog index because (mostly index has not yet created): {{cause}}",
+                    cause=str(e),
+                )
+
+        set_default(kwargs, {"schema": CSETLOG_SCHEMA})
+        self.index = self.es.get_or_create_index(kwargs=kwargs)
+        self.index.refresh()
+
+        total = self.index.search({"size": 0})
+        while not total.hits:
+            total = self.index.search({"size": 0})
+        with suppress_exception:
+            self.index.add_alias()
+
+    def count(self):
+        query = {"aggs": {"output": {"value_count": {"field": "revnum"}}}, "size": 0}
+        return int(self.index.search(query).aggregations.output.value)
+
+    def get_revnum_stats(self, query_required):
+        query = {"size": 0, "aggs": {"value": {query_required: {"field": "revnum"}}}}
+        return int(coalesce(self.index.search(query).aggregations.value.value, 0))
+
+    def get_tip(self):
+        return self._get_end("desc")
+
+    def get_tail(self):
+        return self._get_end("asc")
+
+    def _get_end(self, order):
+        query = {
+            "_source": {"includes": ["revision"]},
+            "sort": [{"revnum": {"order": order}}],
+            "size": 1,
+        }
+        hit = self.index.search(query).hits.hits[0]
+        return hit.sort[0], hit._source.revision
+
+    def get_revnums(self, revisions):
+        if not revisions:
+            return {}
+        query = {
+            "_source": {"includes": ["revision", "revnum"]},
+            "query": {"terms": {"revision": revisions}},
+            "size": len(revisions),
+        }
+        return {h._source.revision: h._source.revnum for h in self.index.search(query).hits.hits}
+
+    def has_revnum(self, revnum):
+        query = {"size": 0, "query": {"term": {"revnum": revnum}}}
+        return self.index.search(query).hits.total > 0
+
+    def get_range(self, low, high):
+        return self._scan({"range": {"revnum": {"gte": low, "lte": high}}}, "revision")
+
+    def get_timestamps(self, below):
+        return self._scan({"range": {"revnum": {"lt": below}}}, "timestamp")
+
+    def _scan(self, filter, field):
+        """
+        Page through the matching rows by revnum, since a single search
+        can not return more than index.max_result_window of them
+        :return: list of (revnum, field), by revnum
+        """
+        output = []
+        after = None
+        while True:
+            query = {
+                "_source": {"includes": ["revnum", field]},
+                "query": filter,
+                "sort": [{"revnum": {"order": "asc"}}],
+                "size": ES_PAGE_SIZE,
+            }
+            if after:
+                query["search_after"] = after
+            hits = self.index.search(query).hits.hits
+            if not hits:
+                return output
+            output.extend((h._source.revnum, h._source[field]) for h in hits)
+            after = hits.last().sort
+
+    def min_permanent_revnum(self):
+        query = {
+            "size": 0,
+            "query": {"term": {"timestamp": -1}},
+            "aggs": {"value": {"min": {"field": "revnum"}}},
+        }
+        value = self.index.search(query).aggregations.value.value
+        return None if value == None else int(value)
+
+    def add(self, rows):
+        records = wrap(
+            [
+                {
+                    "value": {
+                        "_id": revnum,
+                        "revnum": revnum,
+                        "revision": revision,
+                        "timestamp": timestamp,
+                    }
+                }
+                for revnum, revision, timestamp in rows
+            ]
+        )
+        insert(self.index, records)
+
+    def delete_to(self, revnum):
+        delete(self.index, {"range": {"revnum": {"lte": revnum}}})
+
+    def delete_all(self):
+        delete(self.index, {"match_all": {}})
+
+    def refresh(self):
+        self.index.refresh()
+
+
+class SqliteCsetLog(object):
+    """
+    The csetLog in a table of the service's sqlite database. Every lookup is
+    a local query on an index, and an added row is seen at once.
+    """
+
+    def __init__(self, conn, new_table=False):
+        self.conn = conn
+        with self.conn.transaction() as t:
+            if new_table:
+                t.execute("DROP TABLE IF EXISTS csetLog")
+            t.execute(
+                """
+            CREATE TABLE IF NOT EXISTS csetLog (
+                revnum         INTEGER PRIMARY KEY,
+                revision       CHAR(12) NOT NULL UNIQUE,
+                timestamp      INTEGER
+            );"""
+            )
+
+    def count(self):
+        return self.conn.get_one("SELECT COUNT(*) FROM csetLog")[0]
+
+    def get_revnum_stats(self, query_required):
+        if query_required not in ("min", "max"):
+            Log.error("Expecting min or max, not {{query}}", query=query_required)
+        return coalesce(
+            self.conn.get_one("SELECT " + query_required + "(revnum) FROM csetLog")[0], 0
+        )
+
+    def get_tip(self):
+        return self._get_end("DESC")
+
+    def get_tail(self):
+        return self._get_end("ASC")
+
+    def _get_end(self, order):
+        rows = self.conn.get(
+            "SELECT revnum, revision FROM csetLog ORDER BY revnum " + order + " LIMIT 1"
+        )
+        return tuple(rows[0]) if rows else (None, None)
+
+    def get_revnums(self, revisions):
+        if not revisions:
+            return {}
+        rows = self.conn.get(
+            "SELECT revision, revnum FROM csetLog WHERE revision IN " + quote_list(revisions)
+        )
+        return {revision: revnum for revision, revnum in rows}
+
+    def has_revnum(self, revnum):
+        return bool(self.conn.get("SELECT 1 FROM csetLog WHERE revnum=?", (revnum,)))
+
+    def get_range(self, low, high):
+        return [
+            tuple(r)
+            for r in self.conn.get(
+                "SELECT revnum, revision FROM csetLog WHERE revnum>=? AND revnum<=?",
+                (low, high),
+            )
+        ]
+
+    def get_timestamps(self, below):
+        return [
+            tuple(r)
+            for r in self.conn.get(
+                "SELECT revnum, timestamp FROM csetLog WHERE revnum<? ORDER BY revnum",
+                (below,),
+            )
+        ]
+
+    def min_permanent_revnum(self):
+        return self.conn.get_one("SELECT MIN(revnum) FROM csetLog WHERE timestamp=-1")[0]
+
+    def add(self, rows):
+        with self.conn.transaction() as t:
+            for start in range(0, len(rows), SQL_CSET_BATCH_SIZE):
+                t.execute(
+                    "INSERT OR REPLACE INTO csetLog (revnum, revision, timestamp) VALUES "
+                    + sql_list(quote_list(r) for r in rows[start : start + SQL_CSET_BATCH_SIZE])
+                )
+
+    def delete_to(self, revnum):
+        with self.conn.transaction() as t:
+            t.execute("DELETE FROM csetLog WHERE revnum<=?", (revnum,))
+
+    def delete_all(self):
+        with self.conn.transaction() as t:
+            t.execute("DELETE FROM csetLog")
+
+    def refresh(self):
+        # Added rows are seen at once
+        pass
+
+
+CSETLOG_SCHEMA = {
+    "settings": {"index.number_of_replicas": 1, "index.number_of_shards": 1},
+    "mappings": {
+        "csetlogtype": {
+            "_all": {"enabled": False},
+            "properties": {
+                "revnum": {"type": "integer", "store": True},
+                "revision": {"type": "keyword", "store": True},
+                "timestamp": {"type": "integer", "store": True},
+            },
+        }
+    },
+}
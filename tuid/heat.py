@@ -0,0 +1,89 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from time import time
+
+from mo_threads import Lock
+from mo_times.durations import DAY
+
+HALF_LIFE = DAY.seconds  # seconds for the heat of a file to halve
+FORGET_HEAT = 0.01  # files colder than this are dropped
+
+
+class FileHeat(object):
+    """
+    How often, and how recently, each file was requested. Every request adds
+    one to the heat of its files, and the heat halves every HALF_LIFE seconds,
+    so a file asked for on every coverage run stays hot and a file asked for
+    once fades away.
+    """
+
+    def __init__(self, half_life=HALF_LIFE):
+        self.half_life = half_life
+        self.locker = Lock()
+        self.heat = {}  # file -> (heat, time of that heat)
+
+    def _decay(self, heat, then, now):
+        return heat * 0.5 ** ((now - then) / self.half_life)
+
+    def add(self, files, now=None):
+        now = time() if now is None else now
+        with self.locker:
+            for file in files:
+                file = file.lstrip("/")
+                heat, then = self.heat.get(file, (0, now))
+                self.heat[file] = (self._decay(heat, then, now) + 1, now)
+
+    def get(self, file, now=None):
+        now = time() if now is None else now
+        with self.locker:
+            heat, then = self.heat.get(file.lstrip("/"), (0, now))
+        return self._decay(heat, then, now)
+
+    def hottest(self, files, min_heat=0, limit=None, now=None):
+        """
+        :param files: files to choose from
+        :param min_heat: files colder than this are left out
+        :param limit: maximum number of files to return
+        :return: files, hottest first
+        """
+        now = time() if now is None else now
+        with self.locker:
+            # Forget the files that went cold, so the table does not grow forever
+            for file, (heat, then) in list(self.heat.items()):
+                if self._decay(heat, then, now) < FORGET_HEAT:
+                    del self.heat[file]
+
+            scored = []
+            for file in files:
+                heat, then = self.heat.get(file.lstrip("/"), (0, now))
+                heat = self._decay(heat, then, now)
+                if heat > 0 and heat >= min_heat:
+                    scored.append((heat, file))
+        scored.sort(key=lambda s: -s[0])
+        return [file for _, file in scored[:limit]]
+
+    def snapshot(self):
+        """
+        :return: list of (file, heat, time of that heat), to keep across restarts
+        """
+        with self.locker:
+            return [(file, heat, then) for file, (heat, then) in self.heat.items()]
+
+    def restore(self, rows):
+        """
+        :param rows: list of (file, heat, time of that heat), from snapshot()
+        """
+        with self.locker:
+            for file, heat, then in rows:
+                self.heat[file] = (heat, then)
+
+    def __len__(self):
+        return len(self.heat)
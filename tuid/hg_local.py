@@ -0,0 +1,205 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import struct
+import subprocess
+
+from mo_dots import coalesce, wrap
+from mo_hg.parse import stream_lines, stream_to_moves
+from mo_json import json2value
+from mo_kwargs import override
+from mo_logs import Log
+from mo_threads import Queue
+
+DEBUG = False
+LOCAL_HG_PROCESSES = 4  # command servers, so annotations can run in parallel
+CHANGESETS_PER_CLOG = 20  # changesets, same page size as the hg.mozilla.org json-log
+FILES_TEMPLATE = '{files % "{file}\\n"}'
+
+
+class CommandServer(object):
+    """
+    One `hg serve --cmdserver pipe` process, see
+    https://www.mercurial-scm.org/wiki/CommandServer
+    Not thread safe; `LocalHg` hands each one to a single thread at a time.
+    """
+
+    def __init__(self, executable, source):
+        self.executable = executable
+        self.source = source
+        self.process = None
+        self._start()
+
+    def _start(self):
+        env = dict(os.environ)
+        env[str("HGPLAIN")] = str("1")
+        env[str("HGENCODING")] = str("UTF-8")
+        self.process = subprocess.Popen(
+            [self.executable, "serve", "--cmdserver", "pipe", "--config", "ui.interactive=False"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.source,
+            env=env,
+        )
+        channel, hello = self._read_channel()
+        if channel != b"o" or b"runcommand" not in hello:
+            Log.error("Unexpected greeting from hg command server: {{hello}}", hello=hello)
+
+    def _read_channel(self):
+        header = self.process.stdout.read(5)
+        if len(header) < 5:
+            Log.error("hg command server closed the connection")
+        channel, length = struct.unpack(str(">cI"), header)
+        if channel in (b"I", b"L"):
+            # INPUT REQUEST, length IS THE MAXIMUM SIZE WANTED
+            return channel, length
+        return channel, self.process.stdout.read(length)
+
+    def run(self, args):
+        """
+        :param args: hg command line, without the executable
+        :return: (return code, stdout bytes, stderr bytes)
+        """
+        if self.process.poll() is not None:
+            Log.note("Restarting hg command server for {{source}}", source=self.source)
+            self._start()
+
+        data = b"\0".join(a.encode("utf8") for a in args)
+        self.process.stdin.write(b"runcommand\n" + struct.pack(str(">I"), len(data)) + data)
+        self.process.stdin.flush()
+
+        output = []
+        error = []
+        while True:
+            channel, value = self._read_channel()
+            if channel == b"o":
+                output.append(value)
+            elif channel == b"e":
+                error.append(value)
+            elif channel == b"r":
+                return struct.unpack(str(">i"), value)[0], b"".join(output), b"".join(error)
+            elif channel in (b"I", b"L"):
+                # WE NEVER HAVE INPUT
+                self.process.stdin.write(struct.pack(str(">I"), 0))
+                self.process.stdin.flush()
+            elif channel.isupper():
+                Log.error("Unexpected required hg channel {{channel}}", channel=channel)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+
+class LocalHg(object):
+    """
+    Answers the hg.mozilla.org requests the service makes (json-log pages,
+    changeset diffs, file line counts) from a local clone of the branch.
+    """
+
+    @override
+    def __init__(self, local_hg_source, hg_for_building=None, kwargs=None):
+        self.source = local_hg_source
+        self.executable = coalesce(hg_for_building, "hg")
+        self.servers = Queue("local hg command servers")
+        self.all_servers = []
+        for _ in range(LOCAL_HG_PROCESSES):
+            server = CommandServer(self.executable, self.source)
+            self.all_servers.append(server)
+            self.servers.add(server)
+        Log.note(
+            "Using local hg clone at {{source}} ({{num}} command servers)",
+            source=self.source,
+            num=LOCAL_HG_PROCESSES,
+        )
+
+    def _hg(self, *args):
+        server = self.servers.pop()
+        try:
+            if DEBUG:
+                Log.note("hg {{args|join(' ')}}", args=args)
+            return server.run(args)
+        finally:
+            self.servers.add(server)
+
+    def _hg_output(self, *args):
+        code, output, error = self._hg(*args)
+        if code:
+            Log.error(
+                "hg {{args|join(' ')}} failed: {{error}}",
+                args=args,
+                error=error.decode("utf8", "replace"),
+            )
+        return output
+
+    def has_revision(self, revision):
+        code, _, _ = self._hg("log", "-r", revision, "-T", "{node}")
+        return code == 0
+
+    def get_clog(self, revision, limit=CHANGESETS_PER_CLOG):
+        """
+        :param revision: newest changeset of the page ("tip" is allowed)
+        :param limit: number of changesets in the page
+        :return: json-log page, newest first, starting at revision
+        """
+        output = self._hg_output(
+            "log",
+            "-r",
+            "reverse(:" + revision + ")",
+            "-l",
+            str(limit),
+            "-T",
+            "json",  # SAME FIELDS AS THE hg.mozilla.org json-log
+        )
+        changesets = json2value(output.decode("utf8"))
+        return wrap({"node": changesets[0].node, "changesets": changesets})
+
+    def get_diff(self, revision, files=None):
+        """
+        :param files: optional set of file names wanted, see `stream_moves`
+        :return: (moves, description) for the changeset, moves as given by
+                 `diff_to_moves` on the hg.mozilla.org raw-rev
+        """
+        description = self._hg_output("log", "-r", revision, "-T", "{desc}").decode("utf8")
+        raw_diff = self._hg_output("export", "--git", "-r", revision)
+        return stream_to_moves(stream_lines([raw_diff]), files), description
+
+    def get_files(self, revision):
+        """
+        :return: files touched by the changeset
+        """
+        output = self._hg_output("log", "-r", revision, "-T", FILES_TEMPLATE)
+        return [f for f in output.decode("utf8").split("\n") if f]
+
+    def get_line_count(self, revision, file):
+        """
+        :return: number of lines in file at revision, or None if it does not exist
+        """
+        code, output, error = self._hg("cat", "-r", revision, file)
+        if code:
+            return None
+        return len(output.splitlines())
+
+    def pull(self):
+        """
+        Bring the clone up to date with its default path
+        """
+        code, _, error = self._hg("pull")
+        if code:
+            Log.warning(
+                "Could not pull into {{source}}: {{error}}",
+                source=self.source,
+                error=error.decode("utf8", "replace"),
+            )
+
+    def stop(self):
+        for server in self.all_servers:
+            server.stop()
@@ -0,0 +1,134 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+
+from mo_dots import listwrap, set_default, wrap
+from mo_json import json2value
+from mo_kwargs import override
+from mo_logs import Log
+from mo_threads import Queue, Thread, Till
+
+PUSH_FILE_WAIT = 1  # seconds between looks at the push file
+PUSH_TIP_TIMEOUT = 60  # seconds to wait for the tip update that brings a push
+
+
+class PushListener(object):
+    """
+    Wakes the Clogger's tip update as soon as a push lands on the main branch,
+    instead of at the next CSET_TIP_WAIT_TIME poll, then reads the diffs of
+    the pushed changesets, so the first requests for them find them in the
+    hg_cache.
+
+    Pushes come from hg.mozilla.org's Pulse exchange (exchange/hgpushes/v2),
+    or, for testing, from a file with one push message per line, or add().
+    """
+
+    @override
+    def __init__(self, clogger, pulse=None, file=None, kwargs=None):
+        self.clogger = clogger
+        self.branch = clogger.config.hg.branch
+        self.queue = Queue(name="PushListener.queue")
+        self.received = 0  # pushes to the main branch seen
+        self.consumer = None
+        self.file_thread = None
+
+        if pulse:
+            # Needs kombu and mozillapulse, so only imported when used
+            from pyLibrary.env.pulse import Consumer
+
+            set_default(pulse, {"exchange": "exchange/hgpushes/v2", "topic": self.branch})
+            self.consumer = Consumer(target_queue=self.queue, kwargs=pulse)
+        if file:
+            self.file_thread = Thread.run("push file", self._read_file, file)
+        self.thread = Thread.run("push listener", self._worker)
+
+    def add(self, message):
+        """
+        :param message: a push message, as sent to exchange/hgpushes/v2
+        """
+        self.queue.add(message)
+
+    def _read_file(self, filename, please_stop):
+        # Follows the file like `tail -f`, starting at its end
+        position = os.path.getsize(filename) if os.path.exists(filename) else 0
+        while not please_stop:
+            (please_stop | Till(seconds=PUSH_FILE_WAIT)).wait()
+            if not os.path.exists(filename) or os.path.getsize(filename) <= position:
+                continue
+            with open(filename, "rb") as f:
+                f.seek(position)
+                lines = f.read().decode("utf8").split("\n")
+            # A last line without its newline is read again next time
+            for line in lines[:-1]:
+                position += len((line + "\n").encode("utf8"))
+                if line.strip():
+                    try:
+                        self.add(json2value(line))
+                    except Exception as e:
+                        Log.warning("Can not read push {{line|quote}}", line=line, cause=e)
+
+    def _heads(self, message):
+        """
+        :return: the 12 character head revisions of a push to the main branch
+        """
+        payload = wrap(message).payload
+        if payload.type != "changegroup.1":
+            return []
+        if not payload.data.repo_url.rstrip("/").endswith("/" + self.branch):
+            return []
+        return [h[:12] for h in listwrap(payload.data.heads)]
+
+    def _worker(self, please_stop):
+        while not please_stop:
+            try:
+                message = self.queue.pop(till=please_stop)
+                if please_stop:
+                    break
+                pushed = [self._heads(m) for m in [message] + self.queue.pop_all() if m]
+                heads = set(h for p in pushed for h in p)
+                if not heads:
+                    continue
+                self.received += len([p for p in pushed if p])
+
+                tip_revnum, _ = self.clogger.get_tip()
+                known = self.clogger.get_revnums(list(heads))
+                missing = [h for h in heads if h not in known]
+                if not missing:
+                    continue
+                Log.note("Push of {{heads}}, updating the tip", heads=missing)
+
+                # Fired when a head is added to the csetLog
+                done = [(h, self.clogger._backfill_signal(h)) for h in missing]
+                self.clogger.tip_signal.go()
+                timeout = Till(seconds=PUSH_TIP_TIMEOUT)
+                for h, d in done:
+                    (d | timeout | please_stop).wait()
+                    if not d:
+                        # The tip update did not bring it, stop waiting for it
+                        self.clogger._backfill_forget(h, d)
+
+                self._warm_diffs(tip_revnum)
+            except Exception as e:
+                Log.warning("Unknown error occurred while handling a push", cause=e)
+
+    def _warm_diffs(self, old_tip_revnum):
+        # Diffs are only kept by the hg_cache; the local clone needs no warming
+        service = self.clogger.tuid_service
+        if not service.hg_cache or service.local_hg:
+            return
+        tip_revnum, _ = self.clogger.get_tip()
+        if old_tip_revnum == None or tip_revnum == None or tip_revnum <= old_tip_revnum:
+            return
+        for _, revision in sorted(self.clogger._get_revnum_range(old_tip_revnum + 1, tip_revnum)):
+            try:
+                service._get_hg_diff(revision)
+            except Exception as e:
+                Log.warning("Can not get diff of {{rev}}", rev=revision, cause=e)
@@ -0,0 +1,216 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_http import http
+from mo_json import json2value
+from mo_logs import Log
+from mo_threads import Thread
+from tuid.util import TuidMap
+
+PEER_TIMEOUT = 60  # seconds to wait for another worker to answer
+FORWARDED_HEADER = "X-TUID-Forwarded"  # marks a request sent by another worker
+
+
+class Router(object):
+    """
+    In a multi-process deployment (see tuid.workers), sends each file of a
+    request to the worker that owns it, and each tuid to the worker that made
+    it, then puts the answers back together. The files this worker owns go to
+    the Batcher. A forwarded request is answered by the worker it was sent
+    to, without being routed again.
+
+    Offers the lookups of the Batcher and TUIDService that the app uses.
+    """
+
+    def __init__(self, service, batcher):
+        self.service = service
+        self.batcher = batcher
+        self.workers = service.workers
+        self.forwarded = 0  # requests sent to other workers
+
+    def get_tuids_from_files(self, files, revision, repo=None):
+        """
+        Same as Batcher.get_tuids_from_files(files, revision, repo=repo)
+        """
+        files = [f.lstrip("/") for f in files]
+        parts = _split(files, self.workers.owner)
+        local = parts.pop(self.workers.process_num, [])
+        threads = [
+            Thread.run(
+                "forward to worker " + str(k),
+                self._forward,
+                k,
+                "files",
+                _where(repo, revision, {"path": paths}),
+            )
+            for k, paths in parts.items()
+        ]
+
+        found, completed = {}, True
+        if local:
+            self.service.heat.add(local)
+            result, completed = self.batcher.get_tuids_from_files(local, revision, repo=repo)
+            found.update(result)
+        for data, peer_completed in _join(threads):
+            completed = completed and peer_completed
+            found.update((r.path, _to_tuid_maps(r.tuids)) for r in data)
+        return [(f, found[f]) for f in files if f in found], completed
+
+    def get_lines_from_tuids(self, tuids, revision, repo=None, forwarded=False):
+        """
+        Same as TUIDService.get_lines_from_tuids(tuids, revision, repo=repo).
+        The worker that made a tuid knows its file, and the owner of the file
+        knows its lines.
+        :param forwarded: True if the tuids were sent here by their maker
+        """
+        if forwarded:
+            parts = {self.workers.process_num: list(tuids)}
+        else:
+            parts = _split(tuids, self.workers.tuid_owner)
+        local = parts.pop(self.workers.process_num, [])
+        threads = [
+            Thread.run(
+                "forward to worker " + str(k),
+                self._forward,
+                k,
+                "tuids",
+                _where(repo, revision, {"tuid": some}),
+            )
+            for k, some in parts.items()
+        ]
+
+        found, completed = {}, True
+        if local:
+            result, completed = self.service.get_lines_from_tuids(
+                local, revision, repo=repo, lookup=self.get_tuids_from_files
+            )
+            found.update((tuid, (file, line)) for tuid, file, line in result)
+        for data, peer_completed in _join(threads):
+            completed = completed and peer_completed
+            found.update((r.tuid, (r.path, r.line)) for r in data)
+        return [(t,) + found.get(t, (None, None)) for t in tuids], completed
+
+    def get_tuids_from_revisions(self, groups):
+        """
+        Same as TUIDService.get_tuids_from_revisions(groups). The groups this
+        worker has files of are given as they are done, once the other
+        workers have answered.
+        """
+        local, remote = [], {}
+        for i, (branch, revision, paths) in enumerate(groups):
+            for k, some in _split(paths, self.workers.owner).items():
+                if k == self.workers.process_num:
+                    local.append((i, (branch, revision, some)))
+                else:
+                    remote.setdefault(k, []).append((i, (branch, revision, some)))
+        threads = [
+            Thread.run("forward to worker " + str(k), self._forward_groups, k, some_groups)
+            for k, some_groups in remote.items()
+        ]
+
+        answers = None
+        if local:
+            self.service.heat.add(path for _, (_, _, paths) in local for path in paths)
+            results = self.service.get_tuids_from_revisions([g for _, g in local])
+            for j, files, completed in results:
+                if answers is None:
+                    answers = _merge(_join(threads))
+                i = local[j][0]
+                more, more_completed = answers.pop(i, ([], True))
+                yield i, list(files) + more, completed and more_completed
+        if answers is None:
+            answers = _merge(_join(threads))
+        for i, (files, completed) in sorted(answers.items()):
+            yield i, files, completed
+
+    def _forward_groups(self, process_num, groups, please_stop=None):
+        """
+        :param groups: list of (index, (branch, revision, paths))
+        :return: map from index to (list of (file, list(tuids)), completed)
+        """
+        self.forwarded += 1
+        try:
+            data, _ = self._post(
+                process_num,
+                "files",
+                {"or": [_where(b, r, {"path": paths}) for _, (b, r, paths) in groups]},
+            )
+        except Exception as e:
+            Log.warning("Worker {{num}} did not answer", num=process_num, cause=e)
+            return {i: ([], False) for i, _ in groups}
+
+        answers = {i: ([], False) for i, _ in groups}
+        for g in data:
+            files = [(f.path, _to_tuid_maps(f.tuids)) for f in g.files]
+            answers[groups[g.group][0]] = (files, g.complete)
+        return answers
+
+    def _forward(self, process_num, table, where, please_stop=None):
+        """
+        :return: (records of the list response, completed)
+        """
+        self.forwarded += 1
+        try:
+            return self._post(process_num, table, where)
+        except Exception as e:
+            Log.warning("Worker {{num}} did not answer", num=process_num, cause=e)
+            return [], False
+
+    def _post(self, process_num, table, where):
+        response = http.post(
+            self.workers.peer_url(process_num),
+            json={"from": table, "where": where, "meta": {"format": "list"}},
+            headers={FORWARDED_HEADER: "1"},
+            zip=False,
+            timeout=PEER_TIMEOUT,
+        )
+        if response.status_code not in (200, 202):
+            Log.error(
+                "Worker {{num}} responded with {{status}}",
+                num=process_num,
+                status=response.status_code,
+            )
+        return json2value(response.all_content.decode("utf8")).data, response.status_code == 200
+
+
+def _split(items, owner):
+    """
+    :return: map from worker to the items it owns, in the order given
+    """
+    parts = {}
+    for item in items:
+        parts.setdefault(owner(item), []).append(item)
+    return parts
+
+
+def _where(branch, revision, values):
+    return {"and": [{"eq": {"branch": branch}}, {"eq": {"revision": revision}}, {"in": values}]}
+
+
+def _join(threads):
+    return [t.join() for t in threads]
+
+
+def _merge(answers):
+    """
+    :param answers: list of maps from group index to (files, completed)
+    :return: one map, with the files of each group put together
+    """
+    merged = {}
+    for answer in answers:
+        for i, (files, completed) in answer.items():
+            some, some_completed = merged.get(i, ([], True))
+            merged[i] = (some + files, some_completed and completed)
+    return merged
+
+
+def _to_tuid_maps(tuids):
+    # The inverse of map_to_array
+    return [TuidMap(tuid, line + 1) for line, tuid in enumerate(tuids) if tuid != None]
@@ -8,6 +8,7 @@ from __future__ import absolute_import, division, unicode_literals
 
 import copy
 import gc
+import time
 
 from jx_python import jx
 from jx_sqlite.sqlite import quote_list, quote_value
@@ -16,9 +17,9 @@ from mo_files.url import URL
 from mo_future import text
 from mo_hg.apply import apply_diff, apply_diff_backwards
 from mo_hg.hg_mozilla_org import HgMozillaOrg
+from mo_hg.parse import as_moves, stream_lines, stream_to_moves
 from mo_kwargs import override
 from mo_logs import Log
-from mo_logs.exceptions import suppress_exception
 from mo_math.randoms import Random
 from mo_sql import sql_list
 from mo_threads import Lock, Thread, Till
@@ -28,25 +29,38 @@ from mo_http import http
 from pyLibrary.meta import cache
 from tuid import sql
 import tuid.clogger
+from tuid.annotation_index import AnnotationIndex
+from tuid.annotation_writer import AnnotationWriter
 from tuid.counter import Counter
+from tuid.heat import FileHeat
+from tuid.hg_local import LocalHg
 from tuid.statslogger import StatsLogger
-from tuid.util import AnnotateFile, HG_URL, MISSING, TuidLine, TuidMap, insert
+from tuid.util import (
+    AnnotateFile,
+    HG_URL,
+    MISSING,
+    TuidLine,
+    TuidMap,
+    decode_delta,
+    encode_delta,
+)
+from tuid.workers import Workers
 
 DEBUG = False
 ANNOTATE_DEBUG = False
 VERIFY_TUIDS = True
 RETRY = {"times": 3, "sleep": 5, "http": True}
 ANN_WAIT_TIME = 5 * HOUR
+ANNOTATION_DELTA_RATIO = 4  # store a delta when it is this many times smaller, 0 for full copies
 MEMORY_LOG_INTERVAL = 15
 MAX_CONCURRENT_ANN_REQUESTS = 5
-MAX_ANN_REQUESTS_WAIT_TIME = 5 * SECOND
-MAX_THREAD_WAIT_TIME = 5 * SECOND
 WORK_OVERFLOW_BATCH_SIZE = 250
-SQL_ANN_BATCH_SIZE = 5
+ANN_MGET_SIZE = 500  # annotations fetched by _id in one request
 SQL_BATCH_SIZE = 500
 FILES_TO_PROCESS_THRESH = 5
 ENABLE_TRY = False
 DAEMON_WAIT_AT_NEWEST = 30 * SECOND  # Time to wait at the newest revision before polling again.
+DIFF_CHUNK_SIZE = 64 * 1024  # bytes read at a time when streaming a raw diff
 
 GET_LATEST_MODIFICATION = "SELECT revision FROM latestFileMod WHERE file=?"
 
@@ -54,18 +68,37 @@ GET_LATEST_MODIFICATION = "SELECT revision FROM latestFileMod WHERE file=?"
 class TUIDService:
     @override
     def __init__(
-        self, database, hg, hg_cache=None, conn=None, clogger=None, start_workers=True, kwargs=None
+        self,
+        database,
+        hg,
+        hg_cache=None,
+        conn=None,
+        clogger=None,
+        start_workers=True,
+        workers=None,
+        kwargs=None,
     ):
         try:
             self.config = kwargs
 
+            # Many worker processes, each with its own database and csetLog
+            self.workers = Workers(kwargs=workers) if workers else Null
+            database_name = self.config.database.name
+            if self.workers:
+                self.config.database.name = self.workers.local_name(database_name)
+                csetlog = self.config.esclogger.csetLog
+                if csetlog.index and csetlog.backend != "sqlite":
+                    csetlog.index = self.workers.local_name(csetlog.index)
+
             self.conn = conn if conn else sql.Sql(self.config.database)
             self.hg_cache = (
                 HgMozillaOrg(kwargs=self.config.hg_cache, use_cache=True)
                 if self.config.hg_cache
                 else Null
             )
-            self.hg_url = URL(hg.url)
+            self.hg_url = URL(coalesce(hg.url, HG_URL))
+            # hg.backend == "local" reads the main branch from the local_hg_source clone
+            self.local_hg = LocalHg(kwargs=self.config) if hg.backend == "local" else Null
 
             self.esconfig = self.config.esservice
             self.es_temporal = elasticsearch.Cluster(kwargs=self.esconfig.temporal)
@@ -75,16 +108,22 @@ class TUIDService:
                 self.init_db()
             else:
                 self.init_db(True)
+            if self.workers and not conn:
+                self.workers.take_frontiers(self.conn, database_name)
 
             self.locker = Lock()
-            self.request_locker = Lock()
-            self.ann_thread_locker = Lock()
             self.service_thread_locker = Lock()
             self.count_locker = Counter()
-            self.num_requests = 0
-            self.ann_threads_running = 0
+            self.hg_requests = Counter()  # raw-file requests running
+            self.ann_threads = Counter()  # annotation threads running
+            self.heat = FileHeat()  # how often each file is requested, for the caching daemon
+            self.heat.restore(self.conn.get("SELECT file, heat, time FROM fileHeat"))
             self.service_threads_running = 0
             self.next_tuid = coalesce(self.conn.get_one("SELECT max(tuid) FROM temporal")[0], 1)
+            # With workers, tuids up to here come from the block taken from the coordinator
+            self.tuid_block_stop = self.next_tuid
+            if self.workers and not self.workers.process_num:
+                self.workers.start_tuids(self.next_tuid)
             self.total_locker = Lock()
             self.temporal_locker = Lock()
             self.total_files_requested = 0
@@ -98,14 +137,66 @@ class TUIDService:
                     conn=self.conn, tuid_service=self, start_workers=start_workers, kwargs=kwargs
                 )
             )
+            self._add_gauges()
         except Exception as e:
             Log.error("can not setup service", cause=e)
 
+    def _add_gauges(self):
+        # Values read only when the metrics endpoint is hit
+        gauge = self.statsdaemon.add_gauge
+        gauge("service_threads", "Requests being processed", self.get_thread_count)
+        gauge("annotation_threads", "Threads getting raw files", lambda: self.ann_threads.value)
+        gauge("hg_requests_running", "Raw file requests to hg", lambda: self.hg_requests.value)
+        gauge("requested_files_tracked", "Files with request heat", lambda: len(self.heat))
+        gauge(
+            "pending_transactions",
+            "Sqlite transactions waiting",
+            lambda: self.conn.pending_transactions,
+        )
+        gauge(
+            "backfill_queue_depth",
+            "Revisions waiting for backfill",
+            lambda: len(self.clogger.csets_todo_backwards),
+        )
+        gauge("next_tuid", "Next tuid to be assigned", lambda: self.next_tuid)
+        gauge(
+            "annotations_pending",
+            "Annotations waiting to be written",
+            lambda: len(self.annotation_writer),
+        )
+        gauge(
+            "pushes_received",
+            "Pushes to the main branch heard of, see tuid.pushes",
+            lambda: self.clogger.push_listener.received if self.clogger.push_listener else 0,
+        )
+        gauge(
+            "csets_deleted",
+            "Changesets aged out of the csetLog",
+            lambda: self.clogger.csets_deleted,
+        )
+        gauge(
+            "annotations_deleted",
+            "Annotations aged out of the annotations index",
+            lambda: self.clogger.annotations_deleted,
+        )
+        gauge(
+            "http_requests_pooled",
+            "Requests sent over shared keep-alive connections",
+            lambda: sum(p["requests"] for p in http.pool_stats().values()),
+        )
+        gauge(
+            "http_connections_opened",
+            "Connections opened by the shared http sessions",
+            lambda: sum(p["connections"] for p in http.pool_stats().values()),
+        )
+
     def tuid(self):
         """
         :return: next tuid
         """
         with self.locker:
+            if self.workers and self.next_tuid >= self.tuid_block_stop:
+                self.next_tuid, self.tuid_block_stop = self.workers.next_block(self.next_tuid)
             try:
                 return self.next_tuid
             finally:
@@ -121,14 +212,46 @@ class TUIDService:
         annotations = self.esconfig.annotations
         set_default(annotations, {"schema": ANNOTATIONS_SCHEMA})
         # what would be the _id here
-        self.annotations = self.es_annotations.get_or_create_index(kwargs=annotations)
+        self.annotations = AnnotationIndex(self.es_annotations, kwargs=annotations)
         self.annotations.refresh()
 
         total = self.annotations.search({"size": 0})
         while not total.hits:
             total = self.annotations.search({"size": 0})
-        with suppress_exception:
-            self.annotations.add_alias()
+        self.annotation_writer = AnnotationWriter(self.annotations)
+
+        with self.conn.transaction() as t:
+            # Where each tuid was created, as runs of consecutive tuids.
+            # Added after the other tables, so older databases get it here.
+            t.execute(
+                """
+            CREATE TABLE IF NOT EXISTS tuidRange (
+                start          INTEGER,
+                stop           INTEGER NOT NULL,
+                file           TEXT NOT NULL,
+                revision       CHAR(12) NOT NULL,
+                PRIMARY KEY(start)
+            );"""
+            )
+            # The heat of each file, kept across restarts, see save_heat()
+            t.execute(
+                """
+            CREATE TABLE IF NOT EXISTS fileHeat (
+                file           TEXT,
+                heat           REAL NOT NULL,
+                time           REAL NOT NULL,
+                PRIMARY KEY(file)
+            );"""
+            )
+            # Revisions hg found on a branch, so it is asked only once
+            t.execute(
+                """
+            CREATE TABLE IF NOT EXISTS branchRevision (
+                branch         TEXT,
+                revision       CHAR(12),
+                PRIMARY KEY(branch, revision)
+            );"""
+            )
         if temporal_only:
             return
 
@@ -155,6 +278,20 @@ class TUIDService:
 
         Log.note("Tables created successfully")
 
+    def save_heat(self):
+        """
+        Keep the file heat in the database, so the caching daemon still knows
+        the hot files after a restart
+        """
+        rows = self.heat.snapshot()
+        with self.conn.transaction() as t:
+            t.execute("DELETE FROM fileHeat")
+            for _, some in jx.chunk(rows, size=SQL_BATCH_SIZE):
+                t.execute(
+                    "INSERT INTO fileHeat (file, heat, time) VALUES "
+                    + sql_list(quote_list(r) for r in some)
+                )
+
     def _insert_max_tuid(self):
         with self.conn.transaction() as transaction:
             transaction.execute(
@@ -162,26 +299,68 @@ class TUIDService:
                 (1, quote_value(self.next_tuid)),
             )
 
+    def _insert_tuid_ranges(self, entries):
+        """
+        Remember where new tuids were created, for get_lines_from_tuids
+        :param entries: (tuid, file, revision) for every new tuid
+        """
+        ranges = []
+        for tuid, file, revision in sorted(entries):
+            file = file.lstrip("/")
+            if ranges:
+                start, stop, last_file, last_revision = ranges[-1]
+                if tuid == stop and file == last_file and revision == last_revision:
+                    ranges[-1][1] = tuid + 1
+                    continue
+            ranges.append([tuid, tuid + 1, file, revision])
+        if not ranges:
+            return
+        with self.conn.transaction() as t:
+            t.execute(
+                "INSERT OR REPLACE INTO tuidRange (start, stop, file, revision) VALUES "
+                + sql_list(quote_list(r) for r in ranges)
+            )
+
+    def _find_tuid_ranges(self, tuids):
+        """
+        :param tuids: list of tuids
+        :return: map from tuid to the (file, revision) that created it
+        """
+        found = {}
+        with self.conn.transaction() as t:
+            stop = file = revision = None
+            for tuid in sorted(set(tuids)):
+                if stop is None or tuid >= stop:
+                    row = t.get(
+                        "SELECT start, stop, file, revision FROM tuidRange"
+                        " WHERE start<=? ORDER BY start DESC LIMIT 1",
+                        (tuid,),
+                    )
+                    if not row:
+                        continue
+                    _, stop, file, revision = row[0]
+                if tuid < stop:
+                    found[tuid] = (file, revision)
+        return found
+
     def _dummy_annotate_exists(self, file_name, rev):
         # True if dummy, false if not.
         # None means there is no entry.
-        query = {
-            "_source": {"includes": ["annotation"]},
-            "query": {
-                "bool": {"must": [{"term": {"file": file_name}}, {"term": {"revision": rev}}]}
-            },
-            "size": 1,
-        }
-        temp = self.annotations.search(query).hits.total
-        return 0 != temp
+        return (rev, file_name) in self._get_annotation_records([(rev, file_name)])
 
-    def _make_record_annotations(self, revision, file, annotation):
+    def _make_record_annotations(self, revision, file, annotation, base=None, delta=None):
         record = {
             "_id": revision + file,
             "revision": revision,
             "file": file,
-            "annotation": annotation,
+            "timestamp": int(time.time()),  # for tuid.clogger to age it out
         }
+        if base:
+            # annotation IS decode_delta(<annotation at base>, delta)
+            record["base"] = base
+            record["delta"] = delta
+        else:
+            record["annotation"] = annotation
         return {"value": record}
 
     def insert_annotate_dummy(self, rev, file_name):
@@ -190,31 +369,112 @@ class TUIDService:
             self.insert_annotations([(rev[:12], file_name, "")])
 
     def insert_annotations(self, data):
+        """
+        :param data: list of (revision, file, annotation) or, for annotations
+                     stored as a delta, (revision, file, annotation, base, delta)
+                     as given by `_delta_from`
+        """
         if VERIFY_TUIDS:
-            for _, _, tuids_string in data:
-                self.destringify_tuids(tuids_string)
+            for entry in data:
+                self.destringify_tuids(entry[2])
 
-        records = wrap(
-            [
-                self._make_record_annotations(revision, file, annotation)
-                for revision, file, annotation in data
-            ]
-        )
-        insert(self.annotations, records)
+        records = wrap([self._make_record_annotations(*entry) for entry in data])
+        self.annotation_writer.add(records)
+
+    def _delta_from(self, snapshot, revision, annotation):
+        """
+        Decide how to store annotation: as a delta against the snapshot
+        (revision, annotation) of an earlier revision, or in full.
+        :return: (base revision, delta), or (None, None) to store it in full
+        """
+        if not snapshot or not annotation or not ANNOTATION_DELTA_RATIO:
+            return None, None
+        base, base_annotation = snapshot
+        if base == revision:
+            return None, None
+        delta = encode_delta(base_annotation, annotation)
+        if len(delta) * ANNOTATION_DELTA_RATIO >= len(annotation):
+            return None, None
+        return base, delta
+
+    def _get_annotation_records(self, keys):
+        """
+        :param keys: list of (revision, file)
+        :return: map from (revision, file) to its annotation record, for those found
+        """
+        found = {}
+        missing = []
+        for rev, file in set(keys):
+            # Annotations not yet written are found first
+            record = self.annotation_writer.get(rev + file)
+            if record is not None:
+                found[(rev, file)] = record
+            else:
+                missing.append((rev, file))
+
+        # _mget is realtime, no refresh is needed to see recent writes
+        for _, some in jx.chunk(missing, size=ANN_MGET_SIZE):
+            records = self.annotations.get_records(
+                [rev + file for rev, file in some],
+                includes=["annotation", "revision", "base", "delta"],
+            )
+            for rev, file in some:
+                record = records.get(rev + file)
+                if record is not None:
+                    found[(rev, file)] = record
+        return found
 
     def _get_annotation(self, rev, file):
-        if isinstance(rev, list):
-            filter = {"terms": {"revision": rev}}
-        else:
-            filter = {"term": {"revision": rev}}
+        return self._get_annotations([(rev, file)]).get((rev, file))
 
-        query = {
-            "_source": {"includes": ["annotation", "revision"]},
-            "query": {"bool": {"must": [filter, {"term": {"file": file}}]}},
-            "size": 1,
+    def _get_annotations(self, keys):
+        """
+        :param keys: list of (revision, file)
+        :return: map from (revision, file) to annotation, for those found
+        """
+        return {
+            key: annotation
+            for key, (annotation, _) in self._get_annotations_and_snapshots(keys).items()
+            if annotation is not None
         }
-        r = self.annotations.search(query).hits.hits[0]
-        return r._source.annotation
+
+    def _get_annotation_and_snapshot(self, rev, file):
+        return self._get_annotations_and_snapshots([(rev, file)]).get((rev, file), (None, None))
+
+    def _get_annotations_and_snapshots(self, keys):
+        """
+        :param keys: list of (revision, file)
+        :return: map from (revision, file) to (annotation, snapshot), for those
+                 found, where snapshot is the full (revision, annotation) later
+                 revisions can be stored as deltas against
+        """
+        records = self._get_annotation_records(keys)
+        bases = self._get_annotation_records(
+            [(r.base, file) for (_, file), r in records.items() if r.base]
+        )
+
+        result = {}
+        for (rev, file), r in records.items():
+            if not r.base:
+                if r.annotation:
+                    result[(rev, file)] = r.annotation, (r.revision, list(r.annotation))
+                else:
+                    result[(rev, file)] = r.annotation, None
+                continue
+
+            snapshot = bases.get((r.base, file), Null).annotation
+            if not snapshot:
+                Log.note(
+                    "Annotation of {{file}} at {{rev}} is a delta, but its base {{base}} is gone",
+                    file=file,
+                    rev=r.revision,
+                    base=r.base,
+                )
+                result[(rev, file)] = None, None
+                continue
+            snapshot = list(snapshot)
+            result[(rev, file)] = decode_delta(snapshot, list(r.delta)), (r.base, snapshot)
+        return result
 
     def _get_latest_revision(self, file, transaction):
         # Returns the latest revision that we
@@ -240,17 +500,25 @@ class TUIDService:
         except Exception as e:
             Log.error("Invalid entry in tuids list:\n{{list}}", list=tuids_list, cause=e)
 
-    # Gets a diff from a particular revision from https://hg.mozilla.org/
-    def _get_hg_diff(self, cset, repo=None):
-        def check_merge(description):
-            if description.startswith("merge "):
-                return True
-            elif description.startswith("Merge "):
-                return True
-            return False
+    def _is_local(self, repo):
+        # True if the local clone can answer for this branch
+        return bool(self.local_hg) and repo == self.config.hg.branch
 
+    # Gets a diff from a particular revision from https://hg.mozilla.org/
+    def _get_hg_diff(self, cset, repo=None, files=None):
+        """
+        :param files: optional set of file names; when given, the diff is
+                      streamed and changes to other files are dropped
+                      (see `mo_hg.parse.stream_moves`)
+        """
         if repo is None:
             repo = self.config.hg.branch
+        if self._is_local(repo):
+            moves, description = self.local_hg.get_diff(cset, files)
+            return {"diffs": moves, "merge": _is_merge(description)}
+        if not self.hg_cache:
+            return self._get_hg_diff_without_cache(cset, repo, files)
+
         tmp = self.hg_cache.get_revision(
             wrap({"changeset": {"id": cset}, "branch": {"name": repo}}), None, False, True
         )
@@ -259,38 +527,56 @@ class TUIDService:
         output2["diffs"] = output
 
         merge_description = tmp["changeset"]["description"]
-        output2["merge"] = check_merge(merge_description)
+        output2["merge"] = _is_merge(merge_description)
         return output2
 
+    def _get_hg_diff_without_cache(self, cset, repo, files=None):
+        # When no hg_cache is configured, read the diff straight from hg
+        rev_url = str(self.hg_url) + "/" + repo + "/json-rev/" + cset
+        diff_url = str(self.hg_url) + "/" + repo + "/raw-rev/" + cset
+        description = http.get_json(rev_url, retry=RETRY).desc
+        response = http.get(diff_url, retry=RETRY, stream=True)
+        try:
+            moves = stream_to_moves(stream_lines(response.iter_content(DIFF_CHUNK_SIZE)), files)
+        finally:
+            response.close()
+        return {"diffs": moves, "merge": _is_merge(coalesce(description, ""))}
+
     # Gets number of lines in a file from a particular revision from https://hg.mozilla.org/
     def _get_hg_annotate(self, cset, file, annotated_files, thread_num, repo, please_stop=None):
-        with self.ann_thread_locker:
-            self.ann_threads_running += 1
-        url = str(HG_URL) + "/" + repo + "/raw-file/" + cset + "/" + file
+        self.ann_threads.add(1)
+        if self._is_local(repo):
+            # No request slots needed, the local clone is not rate limited
+            try:
+                annotated_files[thread_num] = coalesce(self.local_hg.get_line_count(cset, file), 0)
+            except Exception as e:
+                annotated_files[thread_num] = []
+                Log.warning(
+                    "Unexpected error reading {{file}} at {{rev}} from the local clone",
+                    file=file,
+                    rev=cset,
+                    cause=e,
+                )
+            finally:
+                self.ann_threads.add(-1)
+            return
+
+        url = str(self.hg_url) + "/" + repo + "/raw-file/" + cset + "/" + file
         if DEBUG:
             Log.note("HG: {{url}}", url=url)
 
-        # Wait until there is room to request
+        # Wait until there is room to request, woken when a request finishes
         self.statsdaemon.update_anns_waiting(1)
-        num_requests = MAX_CONCURRENT_ANN_REQUESTS
+        if ANNOTATE_DEBUG:
+            Log.note(
+                "Waiting to request annotation at {{rev}} for file: {{file}}", rev=cset, file=file
+            )
         timeout = Till(seconds=ANN_WAIT_TIME.seconds)
-        while num_requests >= MAX_CONCURRENT_ANN_REQUESTS and not timeout:
-            with self.request_locker:
-                num_requests = self.num_requests
-                if num_requests < MAX_CONCURRENT_ANN_REQUESTS:
-                    self.num_requests += 1
-                    break
-            if ANNOTATE_DEBUG:
-                Log.note(
-                    "Waiting to request annotation at {{rev}} for file: {{file}}",
-                    rev=cset,
-                    file=file,
-                )
-            Till(seconds=MAX_ANN_REQUESTS_WAIT_TIME.seconds).wait()
+        got_slot = self.hg_requests.acquire(MAX_CONCURRENT_ANN_REQUESTS, till=timeout)
         self.statsdaemon.update_anns_waiting(-1)
 
         annotated_files[thread_num] = []
-        if not timeout:
+        if got_slot:
             try:
                 response = http.get(url, retry=RETRY, stream=True)
                 if response.status_code == 200:
@@ -308,27 +594,45 @@ class TUIDService:
                     "Unexpected error while trying to get raw file for {{url}}", url=url, cause=e
                 )
             finally:
-                with self.request_locker:
-                    self.num_requests -= 1
+                self.hg_requests.add(-1)
         else:
             Log.warning(
                 "Timeout {{timeout}} exceeded waiting for annotation: {{url}}",
                 timeout=ANN_WAIT_TIME,
                 url=url,
             )
-        with self.ann_thread_locker:
-            self.ann_threads_running -= 1
+        self.ann_threads.add(-1)
         return
 
-    def get_diffs(self, csets, repo=None):
-        # Get all the diffs
+    def get_diffs(self, csets, repo=None, files=None):
+        """
+        :param csets: revisions to get diffs for
+        :param repo: branch, default is the main branch
+        :param files: optional list of files the caller needs; changes to
+                      other files are not kept
+        :return: list of {"cset", "diff"}, in the same order as csets
+        """
         if repo is None:
             repo = self.config.hg.branch
 
-        list_diffs = []
+        diffs = {}
+        wanted = set(f.lstrip("/") for f in files) if files is not None else None
+        pending = []
         for cset in csets:
-            list_diffs.append({"cset": cset, "diff": self._get_hg_diff(cset, repo=repo)})
-        return list_diffs
+            if cset not in pending:
+                pending.append(cset)
+        while pending:
+            # A rename adds the other name to `wanted`, so earlier diffs may
+            # have dropped changes we now need. Those are read again.
+            redo = []
+            for i, cset in enumerate(pending):
+                known = len(wanted) if wanted is not None else 0
+                diffs[cset] = self._get_hg_diff(cset, repo=repo, files=wanted)
+                if wanted is not None and len(wanted) > known:
+                    redo = pending[:i]
+            pending = redo
+
+        return [{"cset": cset, "diff": diffs[cset]} for cset in csets]
 
     def get_tuids_from_revision(self, revision):
         """
@@ -338,17 +642,19 @@ class TUIDService:
         :return: list of (file, list(tuids)) tuples
         """
         result = []
-        URL_TO_FILES = str(HG_URL) + "/" + self.config.hg.branch + "/json-info/" + revision
+        URL_TO_FILES = str(self.hg_url) + "/" + self.config.hg.branch + "/json-info/" + revision
         try:
-            mozobject = http.get_json(url=URL_TO_FILES, retry=RETRY)
+            if self.local_hg:
+                files = self.local_hg.get_files(revision)
+            else:
+                mozobject = http.get_json(url=URL_TO_FILES, retry=RETRY)
+                files = mozobject[revision]["files"]
         except Exception as e:
             Log.warning(
                 "Unexpected error trying to get file list for revision {{revision}}", cause=e
             )
             return None
 
-        files = mozobject[revision]["files"]
-
         results = self.get_tuids(files, revision)
         return results
 
@@ -357,19 +663,40 @@ class TUIDService:
         clog_obj = http.get_json(clog_url, retry=RETRY)
         return clog_obj
 
-    @cache(duration=30 * MINUTE)
     def _check_branch(self, revision, branch):
         """
-        Used to find out if the revision is in the given branch.
+        Used to find out if the revision is in the given branch. The csetLog
+        and the revisions hg already found are looked at before asking hg.
 
         :param revision: Revision to check.
         :param branch: Branch to check revision on.
         :return: True/False - Found it/Didn't find it
         """
+        if branch == self.config.hg.branch and self.clogger.get_revnums([revision]):
+            return True
+        if self.conn.get(
+            "SELECT 1 FROM branchRevision WHERE branch=? AND revision=?", (branch, revision[:12])
+        ):
+            return True
+
+        found = self._check_branch_in_hg(revision, branch)
+        if found:
+            # Only a yes is kept, a revision may still be pushed to the branch
+            with self.conn.transaction() as t:
+                t.execute(
+                    "INSERT OR REPLACE INTO branchRevision (branch, revision) VALUES (?, ?)",
+                    (branch, revision[:12]),
+                )
+        return found
+
+    @cache(duration=30 * MINUTE)
+    def _check_branch_in_hg(self, revision, branch):
+        if self._is_local(branch):
+            return self.local_hg.has_revision(revision)
 
         # Get a changelog
         res = True
-        clog_url = str(HG_URL) + "/" + branch + "/json-log/" + revision
+        clog_url = str(self.hg_url) + "/" + branch + "/json-log/" + revision
         clog_obj = None
         try:
             Log.note("Searching through changelog {{url}}", url=clog_url)
@@ -532,6 +859,7 @@ class TUIDService:
         new_files = []
 
         log_existing_files = []
+        existing = self._get_annotations([(revision, file) for file in files])
         for count, file in enumerate(files):
             # Go through all requested files and
             # either update their frontier or add
@@ -544,7 +872,7 @@ class TUIDService:
 
             with self.conn.transaction() as t:
                 latest_rev = self._get_latest_revision(file, t)
-                already_ann = self._get_annotation(revision, file)
+            already_ann = existing.get((revision, file))
 
             # Check if the file has already been collected at
             # this revision and get the result if so
@@ -577,6 +905,10 @@ class TUIDService:
                 Log.note("Frontier update - adding: " "{{rev}}|{{file}} ", file=file, rev=revision)
                 new_files.append(file)
 
+        self.statsdaemon.update_cache(
+            hits=len(log_existing_files), misses=len(files) - len(log_existing_files)
+        )
+
         if DEBUG:
             Log.note(
                 "Frontier update - already exist in DB: " "{{rev}} || {{file_list}} ",
@@ -717,6 +1049,68 @@ class TUIDService:
 
         return result, completed
 
+    def get_tuids_from_revisions(self, groups):
+        """
+        Gets the TUIDs for many (branch, revision, files) groups. The groups
+        are done in csetLog order, oldest first, so the frontier of a file
+        found in many groups steps forward through them, reusing the diffs,
+        instead of jumping back and forth. Revisions not in the csetLog
+        (like try pushes) are done last, in the order given.
+
+        :param groups: list of (branch, revision, files) tuples
+        :return: generator of (index of group, list of (file, list(tuids)), completed), as done
+        """
+        revnums = self.clogger.get_revnums([revision for _, revision, _ in groups])
+
+        def order(i):
+            revnum = revnums.get(groups[i][1][:12])
+            return (0, revnum, i) if revnum is not None else (1, 0, i)
+
+        for i in sorted(range(len(groups)), key=order):
+            branch, revision, files = groups[i]
+            result, completed = self.get_tuids_from_files(
+                files, revision, going_forward=True, repo=branch
+            )
+            yield i, result, completed
+
+    def get_lines_from_tuids(self, tuids, revision, repo=None, lookup=None):
+        """
+        Find where the given tuids are at a revision. The tuidRange table
+        names the file each tuid was created in, and the annotation of that
+        file at the revision gives its line.
+
+        Tuids created before the tuidRange table existed, and tuids whose
+        file was renamed since, are not found.
+
+        :param tuids: list of tuids
+        :param revision: revision to find the lines at
+        :param repo: Branch to get files from (mozilla-central, or try)
+        :param lookup: function(files, revision, repo=repo) that gets the tuids of the files
+                       instead of this service, like Router.get_tuids_from_files
+        :return: ([list of (tuid, file, line) tuples, in the order given], True/False if completed or not)
+                 file is None if the tuid is unknown, line is None if it is not in the file at revision
+        """
+        origins = self._find_tuid_ranges(tuids)
+        files = list(set(file for file, _ in origins.values()))
+
+        lines = {}
+        completed = True
+        if files and lookup:
+            annotations, completed = lookup(files, revision, repo=repo)
+        elif files:
+            annotations, completed = self.get_tuids_from_files(
+                files, revision, going_forward=True, repo=repo
+            )
+            for file, tuid_maps in annotations:
+                for tuid_map in tuid_maps:
+                    lines[(file.lstrip("/"), tuid_map.tuid)] = tuid_map.line
+
+        result = []
+        for tuid in tuids:
+            file, _ = origins.get(tuid, (None, None))
+            result.append((tuid, file, lines.get((file, tuid))))
+        return result, completed
+
     def _apply_diff(self, annotation, diff, cset, file):
         """
         Using an annotation ([(tuid,line)] - array
@@ -766,18 +1160,20 @@ class TUIDService:
                 # are correctly created.
                 file = new_fname
 
-            f_diff = f_proc["changes"]
-            for change in f_diff:
-                if change.action == "+":
+            for line, action in as_moves(f_proc["changes"]).pairs():
+                if action == "+":
                     new_tuid = self.tuid()
-                    list_to_insert.append((new_tuid, cset, file, change.line + 1))
-                    new_ann = add_one(TuidMap(new_tuid, change.line + 1), new_ann)
-                elif change.action == "-":
-                    new_ann = remove_one(change.line + 1, new_ann)
+                    list_to_insert.append((new_tuid, cset, file, line + 1))
+                    new_ann = add_one(TuidMap(new_tuid, line + 1), new_ann)
+                else:
+                    new_ann = remove_one(line + 1, new_ann)
             break  # Found the file, exit searching
 
         if len(list_to_insert) > 0:
             self._insert_max_tuid()
+            self._insert_tuid_ranges(
+                (tuid, new_file, rev) for tuid, rev, new_file, _ in list_to_insert
+            )
 
         return new_ann, file
 
@@ -800,8 +1196,9 @@ class TUIDService:
         files_to_update = []
 
         # Check if the files were already annotated.
+        existing = self._get_annotations([(revision, file) for file in files])
         for file in files:
-            already_ann = self._get_annotation(revision, file)
+            already_ann = existing.get((revision, file))
             if already_ann and already_ann[0] == "":
                 result.append((file, []))
                 log_existing_files.append("removed|" + file)
@@ -831,7 +1228,7 @@ class TUIDService:
         curr_rev = revision
         mc_revision = ""
         jsonpushes_url = (
-            str(HG_URL) + "/" + repo + "/" + "json-pushes?full=1&changeset=" + str(revision)
+            str(self.hg_url) + "/" + repo + "/" + "json-pushes?full=1&changeset=" + str(revision)
         )
         try:
             pushes_obj = http.get_json(jsonpushes_url, retry=RETRY)
@@ -876,7 +1273,7 @@ class TUIDService:
         files_to_process = {}
 
         Log.note("Gathering diffs for: {{csets}}", csets=str(diffs_to_get))
-        all_diffs = self.get_diffs(diffs_to_get, repo=repo)
+        all_diffs = self.get_diffs(diffs_to_get, repo=repo, files=files_to_update)
 
         # Build a dict for faster access to the diffs
         parsed_diffs = {entry["cset"]: entry["diff"] for entry in all_diffs}
@@ -962,21 +1359,20 @@ class TUIDService:
             # added by another thread.
             anns_added_by_other_thread = {}
             if len(ann_inserts) > 0:
-                for _, tmp_inserts in jx.chunk(ann_inserts, size=SQL_ANN_BATCH_SIZE):
-                    # Check if any were added in the mean time by another thread
-                    recomputed_inserts = []
-                    for rev, filename, tuids in tmp_inserts:
-
-                        tmp_ann = self._get_annotation(rev, filename)
-                        if not tmp_ann and tmp_ann != "":
-                            recomputed_inserts.append((rev, filename, tuids))
-                        else:
-                            anns_added_by_other_thread[filename] = self.destringify_tuids(tmp_ann)
+                # Check if any were added in the mean time by another thread
+                existing = self._get_annotations([(rev, f) for rev, f, _ in ann_inserts])
+                recomputed_inserts = []
+                for rev, filename, tuids in ann_inserts:
+                    tmp_ann = existing.get((rev, filename))
+                    if not tmp_ann and tmp_ann != "":
+                        recomputed_inserts.append((rev, filename, tuids))
+                    else:
+                        anns_added_by_other_thread[filename] = self.destringify_tuids(tmp_ann)
 
-                    try:
-                        self.insert_annotations(recomputed_inserts)
-                    except Exception as e:
-                        Log.error("Error inserting into annotations table.", cause=e)
+                try:
+                    self.insert_annotations(recomputed_inserts)
+                except Exception as e:
+                    Log.error("Error inserting into annotations table.", cause=e)
 
         if len(anns_to_get) > 0:
             result.extend(self.get_tuids(anns_to_get, revision, repo=repo))
@@ -1065,7 +1461,7 @@ class TUIDService:
             diffs_cache.extend([rev for revnum, rev in diffs_to_frontier[cset]])
 
         Log.note("Gathering diffs for: {{csets}}", csets=str(diffs_cache))
-        all_diffs = self.get_diffs(diffs_cache)
+        all_diffs = self.get_diffs(diffs_cache, files=list(file_to_frontier))
 
         # Build a dict for faster access to the diffs,
         # to be used later when applying them.
@@ -1094,6 +1490,9 @@ class TUIDService:
         anns_to_get = []
         total = len(file_to_frontier)
         tmp_results = {}
+        old_annotations = self._get_annotations_and_snapshots(
+            [(old_frontier, file) for file, old_frontier in frontier_list]
+        )
         with self.conn.transaction() as transaction:
             for count, (file, old_frontier) in enumerate(frontier_list):
                 # If the file was modified, get it's newest
@@ -1101,7 +1500,7 @@ class TUIDService:
                 tmp_res = None
                 if file in files_to_process:
                     # Process this file using the diffs found
-                    tmp_ann = self._get_annotation(old_frontier, file)
+                    tmp_ann, snapshot = old_annotations.get((old_frontier, file), (None, None))
                     if tmp_ann == None or tmp_ann == "" or self.destringify_tuids(tmp_ann) is None:
                         Log.warning(
                             "{{file}} has frontier but can't find old annotation for it in {{rev}}, "
@@ -1167,7 +1566,15 @@ class TUIDService:
                                 break
                             file_to_modify.reset_new_lines()
                             tmp_res = file_to_modify.lines_to_annotation()
-                            ann_inserts.append((rev_to_proc, file, self.stringify_tuids(tmp_res)))
+                            tuids = self.stringify_tuids(tmp_res)
+                            base, delta = None, None
+                            if rev_to_proc != revision:
+                                # The new frontier is kept in full, see _drop_old_annotations
+                                base, delta = self._delta_from(snapshot, rev_to_proc, tuids)
+                            if not base:
+                                # Stored in full, the next ones are deltas against it
+                                snapshot = (rev_to_proc, tuids)
+                            ann_inserts.append((rev_to_proc, file, tuids, base, delta))
 
                         Log.note(
                             "Frontier update - modified: {{count}}/{{total}} - {{percent|percent(decimal=0)}} "
@@ -1179,7 +1586,7 @@ class TUIDService:
                             percent=count / total,
                         )
                 else:
-                    old_ann = self._get_annotation(old_frontier, file)
+                    old_ann, _ = old_annotations.get((old_frontier, file), (None, None))
                     if old_ann == None or (old_ann == "" and file in added_files):
                         # File is new (likely from an error), or re-added - we need to create
                         # a new initial entry for this file.
@@ -1197,7 +1604,7 @@ class TUIDService:
                         # File was not modified since last
                         # known revision
                         tmp_res = self.destringify_tuids(old_ann) if old_ann != "" else []
-                        ann_inserts.append((revision, file, old_ann))
+                        ann_inserts.append((revision, file, old_ann, None, None))
                         Log.note(
                             "Frontier update - not modified: {{count}}/{{total}} - {{percent|percent(decimal=0)}} "
                             "| {{rev}}|{{file}} ",
@@ -1239,28 +1646,31 @@ class TUIDService:
                     )
 
             anns_added_by_other_thread = {}
+            # Revisions another thread stored first, they may not match our deltas
+            not_ours = set()
             if len(ann_inserts) > 0:
-                for _, tmp_inserts in jx.chunk(ann_inserts, size=SQL_ANN_BATCH_SIZE):
-                    # Check if any were added in the mean time by another thread
-                    recomputed_inserts = []
-                    for rev, filename, string_tuids in tmp_inserts:
-                        tmp_ann = self._get_annotation(rev, filename)
-                        if not tmp_ann and tmp_ann != "":
-                            recomputed_inserts.append((rev, filename, string_tuids))
-                        elif rev == revision:
+                # Check if any were added in the mean time by another thread
+                existing = self._get_annotations([(rev, f) for rev, f, _, _, _ in ann_inserts])
+                recomputed_inserts = []
+                for rev, filename, string_tuids, base, delta in ann_inserts:
+                    tmp_ann = existing.get((rev, filename))
+                    if not tmp_ann and tmp_ann != "":
+                        if (base, filename) in not_ours:
+                            base, delta = None, None
+                        recomputed_inserts.append((rev, filename, string_tuids, base, delta))
+                    else:
+                        not_ours.add((rev, filename))
+                        if rev == revision:
                             anns_added_by_other_thread[filename] = self.destringify_tuids(tmp_ann)
 
-                    if len(recomputed_inserts) <= 0:
-                        continue
-
-                    try:
-                        self.insert_annotations(recomputed_inserts)
-                    except Exception as e:
-                        Log.error(
-                            "Error inserting into annotations table: {{inserting}}",
-                            inserting=recomputed_inserts,
-                            cause=e,
-                        )
+                try:
+                    self.insert_annotations(recomputed_inserts)
+                except Exception as e:
+                    Log.error(
+                        "Error inserting into annotations table: {{inserting}}",
+                        inserting=recomputed_inserts,
+                        cause=e,
+                    )
 
         if len(anns_to_get) > 0:
             result.extend(self.get_tuids(anns_to_get, revision))
@@ -1298,8 +1708,9 @@ class TUIDService:
                 new_files[count] = file.lstrip("/")
 
             annotations_to_get = []
+            existing = self._get_annotations([(revision, file) for file in new_files])
             for file in new_files:
-                already_ann = self._get_annotation(revision, file)
+                already_ann = existing.get((revision, file))
                 if already_ann:
                     results.append((file, self.destringify_tuids(already_ann)))
                 elif already_ann == "":
@@ -1315,20 +1726,14 @@ class TUIDService:
             # store in annotated_files and
             # prevent too many threads from starting up here.
             self.statsdaemon.update_threads_waiting(len(annotations_to_get))
-            num_threads = chunk
             timeout = Till(seconds=ANN_WAIT_TIME.seconds)
-            while num_threads >= chunk and not timeout:
-                with self.ann_thread_locker:
-                    num_threads = self.ann_threads_running
-                    if num_threads <= chunk:
-                        break
-                Till(seconds=MAX_THREAD_WAIT_TIME.seconds).wait()
+            room = self.ann_threads.wait_for(lambda running: running <= chunk, till=timeout)
             self.statsdaemon.update_threads_waiting(-len(annotations_to_get))
 
-            if timeout:
+            if not room:
                 Log.warning(
                     "Timeout {{timeout}} exceeded waiting to start annotation threads.",
-                    timeout=MAX_ANN_REQUESTS_WAIT_TIME,
+                    timeout=ANN_WAIT_TIME,
                 )
                 annotated_files = [[] for _ in annotations_to_get]
             else:
@@ -1336,8 +1741,9 @@ class TUIDService:
                 # a while.
                 old_annotations_len = len(annotations_to_get)
                 new_annotations_to_get = []
+                existing = self._get_annotations([(revision, file) for file in annotations_to_get])
                 for file in annotations_to_get:
-                    already_ann = self._get_annotation(revision, file)
+                    already_ann = existing.get((revision, file))
                     if already_ann:
                         results.append((file, self.destringify_tuids(already_ann)))
                     elif already_ann == "":
@@ -1398,13 +1804,15 @@ class TUIDService:
         """
         with self.temporal_locker:
             results = []
+            new_tuids = []
+            existing = self._get_annotations([(revision, file) for file in files])
             for fcount, file_length in enumerate(annotated_files):
                 file = files[fcount]
                 # TODO: Replace old empty annotation if a new one is found
                 # TODO: at the same revision and if it is not empty as well.
                 # Make sure we are not adding the same thing another thread
                 # added.
-                tmp_ann = self._get_annotation(revision, file)
+                tmp_ann = existing.get((revision, file))
                 if tmp_ann != None:
                     results.append((file, self.destringify_tuids(tmp_ann)))
                     continue
@@ -1426,12 +1834,14 @@ class TUIDService:
                     new_tuid = self.tuid()
                     str_tuids.append(new_tuid)
                     tuids.append(TuidMap(new_tuid, i + 1))
+                    new_tuids.append((new_tuid, file, revision))
                 entry = [(revision, file, str_tuids)]
 
                 self.insert_annotations(entry)
                 results.append((copy.deepcopy(file), copy.deepcopy(tuids)))
 
             self._insert_max_tuid()
+            self._insert_tuid_ranges(new_tuids)
         return results
 
     def _daemon(self, please_stop, only_coverage_revisions=False):
@@ -1457,106 +1867,97 @@ class TUIDService:
             for file_n_rev in files_n_revs:
                 revs[file_n_rev[1]].append(file_n_rev[0])
 
-            # Go through each frontier and update it
-            ran_changesets = False
-            coverage_revisions = None
+            # Place every frontier in the csetLog, so one walk from the
+            # oldest frontier to the tip serves all the groups.
+            tip_revnum, _ = self.clogger.get_tip()
+            frontier_revnums = {}
             for frontier in revs:
                 if please_stop:
                     return
+                try:
+                    revnum = self.clogger._get_one_revnum(frontier)
+                    if revnum == None:
+                        revnum = self.clogger.get_old_cset_revnum(frontier)
+                except Exception as e:
+                    Log.warning("Can not find frontier {{frontier}}", frontier=frontier, cause=e)
+                    continue
+                if revnum < tip_revnum:
+                    frontier_revnums[frontier] = revnum
 
-                files = revs[frontier]
-
-                # Go through changeset logs until we find the last
-                # known frontier for this revision group.
-                csets = []
-                final_rev = ""
-                found_last_frontier = False
-                Log.note("Searching for frontier: {{frontier}} ", frontier=frontier)
-                Log.note(
-                    "HG URL: {{url}}",
-                    url=str(HG_URL) + "/" + self.config.hg.branch + "/rev/" + frontier,
+            # No frontiers behind the tip means that we are
+            # already at the latest revisions.
+            ran_changesets = False
+            if frontier_revnums:
+                ran_changesets = self._advance_frontiers(
+                    revs, frontier_revnums, tip_revnum, only_coverage_revisions, please_stop
                 )
-                while not found_last_frontier:
-                    # Get a changelog
-                    clog_url = str(HG_URL) + "/" + self.config.hg.branch + "/json-log/" + final_rev
-                    try:
-                        clog_obj = self.get_clog(clog_url)
-                    except Exception as e:
-                        Log.error(
-                            "Unexpected error getting changset-log for {{url}}",
-                            url=clog_url,
-                            error=e,
-                        )
 
-                    cset = ""
-                    still_looking = True
-                    # For each changeset/node
-                    for clog_cset in clog_obj["changesets"]:
-                        cset = clog_cset["node"][:12]
-                        if cset == frontier:
-                            still_looking = False
-                            break
-                        csets.append(cset)
-
-                    if not still_looking:
-                        found_last_frontier = True
-                    final_rev = cset
-
-                # No csets found means that we are already
-                # at the latest revisions.
-                if len(csets) == 0:
-                    continue
+            if not ran_changesets:
+                (please_stop | Till(seconds=DAEMON_WAIT_AT_NEWEST.seconds)).wait()
 
-                # Get all the latest ccov and jsdcov revisions
-                if (not coverage_revisions) and only_coverage_revisions:
-                    active_data_url = "http://activedata.allizom.org/query"
-                    query_json = {
-                        "limit": 1000,
-                        "from": "task",
-                        "where": {
-                            "and": [
-                                {"in": {"build.type": ["ccov", "jsdcov"]}},
-                                {"gte": {"run.timestamp": {"date": "today-day"}}},
-                                {"eq": {"repo.branch.name": self.config.hg.branch}},
-                            ]
-                        },
-                        "select": [
-                            {"aggregate": "min", "value": "run.timestamp"},
-                            {"aggregate": "count"},
-                        ],
-                        "groupby": ["repo.changeset.id12"],
-                    }
-                    coverage_revisions_resp = http.post_json(
-                        active_data_url, retry=RETRY, data=query_json
-                    )
-                    coverage_revisions = [rev_arr[0] for rev_arr in coverage_revisions_resp.data]
-
-                # Reverse changeset list and for each code coverage revision
-                # found by going through the list from oldest to newest,
-                # update _all known_ file frontiers to that revision.
-                csets.reverse()
-                prev_cset = frontier
-                for cset in csets:
-                    if please_stop:
-                        return
-                    if only_coverage_revisions:
-                        if cset not in coverage_revisions:
-                            continue
-                    if DEBUG:
-                        Log.note(
-                            "Moving frontier {{frontier}} forward to {{cset}}.",
-                            frontier=prev_cset,
-                            cset=cset,
-                        )
+    def _advance_frontiers(
+        self, revs, frontier_revnums, tip_revnum, only_coverage_revisions, please_stop
+    ):
+        """
+        Move all the frontier groups forward together, changeset by changeset.
+        A group joins once the walk passes its frontier, so each changeset is
+        applied once, to every file that is behind it.
+        :param revs: frontier -> files
+        :param frontier_revnums: frontier -> revnum, for the frontiers to move
+        :return: True if any changeset was applied
+        """
+        # Get all the latest ccov and jsdcov revisions
+        coverage_revisions = None
+        if only_coverage_revisions:
+            active_data_url = "http://activedata.allizom.org/query"
+            query_json = {
+                "limit": 1000,
+                "from": "task",
+                "where": {
+                    "and": [
+                        {"in": {"build.type": ["ccov", "jsdcov"]}},
+                        {"gte": {"run.timestamp": {"date": "today-day"}}},
+                        {"eq": {"repo.branch.name": self.config.hg.branch}},
+                    ]
+                },
+                "select": [
+                    {"aggregate": "min", "value": "run.timestamp"},
+                    {"aggregate": "count"},
+                ],
+                "groupby": ["repo.changeset.id12"],
+            }
+            coverage_revisions_resp = http.post_json(active_data_url, retry=RETRY, data=query_json)
+            coverage_revisions = [rev_arr[0] for rev_arr in coverage_revisions_resp.data]
+
+        waiting = sorted(frontier_revnums.items(), key=lambda f: f[1])
+        csets = self.clogger._get_revnum_range(waiting[0][1] + 1, tip_revnum)
+        csets = sorted(csets, key=lambda x: int(x[0]))
+
+        # Go through the changesets from oldest to newest and
+        # update _all known_ file frontiers to each (coverage) revision.
+        files = []
+        ran_changesets = False
+        for revnum, cset in csets:
+            if please_stop:
+                break
+            while waiting and waiting[0][1] < revnum:
+                frontier, _ = waiting.pop(0)
+                Log.note("Frontier {{frontier}} joins at {{cset}}", frontier=frontier, cset=cset)
+                files.extend(revs[frontier])
+            if only_coverage_revisions and cset not in coverage_revisions:
+                continue
+            if DEBUG:
+                Log.note("Moving {{num}} files forward to {{cset}}.", num=len(files), cset=cset)
 
-                    # Update files
-                    self.get_tuids_from_files(files, cset)
+            # Update files, the changesets come from the csetLog,
+            # so they are known to be on the main branch
+            self.get_tuids_from_files(list(files), cset, repo=self.config.hg.branch)
+            ran_changesets = True
+        return ran_changesets
 
-                    ran_changesets = True
-                    prev_cset = cset
 
-            if not ran_changesets:
-                (please_stop | Till(seconds=DAEMON_WAIT_AT_NEWEST.seconds)).wait()
+def _is_merge(description):
+    return description.startswith("merge ") or description.startswith("Merge ")
 
 
 ANNOTATIONS_SCHEMA = {
@@ -1568,6 +1969,9 @@ ANNOTATIONS_SCHEMA = {
                 "revision": {"type": "keyword", "store": True},
                 "file": {"type": "keyword", "store": True},
                 "annotation": {"type": "keyword", "ignore_above": 20, "store": True},
+                "base": {"type": "keyword", "store": True},
+                "delta": {"type": "integer", "index": False},
+                "timestamp": {"type": "integer", "store": True},
             },
         }
     },
@@ -9,23 +9,24 @@ from __future__ import division
 from __future__ import unicode_literals
 
 from mo_logs import Log
-from mo_threads import Till, Lock, Thread
+from mo_threads import Lock
 from mo_threads.threads import ALL
-from mo_times.durations import MINUTE
 
-import gc
 import os
 import psutil
 
-DAEMON_WAIT_FOR_PC = 1 * MINUTE  # Time until a percent complete log message is emitted.
-DAEMON_WAIT_FOR_THREADS = (
-    1 * MINUTE
-)  # Time until a thread count log message is emitted.
-DAEMON_MEMORY_LOG_INTERVAL = 2 * MINUTE  # Time until the memory is logged.
-DAEMON_REQUESTS_LOG_INTERVAL = 2 * MINUTE  # Time until requests data is logged.
+# Upper bounds (in seconds) of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+METRICS_PREFIX = "tuid_"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
 
 
 class StatsLogger:
+    """
+    Holds the service counters. Nothing is logged periodically; use
+    `snapshot()` or `to_prometheus()` to read the current values on demand.
+    """
+
     def __init__(self):
         self.out_of_memory_restart = False
 
@@ -44,14 +45,23 @@ class StatsLogger:
         self.requests_passed = 0
         self.requests_failed = 0
 
+        self.latency_locker = Lock()
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)  # LAST IS +Inf
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+        self.cache_locker = Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # MAP FROM METRIC NAME TO (description, function) PAIR
+        self.gauges_locker = Lock()
+        self.gauges = {}
+
         self.prev_mem = 0
         self.curr_mem = 0
         self.initial_growth = {}
-
-        Thread.run("pc-daemon", self.run_pc_daemon)
-        Thread.run("threads-daemon", self.run_threads_daemon)
-        Thread.run("memory-daemon", self.run_memory_daemon)
-        Thread.run("requests-daemon", self.run_requests_daemon)
+        self.processtolog = psutil.Process(os.getpid())
 
     def get_percent_complete(self):
         with self.total_locker:
@@ -71,23 +81,6 @@ class StatsLogger:
             self.total_files_requested = 0
             self.total_tuids_mapped = 0
 
-    def run_pc_daemon(self, please_stop=None):
-        while not please_stop:
-            try:
-                with self.total_locker:
-                    requested = self.total_files_requested
-                    if requested != 0:
-                        mapped = self.total_tuids_mapped
-                        Log.note(
-                            "Percent complete {{mapped}}/{{requested}} = {{percent|percent(0)}}",
-                            requested=requested,
-                            mapped=mapped,
-                            percent=mapped / requested,
-                        )
-                (Till(seconds=DAEMON_WAIT_FOR_PC.seconds) | please_stop).wait()
-            except Exception as e:
-                Log.warning("Unexpected error in pc-daemon: {{cause}}", cause=e)
-
     def update_threads_waiting(self, val):
         with self.threads_locker:
             self.threads_waiting += val
@@ -96,18 +89,40 @@ class StatsLogger:
         with self.threads_locker:
             self.waiting += val
 
-    def run_threads_daemon(self, please_stop=None):
-        while not please_stop:
-            try:
-                with self.threads_locker:
-                    Log.note(
-                        "Currently {{waiting}} waiting to get annotation, and {{threads}} waiting to be created.",
-                        waiting=self.waiting,
-                        threads=self.threads_waiting,
-                    )
-                (Till(seconds=DAEMON_WAIT_FOR_THREADS.seconds) | please_stop).wait()
-            except Exception as e:
-                Log.warning("Unexpected error in pc-daemon: {{cause}}", cause=e)
+    def update_cache(self, hits=0, misses=0):
+        """
+        Count annotation lookups that were answered from the
+        annotations index (hits) or needed hg/diff work (misses).
+        """
+        with self.cache_locker:
+            self.cache_hits += hits
+            self.cache_misses += misses
+
+    def record_latency(self, seconds):
+        """
+        Add one request duration to the latency histogram.
+        :param seconds: time taken to answer the request
+        """
+        for i, upper in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+
+        with self.latency_locker:
+            self.latency_counts[i] += 1
+            self.latency_sum += seconds
+            self.latency_count += 1
+
+    def add_gauge(self, name, description, function):
+        """
+        Register a value that is read only when metrics are requested.
+        :param name: metric name, without prefix
+        :param description: help text
+        :param function: called with no parameters, returns a number
+        """
+        with self.gauges_locker:
+            self.gauges[name] = (description, function)
 
     def set_process(self, pid):
         self.processtolog = psutil.Process(os.getpid())
@@ -136,19 +151,6 @@ class StatsLogger:
         tmp = psutil.virtual_memory()
         return tmp.percent
 
-    def run_memory_daemon(self, please_stop):
-        while not please_stop:
-            try:
-                (Till(seconds=DAEMON_MEMORY_LOG_INTERVAL.seconds) | please_stop).wait()
-                mem = psutil.virtual_memory()
-                Log.note("TUID Process - complete memory info: {{mem}}", mem=str(mem))
-                Log.note("\nOpen threads ({{num}}):", num=len(ALL))
-                Log.note("{{data}}", data=str({i: ALL[i].name for i in ALL}))
-            except Exception as e:
-                Log.warning(
-                    "Error encountered while trying to log memory: {{cause}}", cause=e
-                )
-
     def update_requests(
         self,
         requests_total=0,
@@ -175,40 +177,179 @@ class StatsLogger:
             self.requests_passed += requests_passed
 
     def get_requests(self):
+        with self.requests_locker:
+            return {
+                "total": self.requests_total,
+                "incomplete": self.requests_incomplete,
+                "complete": self.requests_complete,
+                "failed": self.requests_failed,
+                "passed": self.requests_passed,
+            }
+
+    def snapshot(self):
+        """
+        :return: dict of all counters and gauges, as of now
+        """
+        requests = self.get_requests()
+        finished = requests["complete"] + requests["incomplete"]
+
+        with self.total_locker:
+            files_requested = self.total_files_requested
+            tuids_mapped = self.total_tuids_mapped
+
+        with self.threads_locker:
+            anns_waiting = self.waiting
+            threads_waiting = self.threads_waiting
+
+        with self.cache_locker:
+            hits = self.cache_hits
+            misses = self.cache_misses
+
+        with self.latency_locker:
+            latency = {
+                "buckets": list(self.latency_counts),
+                "sum": self.latency_sum,
+                "count": self.latency_count,
+            }
+
+        with self.gauges_locker:
+            gauges = list(self.gauges.items())
+        gauge_values = {}
+        for name, (_, function) in gauges:
+            try:
+                gauge_values[name] = function()
+            except Exception as e:
+                Log.note("Could not read gauge {{name}}: {{cause}}", name=name, cause=e)
+
         return {
-            "total": self.requests_total,
-            "incomplete": self.requests_incomplete,
-            "complete": self.requests_complete,
-            "failed": self.requests_failed,
-            "passed": self.requests_passed,
+            "requests": requests,
+            "requests_complete_ratio": requests["complete"] / finished if finished else 1.0,
+            "files_requested": files_requested,
+            "tuids_mapped": tuids_mapped,
+            "annotations_waiting": anns_waiting,
+            "threads_waiting": threads_waiting,
+            "cache_hits": hits,
+            "cache_misses": misses,
+            "cache_hit_ratio": hits / (hits + misses) if hits + misses else 1.0,
+            "latency": latency,
+            "threads_open": len(ALL),
+            "process_memory_bytes": self.processtolog.memory_info().rss,
+            "free_memory_bytes": psutil.virtual_memory().available,
+            "gauges": gauge_values,
         }
 
-    def run_requests_daemon(self, please_stop):
-        while not please_stop:
-            try:
-                (
-                    Till(seconds=DAEMON_REQUESTS_LOG_INTERVAL.seconds) | please_stop
-                ).wait()
-                request_stats = self.get_requests()
-                if request_stats["incomplete"] == 0:
-                    pc_complete = request_stats["complete"]
+    def to_prometheus(self):
+        """
+        :return: the snapshot in Prometheus text exposition format
+        """
+        snap = self.snapshot()
+        output = []
+
+        def metric(name, kind, description, samples):
+            name = METRICS_PREFIX + name
+            output.append("# HELP " + name + " " + description)
+            output.append("# TYPE " + name + " " + kind)
+            for suffix, labels, value in samples:
+                if labels:
+                    label_text = "{" + ",".join(k + '="' + str(v) + '"' for k, v in labels) + "}"
                 else:
-                    pc_complete = (
-                        request_stats["complete"] / request_stats["incomplete"]
-                    )
-                Log.note(
-                    "\nRequest stats \n"
-                    "----------------\n"
-                    "Requests ratio (complete/incomplete): {{comp}}/{{incomp}} = {{pc_comp}}\n"
-                    "Passed: {{passed}}\n"
-                    "Failed: {{failed}}\n",
-                    comp=request_stats["complete"],
-                    incomp=request_stats["incomplete"],
-                    pc_comp=pc_complete,
-                    passed=request_stats["passed"],
-                    failed=request_stats["failed"],
-                )
-            except Exception as e:
-                Log.warning(
-                    "Error encountered while trying to log requests: {{cause}}", cause=e
-                )
+                    label_text = ""
+                output.append(name + suffix + label_text + " " + _number(value))
+
+        requests = snap["requests"]
+        metric("requests_total", "counter", "Requests received", [("", None, requests["total"])])
+        metric(
+            "requests_outcome_total",
+            "counter",
+            "Requests by outcome",
+            [
+                ("", [("outcome", outcome)], requests[outcome])
+                for outcome in ("complete", "incomplete", "passed", "failed")
+            ],
+        )
+        metric(
+            "requests_complete_ratio",
+            "gauge",
+            "Complete requests over all finished requests",
+            [("", None, snap["requests_complete_ratio"])],
+        )
+        metric(
+            "files_requested_total",
+            "counter",
+            "Files requested",
+            [("", None, snap["files_requested"])],
+        )
+        metric(
+            "files_mapped_total",
+            "counter",
+            "Files given tuids",
+            [("", None, snap["tuids_mapped"])],
+        )
+        metric(
+            "annotations_waiting",
+            "gauge",
+            "Annotations waiting for an hg request slot",
+            [("", None, snap["annotations_waiting"])],
+        )
+        metric(
+            "threads_waiting",
+            "gauge",
+            "Files waiting for an annotation thread",
+            [("", None, snap["threads_waiting"])],
+        )
+        metric(
+            "annotation_cache_total",
+            "counter",
+            "Annotation lookups by result",
+            [
+                ("", [("result", "hit")], snap["cache_hits"]),
+                ("", [("result", "miss")], snap["cache_misses"]),
+            ],
+        )
+        metric(
+            "annotation_cache_hit_ratio",
+            "gauge",
+            "Annotation lookups answered from the annotations index",
+            [("", None, snap["cache_hit_ratio"])],
+        )
+
+        latency = snap["latency"]
+        samples = []
+        cumulative = 0
+        for upper, count in zip(LATENCY_BUCKETS + ("+Inf",), latency["buckets"]):
+            cumulative += count
+            samples.append(("_bucket", [("le", upper)], cumulative))
+        samples.append(("_sum", None, latency["sum"]))
+        samples.append(("_count", None, latency["count"]))
+        metric("request_latency_seconds", "histogram", "Request latency", samples)
+
+        metric("threads_open", "gauge", "Open threads", [("", None, snap["threads_open"])])
+        metric(
+            "process_memory_bytes",
+            "gauge",
+            "Resident memory of this process",
+            [("", None, snap["process_memory_bytes"])],
+        )
+        metric(
+            "free_memory_bytes",
+            "gauge",
+            "Memory available on the machine",
+            [("", None, snap["free_memory_bytes"])],
+        )
+
+        with self.gauges_locker:
+            descriptions = {name: description for name, (description, _) in self.gauges.items()}
+        for name, value in sorted(snap["gauges"].items()):
+            metric(name, "gauge", descriptions.get(name, name), [("", None, value)])
+
+        return "\n".join(output) + "\n"
+
+
+def _number(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
@@ -10,12 +10,11 @@ from __future__ import unicode_literals
 
 from collections import namedtuple
 
+from mo_dots import is_many
 from mo_files.url import URL
 from mo_hg.apply import Line, SourceFile
 from mo_logs import Log
-from mo_threads import Till
 
-TIMEOUT = 10
 HG_URL = URL("https://hg.mozilla.org/")
 
 
@@ -74,6 +73,9 @@ class AnnotateFile(SourceFile, object):
                 ]
 
                 self.tuid_service._insert_max_tuid()
+                self.tuid_service._insert_tuid_ranges(
+                    (tuid, file, rev) for tuid, file, rev, _ in insert_entries
+                )
             except Exception as e:
                 Log.note(
                     "Failed to insert new tuids (likely due to merge conflict) on {{file}}: {{cause}}",
@@ -117,29 +119,80 @@ def map_to_array(pairs):
         return None
 
 
-def wait_until(index, condition):
-    timeout = Till(seconds=TIMEOUT)
-    while not timeout:
-        if condition():
-            break
-        index.refresh()
+def select_lines(pairs, wanted):
+    """
+    THE TUIDS OF JUST THE wanted LINES
+    :param pairs: (tuid, line) PAIRS FOR THE WHOLE FILE
+    :param wanted: LIST OF LINE NUMBERS, AND [first, last] RANGES (INCLUSIVE)
+    :return: (lines, tuids) - THE wanted LINES IN THE FILE, IN ORDER, AND THEIR TUIDS
+    """
+    tuids = map_to_array(pairs) or []
+    lines = set()
+    for w in wanted:
+        if is_many(w):
+            first, last = w
+            lines.update(range(max(first, 1), min(last, len(tuids)) + 1))
+        elif 1 <= w <= len(tuids):
+            lines.add(w)
+    lines = sorted(lines)
+    return lines, [tuids[line - 1] for line in lines]
+
+
+COPY = 0  # DELTA RUN: COPY n TUIDS FROM THE BASE, STARTING AT INDEX a
+NEW = 1  # DELTA RUN: THE n TUIDS a, a+1, ... a+n-1
+
+
+def encode_delta(base, tuids):
+    """
+    DESCRIBE tuids AS RUNS OF base AND RUNS OF CONSECUTIVE NEW TUIDS
+    :param base: LIST OF TUIDS
+    :param tuids: LIST OF TUIDS
+    :return: FLAT LIST OF (kind, a, n) TRIPLES
+    """
+    position = {t: i for i, t in enumerate(base) if t != -1}
+    delta = []
+    kind = start = length = None
+    for tuid in tuids:
+        if kind == COPY and start + length < len(base) and base[start + length] == tuid:
+            length += 1
+            continue
+        if kind == NEW and tuid != -1 and tuid == start + length:
+            length += 1
+            continue
+        if kind is not None:
+            delta.extend((kind, start, length))
+        if tuid in position:
+            kind, start, length = COPY, position[tuid], 1
+        else:
+            kind, start, length = NEW, tuid, 1
+    if kind is not None:
+        delta.extend((kind, start, length))
+    return delta
+
+
+def decode_delta(base, delta):
+    """
+    :return: THE LIST OF TUIDS encode_delta(base, tuids) DESCRIBES
+    """
+    tuids = []
+    for i in range(0, len(delta), 3):
+        kind, start, length = delta[i : i + 3]
+        if kind == COPY:
+            tuids.extend(base[start : start + length])
+        else:
+            tuids.extend(range(start, start + length))
+    return tuids
 
 
 def delete(index, filter):
-    index.delete_record(filter)
-    index.refresh()
-    wait_until(index, lambda: index.search({"size": 0, "query": filter}).hits.total == 0)
+    # RETURNS ONCE THE DELETE IS VISIBLE TO SEARCH
+    # (ES WANTS THE STRING; requests WOULD SEND A PYTHON True AS "True")
+    index.delete_record(filter, refresh="true")
 
 
 def insert(index, records):
-    ids = records.value._id
-    index.extend(records)
-    index.refresh()
-    wait_until(
-        index,
-        lambda: index.search({"size": 0, "query": {"terms": {"_id": ids}}}).hits.total
-        == len(records),
-    )
+    # RETURNS ONCE THE RECORDS ARE VISIBLE TO SEARCH
+    index.extend(records, refresh="wait_for")
 
 
 # Used for increasing readability
@@ -0,0 +1,251 @@
+# encoding: utf-8
+#
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import re
+import zlib
+from bisect import bisect_right
+from glob import glob
+
+from jx_sqlite.sqlite import quote_list, quote_value
+from mo_kwargs import override
+from mo_logs import Log
+from mo_threads import Lock
+from tuid import sql
+
+TUID_BLOCK_SIZE = 10000  # tuids a worker takes from the coordinator at a time
+FRONTIER_BATCH_SIZE = 500  # frontiers moved between worker databases at once
+
+
+def owner(path, count):
+    """
+    :return: the worker, 0 to count-1, that owns the frontier of the file
+    """
+    return zlib.crc32(path.lstrip("/").encode("utf8")) % count
+
+
+class Workers(object):
+    """
+    The worker processes of a multi-process deployment. Each is a
+    TUIDService with its own port (flask.port + process_num) and its own
+    database, and owns the files whose path hashes to it: only the owner
+    moves the frontier of a file.
+
+    The workers share a coordinator database, which hands out blocks of
+    tuids, remembers which worker took each block, and records which workers
+    have copied forward what they need from an annotations partition, so it
+    is dropped only after all have.
+    """
+
+    @override
+    def __init__(
+        self,
+        count,
+        coordinator,
+        process_num=0,
+        url="http://localhost",
+        port=5000,
+        block_size=None,
+        kwargs=None,
+    ):
+        if not 0 <= process_num < count:
+            Log.error(
+                "Expecting process_num from 0 to {{max}}, not {{num}}",
+                max=count - 1,
+                num=process_num,
+            )
+        self.count = count
+        self.process_num = process_num
+        self.url = url
+        self.port = port
+        self.block_size = TUID_BLOCK_SIZE if block_size is None else block_size
+        self.conn = sql.Sql(coordinator)
+        self.locker = Lock()
+        self.starts = []  # start of every block known, in order
+        self.blocks = []  # (start, stop, worker) of every block known, in order
+
+        with self.conn.transaction() as t:
+            # The first tuid not yet handed out
+            t.execute(
+                """
+            CREATE TABLE IF NOT EXISTS tuidNext (
+                id        INTEGER,
+                tuid      INTEGER,
+                PRIMARY KEY(id)
+            );"""
+            )
+            t.execute(
+                """
+            CREATE TABLE IF NOT EXISTS tuidBlock (
+                start          INTEGER,
+                stop           INTEGER NOT NULL,
+                worker         INTEGER NOT NULL,
+                PRIMARY KEY(start)
+            );"""
+            )
+            t.execute(
+                """
+            CREATE TABLE IF NOT EXISTS partitionCarried (
+                partition      TEXT,
+                worker         INTEGER,
+                PRIMARY KEY(partition, worker)
+            );"""
+            )
+
+    def owner(self, path):
+        return owner(path, self.count)
+
+    def owns(self, path):
+        return owner(path, self.count) == self.process_num
+
+    def local_name(self, name):
+        """
+        :return: the name of a database or index that belongs to this worker;
+                 worker 0 keeps the name, so it keeps the data of a
+                 single-process deployment
+        """
+        if not self.process_num:
+            return name
+        base, ext = os.path.splitext(name)
+        return base + "-" + str(self.process_num) + ext
+
+    def peer_url(self, process_num):
+        return self.url.rstrip("/") + ":" + str(self.port + process_num) + "/tuid"
+
+    def start_tuids(self, floor):
+        """
+        Called by worker 0, to make sure the tuids it made before there were
+        workers are never handed out again
+        :param floor: the first tuid worker 0 has not used
+        """
+        with self.conn.transaction() as t:
+            t.execute("INSERT OR IGNORE INTO tuidNext (id, tuid) VALUES (1, ?)", (floor,))
+            t.execute("UPDATE tuidNext SET tuid=max(tuid, ?) WHERE id=1", (floor,))
+
+    def next_block(self, floor):
+        """
+        Take the next block of tuids. The update comes first, so the write
+        lock is taken before anything is read; two workers asking at once
+        wait in turn, instead of both holding a read lock and deadlocking.
+
+        :param floor: the first tuid this worker has not used
+        :return: (start, stop) of the block
+        """
+        with self.conn.transaction() as t:
+            t.execute(
+                "UPDATE tuidNext SET tuid=max(tuid, ?)+? WHERE id=1", (floor, self.block_size)
+            )
+            if not t.get_one("SELECT changes()")[0]:
+                Log.error("No tuids are handed out before worker 0 has started")
+            stop = t.get_one("SELECT tuid FROM tuidNext WHERE id=1")[0]
+            start = stop - self.block_size
+            t.execute(
+                "INSERT INTO tuidBlock (start, stop, worker) VALUES (?, ?, ?)",
+                (start, stop, self.process_num),
+            )
+        return start, stop
+
+    def take_frontiers(self, conn, name):
+        """
+        Move the frontiers (latestFileMod rows) of the files this worker owns
+        out of the databases of the other workers, and of the single-process
+        deployment before them, into this worker's. The annotations are
+        shared, so a file keeps its tuids when the number of workers changes.
+
+        :param conn: the database of this worker
+        :param name: database.name, as configured
+        """
+        mine = os.path.abspath(self.local_name(name))
+        for other in _worker_databases(name):
+            if other == mine:
+                continue
+            # Attached, so the copy and the delete are one transaction
+            conn.get("ATTACH DATABASE " + quote_value(other) + " AS other")
+            try:
+                if not conn.get("SELECT name FROM other.sqlite_master WHERE name='latestFileMod'"):
+                    continue
+                files = [
+                    file
+                    for file, in conn.get("SELECT file FROM other.latestFileMod")
+                    if self.owns(file)
+                ]
+                with conn.transaction() as t:
+                    for start in range(0, len(files), FRONTIER_BATCH_SIZE):
+                        some = quote_list(files[start : start + FRONTIER_BATCH_SIZE])
+                        t.execute(
+                            "INSERT OR REPLACE INTO latestFileMod (file, revision)"
+                            " SELECT file, revision FROM other.latestFileMod WHERE file IN " + some
+                        )
+                        t.execute("DELETE FROM other.latestFileMod WHERE file IN " + some)
+                if files:
+                    Log.note(
+                        "Took {{num}} frontiers from {{database}}", num=len(files), database=other
+                    )
+            finally:
+                conn.get("DETACH DATABASE other")
+
+    def tuid_owner(self, tuid):
+        """
+        :return: the worker that made the tuid; tuids from before there were
+                 workers, or not handed out yet, are worker 0's
+        """
+        with self.locker:
+            if not self.blocks or tuid >= self.blocks[-1][1]:
+                self.blocks = [
+                    tuple(r)
+                    for r in self.conn.get(
+                        "SELECT start, stop, worker FROM tuidBlock ORDER BY start"
+                    )
+                ]
+                self.starts = [start for start, _, _ in self.blocks]
+            i = bisect_right(self.starts, tuid) - 1
+            if i < 0:
+                return 0
+            _, stop, worker = self.blocks[i]
+            return worker if tuid < stop else 0
+
+    def has_carried(self, partition):
+        """
+        :return: True if this worker copied forward what it needs from the partition
+        """
+        return bool(
+            self.conn.get(
+                "SELECT 1 FROM partitionCarried WHERE partition=? AND worker=?",
+                (partition, self.process_num),
+            )
+        )
+
+    def carried(self, partition):
+        """
+        Record that this worker copied forward what it needs from the partition
+        :return: True if every worker has, so the partition can be dropped
+        """
+        with self.conn.transaction() as t:
+            t.execute(
+                "INSERT OR IGNORE INTO partitionCarried (partition, worker) VALUES (?, ?)",
+                (partition, self.process_num),
+            )
+            done = t.get_one(
+                "SELECT COUNT(*) FROM partitionCarried WHERE partition=?", (partition,)
+            )[0]
+        return done >= self.count
+
+
+def _worker_databases(name):
+    """
+    :return: absolute paths of the databases of all workers, by local_name()
+    """
+    base, ext = os.path.splitext(name)
+    pattern = re.escape(os.path.abspath(base)) + r"(-\d+)?" + re.escape(ext) + "$"
+    return sorted(
+        path
+        for path in map(os.path.abspath, glob(base + ext) + glob(base + "-*" + ext))
+        if re.match(pattern, path)
+    )